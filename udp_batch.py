@@ -0,0 +1,223 @@
+"""
+Batches: many files sent in one transfer, one handshake for all of them instead of one per file. The client sends a
+manifest with the name and size of every file first, and then all of the files as if they were one file, every file
+right behind the one in front of it. The window slides from one file into the next like it slides through one file,
+the next file is already on its way while the last ACKs of the file in front of it are still outstanding, and small
+files share chunks: a batch of a thousand 10 KB files goes in as many full-size packets as one 10 MB file, not in a
+thousand packets of 10 KB. The server writes every part of a chunk into the file it belongs to (`spans()`).
+
+`bisect` - The `bisect` module provides support for maintaining a list in sorted order without having to sort the list
+after each insertion. It finds the file a byte of the batch belongs to among the offsets of the files with a binary
+search.
+
+`bisect`: https://docs.python.org/3/library/bisect.html
+
+`collections` - The `collections` module implements specialized container datatypes. An `OrderedDict` keeps the files
+the client has open in the order they were used, so the one used longest ago is closed first.
+
+`collections`: https://docs.python.org/3/library/collections.html
+
+`os` - The `os` module provides a way of interacting with the operating system. `os.walk()` finds the files in a
+directory that is sent as a batch and `os.pread()` reads a chunk from a file.
+
+`os`: https://docs.python.org/3/library/os.html
+
+`posixpath` - The `posixpath` module implements path operations with '/' as the separator on every system. The names
+in a manifest always use '/', whatever system the client and server run on.
+
+`posixpath`: https://docs.python.org/3/library/os.path.html
+
+`struct` - The `struct` module performs conversions between Python values and C structs. The manifest is packed with
+the precompiled `MANIFEST_HEADER` and `ENTRY` structs.
+
+`struct`: https://docs.python.org/3/library/struct.html
+
+--- Manifest ---
+
+The manifest is the number of files followed by the size and name of every file, all integers big-endian:
+
+    +-----------------+-----------------+-----------------+------------------+-----
+    | file count      | file size       | name length     | name (UTF-8)     | file size ...
+    | 4 bytes (!I)    | 8 bytes (!Q)    | 2 bytes (!H)    | name length      |
+    +-----------------+-----------------+-----------------+------------------+-----
+
+A name is a relative path with '/' between the directories, the server writes the file under that name in the
+directory it writes its files to. Names that would end up outside of it (absolute paths, '..') are refused.
+
+"""
+
+import bisect
+import collections
+import os
+import posixpath
+import struct
+
+
+# The number of files at the start of a manifest, and the size and name length in front of every name
+MANIFEST_HEADER = struct.Struct('!I')
+ENTRY = struct.Struct('!QH')
+
+# How many files the client keeps open at once, reading the chunks of a batch of thousands of files
+OPEN_FILES = 64
+
+
+# The safe_name() method returns name if it is a relative path that stays inside the directory it is written to,
+# otherwise None
+def safe_name(name):
+    parts = name.split("/")
+    if not name or name.startswith("/") or "\\" in name or ":" in name or \
+            any(part in ("", ".", "..") for part in parts):
+        return None
+    return name
+
+
+# The name_clash() method returns a name of names that can't be written next to the others, because another file has
+# the same name or is written into a directory of that name (a and a/b), otherwise None
+def name_clash(names):
+    seen = set()
+    for name in names:
+        if name in seen:
+            return name
+        seen.add(name)
+    for name in seen:
+        parts = name.split("/")
+        for end in range(1, len(parts)):
+            directory = "/".join(parts[:end])
+            if directory in seen:
+                return directory
+    return None
+
+
+# The pack_manifest() method returns the manifest of entries, (name, size) for every file
+def pack_manifest(entries):
+    manifest = bytearray(MANIFEST_HEADER.pack(len(entries)))
+    for name, size in entries:
+        encoded = name.encode()
+        manifest += ENTRY.pack(size, len(encoded)) + encoded
+    return bytes(manifest)
+
+
+# The unpack_manifest() method returns the (name, size) of every file in manifest, or None if it isn't a manifest, one
+# of its names isn't safe_name() or clashes with another one (name_clash())
+def unpack_manifest(manifest):
+    try:
+        count, = MANIFEST_HEADER.unpack_from(manifest)
+        position = MANIFEST_HEADER.size
+        entries = []
+        for _ in range(count):
+            size, name_length = ENTRY.unpack_from(manifest, position)
+            position += ENTRY.size
+            name = safe_name(bytes(manifest[position:position + name_length]).decode())
+            position += name_length
+            if name is None or position > len(manifest):
+                return None
+            entries.append((name, size))
+    except (struct.error, UnicodeDecodeError):
+        return None
+    if position != len(manifest) or name_clash(name for name, size in entries) is not None:
+        return None
+    return entries
+
+
+# The file_offsets() method returns where every file of sizes starts in the batch, right behind the one in front of it
+def file_offsets(sizes):
+    offsets = []
+    offset = 0
+    for size in sizes:
+        offsets.append(offset)
+        offset += size
+    return offsets
+
+
+# The spans() method yields (file index, offset in the file, length) for every part of the length bytes at offset of
+# the batch, offsets is from file_offsets(). The search starts at the last file starting at or before offset, empty
+# files are skipped
+def spans(offsets, sizes, offset, length):
+    index = bisect.bisect_right(offsets, offset) - 1
+    end = offset + length
+    while offset < end:
+        piece = min(end, offsets[index] + sizes[index]) - offset
+        if piece > 0:
+            yield index, offset - offsets[index], piece
+            offset += piece
+        index += 1
+
+
+# The Batch class is the files the client sends in one batch, paths are files or directories. The files in a
+# directory are sent with names relative to the directory the directory is in, so the server ends up with the same
+# directory, other files are sent under their own name without the directories in front of it. Paths that would end
+# up with the same name on the server (d/f and e/f) raise ValueError before anything is sent
+# A Batch is read like the memory-mapped file of a single file transfer: batch[start:stop] are the bytes from start to
+# stop of all of the files one after the other, read with os.pread() from at most OPEN_FILES files kept open at once
+class Batch:
+    def __init__(self, paths):
+        self.filenames = []
+        self.names = []
+        for path in paths:
+            if os.path.isdir(path):
+                parent = os.path.dirname(os.path.abspath(path))
+                for directory, directories, filenames in os.walk(path):
+                    directories.sort()
+                    for filename in sorted(filenames):
+                        filename = os.path.join(directory, filename)
+                        self.filenames.append(filename)
+                        self.names.append(os.path.relpath(os.path.abspath(filename), parent).replace(os.sep, "/"))
+            else:
+                self.filenames.append(path)
+                self.names.append(os.path.basename(path))
+        clash = name_clash(self.names)
+        if clash is not None:
+            raise ValueError(f"a batch can't have more than one file or directory named {clash!r}")
+        self.sizes = [os.path.getsize(filename) for filename in self.filenames]
+        self.size = sum(self.sizes)
+        self.offsets = file_offsets(self.sizes)
+        self.manifest = pack_manifest(list(zip(self.names, self.sizes)))
+        self.files = collections.OrderedDict()
+
+    def __len__(self):
+        return self.size
+
+    # Slicing a Batch reads the bytes the slice covers from every file they are in, never past the end of the batch
+    def __getitem__(self, key):
+        start = min(key.start, self.size)
+        stop = min(key.stop, self.size)
+        parts = [self.read(index, offset, length) for index, offset, length in
+                 spans(self.offsets, self.sizes, start, stop - start)]
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    # The read() method reads length bytes at offset of file number index
+    def read(self, index, offset, length):
+        f = self.open(index)
+        if hasattr(os, "pread"):
+            return os.pread(f.fileno(), length, offset)
+        f.seek(offset)
+        return f.read(length)
+
+    # The open() method returns the open file number index, opening it (and closing the file used longest ago) if it
+    # isn't open already
+    def open(self, index):
+        f = self.files.get(index)
+        if f is not None:
+            self.files.move_to_end(index)
+            return f
+        if len(self.files) >= OPEN_FILES:
+            self.files.popitem(last=False)[1].close()
+        f = self.files[index] = open(self.filenames[index], "rb")
+        return f
+
+    # The close() method closes every file that is still open
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The batch_path() method is where the server writes the file name of a batch, inside directory
+def batch_path(directory, name):
+    return os.path.join(directory, *posixpath.normpath(name).split("/"))
@@ -0,0 +1,1026 @@
+"""
+Benchmarks for the UDP client and server, everything runs on the loopback interface (127.0.0.1) so no second machine
+is needed.
+
+`argparse` - The `argparse` module makes it easy to write user-friendly command-line interfaces. It is used to pick
+which benchmark to run and with what parameters.
+
+`argparse`: https://docs.python.org/3/library/argparse.html
+
+`concurrent.futures` - The `concurrent.futures` module provides a high-level interface for asynchronously executing
+callables in threads or processes. It is used to run many clients at the same time, each in its own process so they
+don't share the server's interpreter lock.
+
+`concurrent.futures`: https://docs.python.org/3/library/concurrent.futures.html
+
+`contextlib` - The `contextlib` module provides utilities for common tasks involving the `with` statement. It is used
+to silence the output of the client and server while they are being measured.
+
+`contextlib`: https://docs.python.org/3/library/contextlib.html
+
+`filecmp` - The `filecmp` module compares files. It is used to check that every file received is the file that was
+sent.
+
+`filecmp`: https://docs.python.org/3/library/filecmp.html
+
+`hashlib` - The `hashlib` module implements secure hash and message digest algorithms. The stream benchmark checks
+the bytes it received against the bytes it sent with a BLAKE2 digest of each, without keeping either of them.
+
+`hashlib`: https://docs.python.org/3/library/hashlib.html
+
+`functools` - The `functools` module provides higher-order functions. `functools.partial()` gives the server's worker
+processes a filename function that can be handed to another process.
+
+`functools`: https://docs.python.org/3/library/functools.html
+
+`json` - The `json` module encodes Python objects as JSON. It is used to save the results of the network benchmark so
+runs can be compared later to catch regressions.
+
+`json`: https://docs.python.org/3/library/json.html
+
+`multiprocessing` - The `multiprocessing` module supports spawning processes. Its `Event` stops the server's worker
+processes at the end of the stripes benchmark.
+
+`multiprocessing`: https://docs.python.org/3/library/multiprocessing.html
+
+`random` - The `random` module implements pseudo-random number generators. It picks where the delta benchmark
+changes the file, with a seed so every run changes the same places.
+
+`random`: https://docs.python.org/3/library/random.html
+
+`platform` - The `platform` module identifies the platform the code runs on. It is recorded with the saved results.
+
+`platform`: https://docs.python.org/3/library/platform.html
+
+`subprocess` - The `subprocess` module spawns new processes. It is used to run the server as its own program
+(`python udp_server.py --port 0`) when the network benchmark runs in process mode.
+
+`subprocess`: https://docs.python.org/3/library/subprocess.html
+
+`tempfile` - The `tempfile` module creates temporary files and directories. It is used for the files being sent and
+received so the benchmark doesn't leave anything behind.
+
+`tempfile`: https://docs.python.org/3/library/tempfile.html
+
+`struct` - The `struct` module performs conversions between Python values and C structs. It is used to rebuild the
+original per-packet code (a new format string for every `struct.pack()`) as the baseline for the codec benchmark.
+
+`struct`: https://docs.python.org/3/library/struct.html
+
+`threading` - The `threading` module constructs higher-level threading interfaces. It is used to run the server in
+the background of the benchmark process.
+
+`threading`: https://docs.python.org/3/library/threading.html
+
+`tracemalloc` - The `tracemalloc` module traces memory blocks allocated by Python. It is used to measure how much
+memory the per-packet code allocates and the most memory a transfer held at once.
+
+`tracemalloc`: https://docs.python.org/3/library/tracemalloc.html
+
+--- Benchmarks ---
+
+clients     Starts one `udp_server.serve()` and has 1, 2, 4, ... clients send a file to it at the same time, then prints
+            the aggregate throughput of all clients for every client count.
+
+codec       Microbenchmark of the per-packet work alone (read from file, build the packet, take it apart again), with
+            and without a loopback socket in between, for the original code (`f.read()`, `struct.pack()` with an
+            f-string format, `recvfrom()`) and the buffer-reusing code in `udp_packet` (`readinto()`, `pack_into()`,
+            `recvfrom_into()`), both with 1024 byte chunks. Prints packets per second and the bytes allocated per
+            packet.
+
+network     Sends files of every size in `--sizes` through `udp_emulator.NetworkEmulator` for every network condition in
+            `--conditions` (see `CONDITIONS`, or build one with `--delay`, `--jitter`, `--loss`, `--duplicate` and
+            `--reorder`) and prints the completion time, goodput, share of packets resent and the 50th/90th/99th
+            percentile round trip times, and checks every received file against the one sent. With `--mode thread`
+            the client, emulator and server all run in the benchmark process, with `--mode process` the server is
+            started as `udp_server.py` and the client runs in a worker process. `--json` saves every run to a file.
+
+stripes     Starts `udp_server.serve_workers()` with a worker process per port and sends one file with
+            `udp_client.send_striped()` as 1, 2, 4, ... stripes, one client process per stripe, then prints the time and
+            goodput for every stripe count and checks the received file against the one sent. How far the goodput
+            scales with the stripes depends on how many cores the machine has for the client and server processes.
+
+delta       Sends a file once so the server has a copy of it, changes `--edits` places of 100 bytes in it (and inserts
+            a few bytes near the start) and sends it again in full and as a delta (`send_image(delta=True)`), then
+            prints the time and the bytes sent both ways, for the delta also the bytes of the signature of the
+            server's copy the client fetched and the total of both directions, and checks the file the delta was
+            applied to against the one sent. The last row sends the file unchanged once more, with its signature
+            already in the hash cache. With `--delay` the transfers go through `udp_emulator.NetworkEmulator`.
+
+fec         Sends a file through `udp_emulator.NetworkEmulator` with `--delay` and `--loss` for every forward error
+            correction setting in `--fec` (none, or K:M for M parity packets with every K chunks) and prints the
+            completion time, goodput, the bytes of parity on top of the file, and how many lost chunks the server
+            rebuilt from parity against how many packets the client had to send again, then checks the file received.
+
+compress    Sends a file of log lines (compresses well), of random bytes (doesn't compress at all, like a JPEG) and of
+            both in turns of 1 MB without compression and with every zlib level in `--levels`, then prints the time,
+            the bytes sent, the share of the file compression saved and the CPU time the client spent compressing,
+            also per MB saved, and checks the file received. With `--delay` the transfers go through
+            `udp_emulator.NetworkEmulator`.
+
+batch       Sends `--files` files of `--file-size` bytes one transfer per file, as one batch (`send_batch()`) and as
+            one file of the same size as all of them together, then prints the time, the goodput and the files per
+            second of each and checks every file received. With `--delay` the transfers go through
+            `udp_emulator.NetworkEmulator`, where every handshake costs a round trip.
+
+stream      Sends `--size` bytes as a file and as a stream (`send_stream()`) from a generator of `--piece-size` pieces
+            to a server that hands them to a callback, then prints the time, the goodput, how long the first byte took
+            to arrive and the most memory the transfer held at once (traced Python memory, which is the same for every
+            size for a stream), and checks the bytes received. The last row is a live source that produces `--frames`
+            frames of `--frame-size` bytes every `--interval` milliseconds and prints how long a frame takes from
+            being produced to being delivered, on average and at most. With `--delay` the transfers go through
+            `udp_emulator.NetworkEmulator`.
+
+Run with `python udp_benchmark.py <benchmark> --help` to see the parameters of each benchmark.
+
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import filecmp
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import udp_client
+import udp_compress
+import udp_emulator
+import udp_metrics
+import udp_packet
+import udp_server
+import udp_stream
+
+
+# Network conditions for the network benchmark, delay and jitter in milliseconds, loss, duplicate and reorder in
+# percent, the same units as the command line of udp_emulator.py
+CONDITIONS = {
+    "clean": {},
+    "lan": {"delay": 0.5, "jitter": 0.1},
+    "wan": {"delay": 20, "jitter": 2, "loss": 0.5},
+    "lossy": {"delay": 5, "loss": 5},
+    "reorder": {"delay": 5, "jitter": 1, "duplicate": 2, "reorder": 5},
+}
+
+
+# The received_filename() method is where the server started by start_server() writes the file of client_address, or
+# the file of the striped transfer transfer_id
+def received_filename(output_dir, client_address, transfer_id=0):
+    if transfer_id:
+        return os.path.join(output_dir, f"striped_{transfer_id:08x}.bin")
+    return os.path.join(output_dir, f"received_{client_address[1]}.bin")
+
+
+# The start_server() method runs udp_server.serve() on a free loopback port in a background thread and returns the
+# port, the stop event that shuts it down and the thread
+def start_server(output_dir, **kwargs):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(("127.0.0.1", 0))
+    port = server_socket.getsockname()[1]
+
+    # Every client gets its own file in output_dir
+    def filename_for(client_address, transfer_id=0):
+        return received_filename(output_dir, client_address, transfer_id)
+
+    stop_event = threading.Event()
+
+    def run():
+        try:
+            udp_server.serve(server_socket, filename_for=filename_for, stop_event=stop_event, **kwargs)
+        finally:
+            server_socket.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return port, stop_event, thread
+
+
+# The run_client() method sends one file to the server and returns (succeeded, start time, end time), it runs in a
+# worker process so the times are wall clock times that can be compared between processes
+def run_client(filename, port):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.setblocking(False)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.time()
+        succeeded = udp_client.send_image(filename, client_socket, "127.0.0.1", port)
+        end_time = time.time()
+    client_socket.close()
+    return succeeded, start_time, end_time
+
+
+# The start_server_process() method runs udp_server.py as a program in output_dir (where it writes the files it
+# receives) on a free loopback port, and returns the port and the process once the server is listening
+def start_server_process(output_dir):
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "udp_server.py")
+    process = subprocess.Popen([sys.executable, server, "--host", "127.0.0.1", "--port", "0"], cwd=output_dir,
+                               stdout=subprocess.PIPE, text=True)
+
+    # The server prints the port it got once the socket is bound
+    port = None
+    for line in process.stdout:
+        if line.startswith("Server listening on"):
+            port = int(line.rsplit(":", 1)[1])
+            break
+    if port is None:
+        process.wait()
+        raise RuntimeError(f"udp_server.py exited with {process.returncode} before it was listening")
+
+    # The rest of the server's output is read and thrown away so it never fills the pipe and blocks the server
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+    return port, process
+
+
+# The run_network_client() method sends one file to port and returns what udp_metrics.Metrics counted as a dict, it
+# runs in the benchmark process or in a worker process, so everything it returns has to be picklable
+# The round trip time percentiles come from the fixed buckets of udp_metrics.RttHistogram, so they are the upper bound
+# of the bucket the percentile falls in
+def run_network_client(filename, port, chunk_size):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.bind(("127.0.0.1", 0))
+    client_address = client_socket.getsockname()
+    metrics = udp_metrics.Metrics()
+    rate_controller = udp_client.AimdController()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        succeeded = udp_client.send_image(filename, client_socket, "127.0.0.1", port, chunk_size=chunk_size,
+                                          rate_controller=rate_controller, metrics=metrics)
+    client_socket.close()
+
+    snapshot = metrics.snapshot()
+    return {
+        "client_address": client_address,
+        "succeeded": succeeded,
+        "completion_time": snapshot["elapsed"],
+        "goodput": snapshot["goodput"],
+        "chunk_size": snapshot["chunk_size"],
+        "packets_sent": snapshot["packets_sent"],
+        "retransmissions": snapshot["retransmissions"],
+        "retransmission_ratio": snapshot["retransmission_ratio"],
+        "acks_received": snapshot["acks_received"],
+        "rtt_mean_ms": snapshot["rtt_mean"] * 1000,
+        "rtt_p50_ms": snapshot["rtt_p50"] * 1000,
+        "rtt_p90_ms": snapshot["rtt_p90"] * 1000,
+        "rtt_p99_ms": snapshot["rtt_p99"] * 1000,
+        "final_rate": rate_controller.rate,
+    }
+
+
+# The warm_up() method does nothing, it is submitted to the worker processes so they are already started when the
+# measured clients are submitted
+def warm_up():
+    return None
+
+
+# The bench_clients() method measures the aggregate throughput of the server as the number of clients grows
+def bench_clients(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(args.size))
+
+        port, stop_event, thread = start_server(directory)
+
+        print(f"{'clients':>8} {'seconds':>10} {'MB/s':>10} {'failed':>8}", file=report)
+        try:
+            for client_count in args.clients:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=client_count) as pool:
+                    for future in [pool.submit(warm_up) for _ in range(client_count)]:
+                        future.result()
+
+                    futures = [pool.submit(run_client, filename, port) for _ in range(client_count)]
+                    results = [future.result() for future in futures]
+
+                # The clients overlap, so the aggregate time is from the first start to the last finish
+                elapsed = max(result[2] for result in results) - min(result[1] for result in results)
+                failed = sum(1 for result in results if not result[0])
+                throughput = (client_count - failed) * args.size / elapsed / 1000000
+                print(f"{client_count:>8} {elapsed:>10.3f} {throughput:>10.2f} {failed:>8}", file=report, flush=True)
+        finally:
+            stop_event.set()
+            thread.join()
+
+
+# The legacy_packet_step() method returns a function that does the per-packet work the way the original scripts did:
+# a new bytes object from f.read(), a new format string and a new packet from struct.pack(), and on the receiving side
+# a new bytes object from recvfrom() and another new format string for struct.unpack()
+def legacy_packet_step(f, filesize, sender, receiver):
+    def step(seq_num):
+        data = f.read(1024)
+        if not data:
+            f.seek(0)
+            data = f.read(1024)
+        packet = struct.pack(f'!I{len(data)}sI', seq_num, data, filesize)
+        if sender is not None:
+            sender.send(packet)
+            packet = receiver.recv(1032)
+        return struct.unpack(f'!I{len(packet)-8}sI', packet)
+    return step
+
+
+# The zero_copy_packet_step() method returns a function that does the same per-packet work with udp_packet: the data is
+# read into a reused buffer, the header is packed in front of it and the receiving side receives into another reused
+# buffer, with the same 1024 byte chunks as the original
+def zero_copy_packet_step(f, filesize, sender, receiver):
+    chunk_size = udp_packet.MIN_CHUNK_SIZE
+    buffer = bytearray(udp_packet.HEADER.size + chunk_size)
+    view = memoryview(buffer)
+    payload = udp_packet.payload_view(buffer, chunk_size)
+    receive_buffer = bytearray(udp_packet.BUFFER_SIZE)
+    receive_view = memoryview(receive_buffer)
+
+    def step(seq_num):
+        length = f.readinto(payload)
+        if not length:
+            f.seek(0)
+            length = f.readinto(payload)
+        size = udp_packet.pack_data(buffer, seq_num, length)
+        if sender is None:
+            received, nbytes = view, size
+        else:
+            sender.send(view if size == len(buffer) else view[:size])
+            received, nbytes = receive_view, receiver.recv_into(receive_buffer)
+        header = udp_packet.unpack_header(received, nbytes)
+        return header, udp_packet.payload(received, header[1])
+    return step
+
+
+# The measure_step() method runs a packet step packets times and returns packets per second, then runs it again under
+# tracemalloc and returns the average number of bytes allocated while handling one packet
+def measure_step(step, packets):
+    start_time = time.perf_counter()
+    for seq_num in range(packets):
+        step(seq_num)
+    packets_per_second = packets / (time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    try:
+        allocated = 0
+        samples = min(packets, 2000)
+        for seq_num in range(samples):
+            # The peak above what was in use before the packet is everything the packet needed along the way
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            step(seq_num)
+            allocated += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return packets_per_second, allocated / samples
+
+
+# The bench_codec() method compares the original per-packet code with the buffer-reusing code in udp_packet
+def bench_codec(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(args.size))
+
+        # A connected pair of loopback sockets so the socket variants include the system calls
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.connect(receiver.getsockname())
+
+        print(f"{'code':>10} {'path':>8} {'packets/s':>12} {'alloc B/pkt':>12}", file=report)
+        try:
+            for name, make_step in (("original", legacy_packet_step), ("udp_packet", zero_copy_packet_step)):
+                for path, sockets in (("codec", (None, None)), ("socket", (sender, receiver))):
+                    with open(filename, "rb") as f:
+                        step = make_step(f, args.size, *sockets)
+                        packets_per_second, allocated = measure_step(step, args.packets)
+                    print(f"{name:>10} {path:>8} {packets_per_second:>12.0f} {allocated:>12.1f}",
+                          file=report, flush=True)
+        finally:
+            sender.close()
+            receiver.close()
+
+
+# The bench_network() method sends files of every size through the network emulator under every network condition and
+# reports (and optionally saves) how every transfer went
+def bench_network(args, report):
+    conditions = {name: CONDITIONS[name] for name in args.conditions}
+    custom = {name: getattr(args, name) for name in ("delay", "jitter", "loss", "duplicate", "reorder")
+              if getattr(args, name)}
+    if custom:
+        conditions["custom"] = custom
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        sources = {}
+        for size in args.sizes:
+            sources[size] = os.path.join(directory, f"source_{size}.bin")
+            with open(sources[size], "wb") as f:
+                f.write(os.urandom(size))
+
+        # One server for the whole matrix, every transfer comes from a new client address
+        pool = None
+        if args.mode == "process":
+            port, server = start_server_process(directory)
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        else:
+            port, stop_event, thread = start_server(directory)
+
+        print(f"{'condition':>10} {'size':>10} {'seconds':>9} {'MB/s':>9} {'resent %':>9} {'p50 ms':>8} "
+              f"{'p90 ms':>8} {'p99 ms':>8} {'ok':>4}", file=report)
+        try:
+            for name, condition in conditions.items():
+                for size in args.sizes:
+                    for run in range(args.runs):
+                        emulator = udp_emulator.NetworkEmulator(
+                            ("127.0.0.1", port), delay=condition.get("delay", 0) / 1000,
+                            jitter=condition.get("jitter", 0) / 1000, loss=condition.get("loss", 0) / 100,
+                            duplicate=condition.get("duplicate", 0) / 100, reorder=condition.get("reorder", 0) / 100,
+                            seed=None if args.seed is None else args.seed + run).start()
+                        try:
+                            if pool is not None:
+                                result = pool.submit(run_network_client, sources[size], emulator.address[1],
+                                                     args.chunk_size).result()
+                            else:
+                                result = run_network_client(sources[size], emulator.address[1], args.chunk_size)
+                            upstream_address = emulator.upstream_address(tuple(result.pop("client_address")))
+                        finally:
+                            emulator.stop()
+
+                        # The server knows the client by the address of the emulator's socket towards it
+                        if pool is not None:
+                            received = os.path.join(directory, udp_server.session_filename(upstream_address))
+                        else:
+                            received = received_filename(directory, upstream_address)
+                        verified = os.path.exists(received) and filecmp.cmp(sources[size], received, shallow=False)
+                        if os.path.exists(received):
+                            os.remove(received)
+
+                        record = {"condition": name, **condition, "size": size, "run": run, "mode": args.mode,
+                                  **result, "verified": verified, "dropped": emulator.dropped,
+                                  "duplicated": emulator.duplicated, "reordered": emulator.reordered}
+                        results.append(record)
+                        print(f"{name:>10} {size:>10} {record['completion_time']:>9.3f} "
+                              f"{record['goodput'] / 1000000:>9.2f} {record['retransmission_ratio'] * 100:>9.2f} "
+                              f"{record['rtt_p50_ms']:>8.2f} {record['rtt_p90_ms']:>8.2f} {record['rtt_p99_ms']:>8.2f} "
+                              f"{'yes' if record['succeeded'] and verified else 'no':>4}", file=report, flush=True)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                server.terminate()
+                server.wait()
+            else:
+                stop_event.set()
+                thread.join()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "benchmark": "network",
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "parameters": {"sizes": args.sizes, "conditions": conditions, "runs": args.runs, "mode": args.mode,
+                               "chunk_size": args.chunk_size, "seed": args.seed},
+                "results": results,
+            }, f, indent=2)
+        print(f"Results saved to {args.json}", file=report)
+
+
+# The bench_stripes() method measures how the goodput of one file grows as it is sent as more stripes at once
+def bench_stripes(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(args.size))
+
+        # One server worker process per port, as many as the most stripes measured
+        server_sockets = []
+        for _ in range(max(args.stripes)):
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server_socket.bind(("127.0.0.1", 0))
+            server_sockets.append(server_socket)
+        ports = [server_socket.getsockname()[1] for server_socket in server_sockets]
+
+        stop_event = multiprocessing.Event()
+        server = threading.Thread(target=udp_server.serve_workers, args=(server_sockets, stop_event),
+                                  kwargs={"filename_for": functools.partial(received_filename, directory)},
+                                  daemon=True)
+        server.start()
+
+        print(f"{'stripes':>8} {'seconds':>10} {'MB/s':>10} {'ok':>4}", file=report)
+        try:
+            for stripes in args.stripes:
+                for transfer_id in range(1, args.runs + 1):
+                    start_time = time.perf_counter()
+                    succeeded = udp_client.send_striped(filename, "127.0.0.1", ports[:stripes], stripes,
+                                                        chunk_size=args.chunk_size, transfer_id=transfer_id)
+                    elapsed = time.perf_counter() - start_time
+
+                    received = received_filename(directory, None, transfer_id)
+                    verified = os.path.exists(received) and filecmp.cmp(filename, received, shallow=False)
+                    if os.path.exists(received):
+                        os.remove(received)
+                    print(f"{stripes:>8} {elapsed:>10.3f} {args.size / elapsed / 1000000:>10.2f} "
+                          f"{'yes' if succeeded and verified else 'no':>4}", file=report, flush=True)
+        finally:
+            stop_event.set()
+            server.join()
+            for server_socket in server_sockets:
+                server_socket.close()
+
+
+# The run_delta_client() method sends filename to port in full, or as a delta with delta set, and returns what
+# udp_metrics.Metrics counted as a dict
+def run_delta_client(filename, port, chunk_size, delta):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    metrics = udp_metrics.Metrics()
+    udp_client.send_image(filename, client_socket, "127.0.0.1", port, chunk_size=chunk_size, metrics=metrics,
+                          delta=delta)
+    client_socket.close()
+    return metrics.snapshot()
+
+
+# The bench_delta() method compares sending a changed file in full with sending it as a delta against the copy the
+# server already has, for every number of changed places in --edits
+def bench_delta(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        original = os.urandom(args.size)
+
+        port, stop_event, thread = start_server(directory)
+        emulator = None
+        if args.delay:
+            emulator = udp_emulator.NetworkEmulator(("127.0.0.1", port), delay=args.delay / 1000).start()
+            port = emulator.address[1]
+        received = received_filename(directory, None, udp_client.delta_id(filename))
+        generator = random.Random(args.seed)
+
+        print(f"{'edits':>8} {'full s':>9} {'full bytes':>12} {'delta s':>9} {'delta bytes':>12} {'sig bytes':>10} "
+              f"{'total':>12} {'copied %':>9} {'ok':>4}", file=report)
+        try:
+            for edits in args.edits + [None]:
+                if edits is not None:
+                    # The server gets the original first, then the changed file is sent in full and as a delta
+                    with open(filename, "wb") as f:
+                        f.write(original)
+                    run_delta_client(filename, port, args.chunk_size, True)
+
+                    changed = bytearray(original)
+                    for _ in range(edits):
+                        offset = generator.randrange(len(changed))
+                        changed[offset:offset + 100] = os.urandom(100)
+                    changed[1000:1000] = b"inserted"
+                    with open(filename, "wb") as f:
+                        f.write(changed)
+                    full = run_delta_client(filename, port, args.chunk_size, False)
+                else:
+                    full = None
+                delta = run_delta_client(filename, port, args.chunk_size, True)
+
+                verified = delta["completed"] and filecmp.cmp(filename, received, shallow=False)
+                label = "same" if edits is None else edits
+                full_columns = (f"{'-':>9} {'-':>12}" if full is None else
+                                f"{full['elapsed']:>9.3f} {full['bytes_sent']:>12}")
+                print(f"{label:>8} {full_columns} {delta['elapsed']:>9.3f} {delta['bytes_sent']:>12} "
+                      f"{delta['signature_bytes']:>10} {delta['bytes_sent'] + delta['signature_bytes']:>12} "
+                      f"{100 * delta['bytes_copied'] / max(delta['filesize'], 1):>9.2f} "
+                      f"{'yes' if verified else 'no':>4}", file=report, flush=True)
+        finally:
+            if emulator is not None:
+                emulator.stop()
+            stop_event.set()
+            thread.join()
+
+
+# The fec_setting() method reads one setting of --fec, none or K:M
+def fec_setting(text):
+    return None if text == "none" else udp_client.parse_fec(text)
+
+
+# The bench_fec() method sends the same file through a lossy emulated network with every forward error correction
+# setting, the server's metrics say how many chunks were rebuilt from parity and the client's how many were resent
+def bench_fec(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(args.size))
+
+        # Every transfer gets a Metrics of its own on the server, the last one is the transfer that just ran
+        server_metrics = []
+
+        def metrics_for(client_address):
+            server_metrics.append(udp_metrics.Metrics())
+            return server_metrics[-1]
+
+        port, stop_event, thread = start_server(directory, metrics_for=metrics_for)
+        print(f"{'fec':>8} {'seconds':>9} {'MB/s':>9} {'parity %':>9} {'repaired':>9} {'resent':>8} {'ok':>4}",
+              file=report)
+        try:
+            for fec in args.fec:
+                for run in range(args.runs):
+                    emulator = udp_emulator.NetworkEmulator(
+                        ("127.0.0.1", port), delay=args.delay / 1000, loss=args.loss / 100,
+                        seed=None if args.seed is None else args.seed + run).start()
+                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    client_socket.bind(("127.0.0.1", 0))
+                    client_address = client_socket.getsockname()
+                    metrics = udp_metrics.Metrics()
+                    try:
+                        udp_client.send_image(filename, client_socket, "127.0.0.1", emulator.address[1],
+                                              chunk_size=args.chunk_size, metrics=metrics, fec=fec)
+                        upstream_address = emulator.upstream_address(client_address)
+                    finally:
+                        client_socket.close()
+                        emulator.stop()
+
+                    received = received_filename(directory, upstream_address)
+                    verified = os.path.exists(received) and filecmp.cmp(filename, received, shallow=False)
+                    if os.path.exists(received):
+                        os.remove(received)
+                    label = "none" if fec is None else f"{fec[0]}:{fec[1]}"
+                    print(f"{label:>8} {metrics.elapsed():>9.3f} {metrics.goodput() / 1000000:>9.2f} "
+                          f"{100 * metrics.parity_sent * metrics.chunk_size / max(args.size, 1):>9.2f} "
+                          f"{server_metrics[-1].fec_repaired:>9} {metrics.retransmissions:>8} "
+                          f"{'yes' if verified else 'no':>4}", file=report, flush=True)
+        finally:
+            stop_event.set()
+            thread.join()
+
+
+# The log_lines() method returns size bytes of made up log lines, text that compresses about as well as real logs
+def log_lines(size, generator):
+    lines = []
+    length = 0
+    while length < size:
+        line = (f"2026-10-17T{generator.randrange(24):02d}:{generator.randrange(60):02d}:"
+                f"{generator.random() * 60:06.3f} {generator.choice(['INFO', 'INFO', 'WARN', 'DEBUG'])} "
+                f"worker-{generator.randrange(16)} GET /api/items/{generator.randrange(100000)} "
+                f"status={generator.choice([200, 200, 200, 404, 500])} took={generator.random() * 100:.2f}ms\n")
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()[:size]
+
+
+# The bench_compress() method sends files that compress well, not at all and in part with every compression level,
+# the client's CPU time spent compressing comes from the udp_compress.Compressor of the transfer
+def bench_compress(args, report):
+    generator = random.Random(args.seed)
+    text = log_lines(args.size, generator)
+    mixed = bytearray()
+    for offset in range(0, args.size, 2 * 1024 * 1024):
+        mixed += text[offset:offset + 1024 * 1024] + os.urandom(1024 * 1024)
+    kinds = {"text": text, "random": os.urandom(args.size), "mixed": bytes(mixed[:args.size])}
+
+    with tempfile.TemporaryDirectory() as directory:
+        port, stop_event, thread = start_server(directory)
+        emulator = None
+        if args.delay:
+            emulator = udp_emulator.NetworkEmulator(("127.0.0.1", port), delay=args.delay / 1000).start()
+            port = emulator.address[1]
+
+        print(f"{'data':>8} {'level':>6} {'seconds':>9} {'MB/s':>9} {'bytes sent':>12} {'saved %':>8} "
+              f"{'CPU ms':>8} {'ms/MB':>8} {'ok':>4}", file=report)
+        try:
+            for kind, data in kinds.items():
+                filename = os.path.join(directory, f"{kind}.bin")
+                with open(filename, "wb") as f:
+                    f.write(data)
+                for level in [None] + args.levels:
+                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    client_socket.bind(("127.0.0.1", 0))
+                    client_address = client_socket.getsockname()
+                    compressor = udp_compress.Compressor(level) if level else None
+                    metrics = udp_metrics.Metrics()
+                    udp_client.send_image(filename, client_socket, "127.0.0.1", port, chunk_size=args.chunk_size,
+                                          metrics=metrics, compressor=compressor)
+                    if emulator is not None:
+                        client_address = emulator.upstream_address(client_address)
+
+                    received = received_filename(directory, client_address)
+                    verified = os.path.exists(received) and filecmp.cmp(filename, received, shallow=False)
+                    if os.path.exists(received):
+                        os.remove(received)
+
+                    seconds = compressor.seconds if compressor is not None else 0
+                    saved = metrics.bytes_saved / 1000000
+                    print(f"{kind:>8} {level or '-':>6} {metrics.elapsed():>9.3f} {metrics.goodput() / 1000000:>9.2f} "
+                          f"{metrics.bytes_sent:>12} {100 * metrics.bytes_saved / max(args.size, 1):>8.2f} "
+                          f"{seconds * 1000:>8.1f} {seconds * 1000 / saved if saved else 0:>8.2f} "
+                          f"{'yes' if verified else 'no':>4}", file=report, flush=True)
+        finally:
+            if emulator is not None:
+                emulator.stop()
+            stop_event.set()
+            thread.join()
+
+
+# The send_files() method sends filenames to port from a socket of its own, as one batch or one transfer for the one
+# file, and returns whether they got across and the address the server saw the transfer come from
+def send_files(filenames, port, chunk_size, emulator):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.bind(("127.0.0.1", 0))
+    client_address = client_socket.getsockname()
+    try:
+        if len(filenames) > 1:
+            succeeded = udp_client.send_batch(filenames, client_socket, "127.0.0.1", port, chunk_size=chunk_size)
+        else:
+            succeeded = udp_client.send_image(filenames[0], client_socket, "127.0.0.1", port, chunk_size=chunk_size)
+    finally:
+        client_socket.close()
+    return succeeded, client_address if emulator is None else emulator.upstream_address(client_address)
+
+
+# The bench_batch() method compares sending many small files one transfer at a time, as one batch and, for the goodput
+# to aim for, one file as big as all of them together
+# The emulator hands a new client the port of one that is done, so every file sent on its own is checked (and removed)
+# right after its transfer, before the next transfer can be written to the same file
+def bench_batch(args, report):
+    with tempfile.TemporaryDirectory() as directory:
+        files = os.path.join(directory, "files")
+        os.mkdir(files)
+        filenames = []
+        for number in range(args.files):
+            filenames.append(os.path.join(files, f"{number:05d}.bin"))
+            with open(filenames[-1], "wb") as f:
+                f.write(os.urandom(args.file_size))
+        single = os.path.join(directory, "single.bin")
+        with open(single, "wb") as f:
+            for filename in filenames:
+                with open(filename, "rb") as part:
+                    f.write(part.read())
+        output_dir = os.path.join(directory, "received")
+        os.mkdir(output_dir)
+
+        port, stop_event, thread = start_server(output_dir)
+        emulator = None
+        if args.delay:
+            emulator = udp_emulator.NetworkEmulator(("127.0.0.1", port), delay=args.delay / 1000).start()
+            port = emulator.address[1]
+
+        total = args.files * args.file_size
+        print(f"{'sent as':>12} {'files':>7} {'seconds':>9} {'MB/s':>9} {'files/s':>9} {'ok':>4}", file=report)
+        try:
+            for mode in ("per file", "batch", "one file"):
+                transfers = [filenames] if mode == "batch" else [[single]] if mode == "one file" else \
+                    [[filename] for filename in filenames]
+                elapsed = 0
+                verified = True
+                for sources in transfers:
+                    start_time = time.perf_counter()
+                    succeeded, address = send_files(sources, port, args.chunk_size, emulator)
+                    elapsed += time.perf_counter() - start_time
+
+                    # A batch goes into a directory named after the file of the client, the files under their names
+                    received = received_filename(output_dir, address)
+                    if mode == "batch":
+                        received = [os.path.join(os.path.splitext(received)[0], os.path.basename(source))
+                                    for source in sources]
+                    else:
+                        received = [received]
+                    verified = verified and succeeded and all(
+                        os.path.exists(copy) and filecmp.cmp(source, copy, shallow=False)
+                        for source, copy in zip(sources, received))
+                    if mode == "per file" and os.path.exists(received[0]):
+                        os.remove(received[0])
+                print(f"{mode:>12} {len(filenames) if mode != 'one file' else 1:>7} {elapsed:>9.3f} "
+                      f"{total / elapsed / 1000000:>9.2f} {len(filenames) / elapsed:>9.1f} "
+                      f"{'yes' if verified else 'no':>4}", file=report, flush=True)
+        finally:
+            if emulator is not None:
+                emulator.stop()
+            stop_event.set()
+            thread.join()
+
+
+# The StreamCheck class is what the server of the stream benchmark delivers a stream to: it keeps a digest and the
+# number of the bytes it got instead of the bytes, when the first of them arrived and when every byte up to each of
+# marks (the end of every frame of a live source) had arrived
+class StreamCheck:
+    def __init__(self, marks=()):
+        self.digest = hashlib.blake2b()
+        self.size = 0
+        self.first = None
+        self.marks = marks
+        self.arrivals = []
+        self.ended = threading.Event()
+
+    def __call__(self, data):
+        now = time.perf_counter()
+        if not data:
+            self.ended.set()
+            return
+        if self.first is None:
+            self.first = now
+        self.digest.update(data)
+        self.size += len(data)
+        while len(self.arrivals) < len(self.marks) and self.size >= self.marks[len(self.arrivals)]:
+            self.arrivals.append(now)
+
+
+# The stream_source() method yields size bytes in pieces of at most piece_size bytes, cut from block over and over,
+# adds them to digest and notes in produced when every piece was made. With interval (seconds) it makes a piece every
+# interval, like a camera makes frames
+def stream_source(size, piece_size, block, digest, produced, interval=0):
+    sent = 0
+    while sent < size:
+        if interval:
+            time.sleep(interval)
+        start = sent % len(block)
+        piece = memoryview(block)[start:start + min(piece_size, size - sent)]
+        digest.update(piece)
+        produced.append(time.perf_counter())
+        sent += len(piece)
+        yield piece
+
+
+# The bench_stream() method compares a file with a stream of the same bytes from a generator, and measures how long
+# the frames of a live source take to get across. The server delivers every stream to the StreamCheck of the row that
+# is running (stream_for), the rows run one at a time
+def bench_stream(args, report):
+    block = os.urandom(1024 * 1024)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "source.bin")
+        with open(filename, "wb") as f:
+            for start in range(0, args.size, len(block)):
+                f.write(block[:min(len(block), args.size - start)])
+        output_dir = os.path.join(directory, "received")
+        os.mkdir(output_dir)
+
+        checks = []
+        port, stop_event, thread = start_server(output_dir, stream_for=lambda client_address: checks[-1])
+        emulator = None
+        if args.delay:
+            emulator = udp_emulator.NetworkEmulator(("127.0.0.1", port), delay=args.delay / 1000).start()
+            port = emulator.address[1]
+
+        frames = args.frames * args.frame_size
+        rows = (("file", args.size, args.piece_size, 0), ("stream", args.size, args.piece_size, 0),
+                ("live", frames, args.frame_size, args.interval / 1000))
+        print(f"{'source':>8} {'bytes':>11} {'seconds':>9} {'MB/s':>9} {'first ms':>9} {'frame ms':>13} "
+              f"{'peak MB':>8} {'ok':>4}", file=report)
+        try:
+            for source, size, piece_size, interval in rows:
+                client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client_socket.bind(("127.0.0.1", 0))
+                client_address = client_socket.getsockname()
+                digest = hashlib.blake2b()
+                produced = []
+                check = StreamCheck([min(end, size) for end in range(piece_size, size + piece_size, piece_size)])
+                checks.append(check)
+                pieces = stream_source(size, piece_size, block, digest, produced, interval)
+
+                tracemalloc.start()
+                start_time = time.perf_counter()
+                try:
+                    if source == "file":
+                        succeeded = udp_client.send_image(filename, client_socket, "127.0.0.1", port,
+                                                          chunk_size=args.chunk_size)
+                    else:
+                        succeeded = udp_client.send_stream(pieces, client_socket, "127.0.0.1", port,
+                                                           chunk_size=args.chunk_size)
+                    elapsed = time.perf_counter() - start_time
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+                    client_socket.close()
+                if emulator is not None:
+                    client_address = emulator.upstream_address(client_address)
+
+                if source == "file":
+                    received = received_filename(output_dir, client_address)
+                    verified = succeeded and os.path.exists(received) and \
+                        filecmp.cmp(filename, received, shallow=False)
+                    if os.path.exists(received):
+                        os.remove(received)
+                    first = latency = "-"
+                else:
+                    verified = succeeded and check.ended.wait(1) and check.size == size and \
+                        check.digest.digest() == digest.digest()
+                    first = f"{(check.first - start_time) * 1000:.1f}" if check.first is not None else "-"
+                    latency = [(arrival - made) * 1000 for arrival, made in zip(check.arrivals, produced)]
+                    latency = f"{sum(latency) / len(latency):.1f}/{max(latency):.1f}" if latency else "-"
+                print(f"{source:>8} {size:>11} {elapsed:>9.3f} {size / elapsed / 1000000:>9.2f} {first:>9} "
+                      f"{latency if source == 'live' else '-':>13} {peak / 1000000:>8.2f} "
+                      f"{'yes' if verified else 'no':>4}", file=report, flush=True)
+        finally:
+            if emulator is not None:
+                emulator.stop()
+            stop_event.set()
+            thread.join()
+
+
+# The main() method parses the command line and runs the chosen benchmark
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback benchmarks for the UDP client and server")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    clients = benchmarks.add_parser("clients", help="aggregate server throughput as the number of clients grows")
+    clients.add_argument("--size", type=int, default=1000000, help="bytes sent by each client")
+    clients.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                         help="client counts to measure")
+    clients.set_defaults(run=bench_clients)
+
+    codec = benchmarks.add_parser("codec", help="packets/sec and allocations of the per-packet code")
+    codec.add_argument("--size", type=int, default=1000000, help="size of the file the packets are read from")
+    codec.add_argument("--packets", type=int, default=200000, help="packets to time for each variant")
+    codec.set_defaults(run=bench_codec)
+
+    network = benchmarks.add_parser("network", help="transfers through an emulated network of every condition")
+    network.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 10000000],
+                         help="file sizes to send, in bytes")
+    network.add_argument("--conditions", nargs="*", choices=sorted(CONDITIONS), default=list(CONDITIONS),
+                         help="network conditions to send through (default: all of them)")
+    network.add_argument("--delay", type=float, default=0, help="custom condition: one way delay in milliseconds")
+    network.add_argument("--jitter", type=float, default=0, help="custom condition: delay variation in milliseconds")
+    network.add_argument("--loss", type=float, default=0, help="custom condition: datagrams lost, in percent")
+    network.add_argument("--duplicate", type=float, default=0,
+                         help="custom condition: datagrams duplicated, in percent")
+    network.add_argument("--reorder", type=float, default=0, help="custom condition: datagrams reordered, in percent")
+    network.add_argument("--runs", type=int, default=1, help="transfers of every size under every condition")
+    network.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                         help="largest chunk size the client tries")
+    network.add_argument("--mode", choices=["thread", "process"], default="thread",
+                         help="run the server and client in the benchmark process or as their own processes")
+    network.add_argument("--seed", type=int, help="random seed for the emulator, to repeat a run exactly")
+    network.add_argument("--json", help="file to save the results of every transfer to")
+    network.set_defaults(run=bench_network)
+
+    stripes = benchmarks.add_parser("stripes", help="goodput of one file sent as more and more stripes at once")
+    stripes.add_argument("--size", type=int, default=100000000, help="size of the file sent, in bytes")
+    stripes.add_argument("--stripes", type=int, nargs="+", default=[1, 2, 4, 8], help="stripe counts to measure")
+    stripes.add_argument("--runs", type=int, default=1, help="transfers for every stripe count")
+    stripes.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                         help="largest chunk size the clients try")
+    stripes.set_defaults(run=bench_stripes)
+
+    delta = benchmarks.add_parser("delta", help="a changed file sent in full and as a delta")
+    delta.add_argument("--size", type=int, default=20000000, help="size of the file sent, in bytes")
+    delta.add_argument("--edits", type=int, nargs="+", default=[0, 1, 10, 100],
+                       help="places changed in the file between the transfers")
+    delta.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                       help="largest chunk size the client tries")
+    delta.add_argument("--delay", type=float, default=0,
+                       help="one way delay of an emulated network in milliseconds (default: no emulator)")
+    delta.add_argument("--seed", type=int, default=0, help="random seed for the places changed")
+    delta.set_defaults(run=bench_delta)
+
+    fec = benchmarks.add_parser("fec", help="losses repaired with forward error correction against resent")
+    fec.add_argument("--size", type=int, default=10000000, help="size of the file sent, in bytes")
+    fec.add_argument("--fec", type=fec_setting, nargs="+", default=[None, (16, 1), (16, 2), (8, 2)],
+                     help="forward error correction settings to measure, none or K:M")
+    fec.add_argument("--delay", type=float, default=5, help="one way delay of the emulated network in milliseconds")
+    fec.add_argument("--loss", type=float, default=2, help="datagrams lost by the emulated network, in percent")
+    fec.add_argument("--runs", type=int, default=1, help="transfers for every setting")
+    fec.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                     help="largest chunk size the client tries")
+    fec.add_argument("--seed", type=int, help="random seed for the emulator, to repeat a run exactly")
+    fec.set_defaults(run=bench_fec)
+
+    compress = benchmarks.add_parser("compress", help="bytes saved by compression against the CPU time it costs")
+    compress.add_argument("--size", type=int, default=20000000, help="size of every file sent, in bytes")
+    compress.add_argument("--levels", type=int, nargs="+", choices=range(1, 10), default=[1, 6, 9],
+                          help="zlib levels to measure")
+    compress.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                          help="largest chunk size the client tries")
+    compress.add_argument("--delay", type=float, default=0,
+                          help="one way delay of an emulated network in milliseconds (default: no emulator)")
+    compress.add_argument("--seed", type=int, default=0, help="random seed for the log lines")
+    compress.set_defaults(run=bench_compress)
+
+    batch = benchmarks.add_parser("batch", help="many small files one transfer at a time against one batch")
+    batch.add_argument("--files", type=int, default=1000, help="number of files sent")
+    batch.add_argument("--file-size", type=int, default=10000, help="size of every file, in bytes")
+    batch.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                       help="largest chunk size the client tries")
+    batch.add_argument("--delay", type=float, default=1,
+                       help="one way delay of an emulated network in milliseconds, 0 for no emulator")
+    batch.set_defaults(run=bench_batch)
+
+    stream = benchmarks.add_parser("stream", help="a stream from a generator against a file, and a live source")
+    stream.add_argument("--size", type=int, default=100000000, help="bytes sent as a file and as a stream")
+    stream.add_argument("--piece-size", type=int, default=65536, help="size of the pieces the generator yields")
+    stream.add_argument("--frames", type=int, default=100, help="frames the live source produces")
+    stream.add_argument("--frame-size", type=int, default=20000, help="size of every frame, in bytes")
+    stream.add_argument("--interval", type=float, default=10, help="milliseconds between two frames")
+    stream.add_argument("--chunk-size", type=int, default=udp_packet.MAX_CHUNK_SIZE,
+                        help="largest chunk size the client tries")
+    stream.add_argument("--delay", type=float, default=0,
+                        help="one way delay of an emulated network in milliseconds (default: no emulator)")
+    stream.set_defaults(run=bench_stream)
+
+    args = parser.parse_args(argv)
+
+    # The client and server print a summary of every transfer, that output is thrown away and only the report is
+    # printed
+    report = sys.stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        args.run(args, report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,6 +14,38 @@ environment in which the Python program is running.
 
 `os`: https://docs.python.org/3/library/os.html
 
+`argparse` - The `argparse` module makes it easy to write user-friendly command-line interfaces. It is used to take the
+server address and the file to send from the command line, so the client can be run from a script.
+
+`argparse`: https://docs.python.org/3/library/argparse.html
+
+`concurrent.futures` - The `concurrent.futures` module provides a high-level interface for asynchronously executing
+callables in threads or processes. A striped transfer sends every stripe from a worker process of a
+`ProcessPoolExecutor`, so the stripes don't share one interpreter lock.
+
+`concurrent.futures`: https://docs.python.org/3/library/concurrent.futures.html
+
+`contextlib` - The `contextlib` module provides utilities for common tasks involving the `with` statement. It is used
+to silence the output of the stripes, only the result of every stripe is printed, and `open_source()` is a
+`contextlib.contextmanager` that unmaps the file once the transfer is done with it.
+
+`contextlib`: https://docs.python.org/3/library/contextlib.html
+
+`sys` - The `sys` module provides access to variables and functions of the interpreter. `sys.exit()` hands the result
+of the transfer back to the shell as the exit status.
+
+`sys`: https://docs.python.org/3/library/sys.html
+
+`mmap` - The `mmap` module provides memory-mapped file objects, which behave like both bytearrays and file objects.
+It is used to look at the whole image file as one buffer, so any chunk of it can be sent without reading it first.
+
+`mmap`: https://docs.python.org/3/library/mmap.html
+
+`heapq` - The `heapq` module provides an implementation of the heap queue algorithm. It is used to always know which
+in-flight packet is the next one to time out without searching the whole window.
+
+`heapq`: https://docs.python.org/3/library/heapq.html
+
 `select` - The `select` module in Python provides a way to monitor and handle I/O operations on multiple file
 descriptors. This includes sockets, files, pipes, and any other file-like objects that can be monitors for I/O events.
 It provides a mechanism for waiting until one or more of these file descriptors are ready for reading, writing, or
@@ -28,12 +60,33 @@ on a network. The `socket` module is used to create network connection,s send a
 
 `socket`: https://docs.python.org/3/library/socket.html
 
-`struct` - The `struct` module provides functions for working with structured binary data, such as data in a binary file
-or data sent over a network. It provides functions for packing and unpacking data into and from byte strings, and for
-working with different byte orders and data types. The `struct` module is used to convert data between Python objects
-and binary data.
+`zlib` - The `zlib` module provides compression functions and checksums. `zlib.crc32()` turns the path, size and
+modification time of the file into the transfer id a resumed transfer is found by, and the path alone into the one
+every version of the file is sent as a delta with.
+
+`zlib`: https://docs.python.org/3/library/zlib.html
+
+`udp_batch` - The `udp_batch` module is the manifest of a batch of many files sent in one transfer, and reads the
+chunks of the batch from the files they are in.
+
+`udp_compress` - The `udp_compress` module compresses the chunks that are worth compressing, and stops trying for
+data that doesn't compress.
+
+`udp_delta` - The `udp_delta` module works out which parts of the file the server already has in its copy of it, so a
+delta only sends what changed, and keeps the signatures of files that didn't change in a `HashCache`.
+
+`udp_fec` - The `udp_fec` module is the forward error correction code, it encodes the parity packets sent along with
+every group of chunks so the server can rebuild lost chunks without them being sent again.
 
-`struct`: https://docs.python.org/3/library/struct.html
+`udp_metrics` - The `udp_metrics` module counts what happens during a transfer (packets, bytes, retransmissions,
+duplicates, round trip times) instead of printing every packet, and writes a sampled per-packet trace when asked to.
+
+`udp_packet` - The `udp_packet` module is the packet format shared by the client and the server. It uses precompiled
+`struct.Struct` objects to pack and unpack the packet header in place, so packets are built with `readinto()` into
+buffers that are reused for every packet instead of creating new bytes objects.
+
+`udp_stream` - The `udp_stream` module reads the source of a stream of unknown length in a thread of its own and keeps
+only the chunks of it that are in flight.
 
 `time` - The `time` module provides functions for working with time, such as getting the current time, converting
 between time formats, and sleeping for a given amount of time. The `time` module is used to performing timing
@@ -43,193 +96,1177 @@ operations, measure program performance, and more.
 
 --- Behavior --- Top to bottom explanation
 
-1.  The code imports necessary libraries `os`, `socket`, `struct`, and `time`.
-2.  It sets the buffer size to 1032 bytes.
-3.  The `send_image()` function is defined that takes a filename, a socket, server IP and server port as parameters.
-4.  Inside the function, the size of the image is obtained using `os.path.getsize()` function and sent to the server using
-    `sock.sendto()`.
-5.  The image file is opened and read 1024 bytes at a time in a loop.
-6.  A packet is constructed with sequence number, image data, file size, and timeout using `struct.pack()`.
-7.  A while loop is started to send the packet to the server, and wait for the acknowledgement. The loop runs up to 5
-    times if the server doesn't send the acknowledgement within the timeout of TIMEOUT seconds.
-8.  The start time for the packet is recorded, and the packet is sent to the server using `sock.sendto()`.
-9.  A message is printed indicating the packet has been sent.
-10. The client waits for an acknowledgement from the server using `sock.recvfrom()` with a TIMEOUT-second timeout.
-11. If the client receives an acknowledgement, the end time is recorded, and the round trip time for the packet is
-    calculated.
-12. The sequence number of the acknowledgement is extracted using `struct.unpack()`, and a message is printed indicating
-    the packet has been received by the server.
-13. The start time of the acknowledgement is recorded, and the acknowledgement time is calculated.
-14. The round trip time for the packet is calculated and printed.
-15. The total round trip time is added to the total time for all packets, and the retry loop is exited.
-16. If the maximum number of retries is reached, a message is printed and the function returns.
-17. The sequence number is incremented, and the next 1024 bytes of data are read from the image file.
-18. Once all data has been sent, the total time and average round trip time are calculated and printed.
-19. The socket is closed, and a message is printed indicating the socket has been closed.
-20. The `main()` function is defined as to resemble a C or C++ program.
-21. The user is prompted to enter the server IP address and port number.
-22. The server IP and port number are set, and a message is printed indicating the connection has been established.
-23. A UDP socket is created and set to non-blocking mode.
-24. The `send_image()` function is called with the appropriate parameters.
-25. The socket is closed.
-26. The main function is called if the code is executed directly.
+1.  The code imports necessary libraries `argparse`, `concurrent.futures`, `contextlib`, `heapq`, `mmap`, `os`,
+    `select`, `socket`, `sys`, `time`, `zlib`, `udp_batch`, `udp_compress`, `udp_delta`, `udp_fec`, `udp_metrics`,
+    `udp_packet` and `udp_stream`.
+2.  It sets the buffer size big enough for any packet, the initial timeout, the bounds of the retransmission timeout,
+    the window size to 32 packets, how long the client goes on without hearing from the server (10 seconds), how many
+    times `--resume` connects again, how many times a HELLO of each size is tried and the bounds and pacing gains of
+    the congestion window and what the stripes of a striped transfer are aligned to.
+3.  The `RttEstimator` class keeps the smoothed round trip time and its deviation and computes the retransmission
+    timeout from them, doubling it whenever packets time out.
+4.  The `AimdController` class limits how many packets are in flight with a congestion window that grows while packets
+    are ACKed and is cut in half when they time out, and spreads the packets out over the round trip time with a token
+    bucket pacer. Its `rate` is the current sending rate in bytes per second. The `DelayController` class does the same
+    but grows or shrinks the window by how much the round trip time has grown over the lowest one seen.
+5.  The `send_packet()` function sends one datagram, waiting with `select.select()` if the send buffer is full. The
+    datagram can be given as several buffers, which are gathered into one datagram with `sendmsg()`.
+6.  The `send_chunk()` function sends one chunk of the file by its sequence number: the header is packed into a small
+    buffer and sent together with the chunk straight out of the memory-mapped file by `send_gathered()`, or where
+    `sendmsg()` isn't available (Windows) the chunk is copied behind the header first. A compressed chunk is sent the
+    same way in place of the chunk, with `udp_packet.CHUNK_COMPRESSED` in the header. For a delta it sends one
+    instruction instead with `send_instruction()`: a LITERAL with the bytes straight out of the file, or a COPY telling
+    the server where in its own copy of the file the bytes are. `send_parity()` sends the forward error correction
+    parity packets of one group of chunks, encoded with `udp_fec.FecCode` from the mapped file.
+7.  The `handshake()` function sends the size of the image to the server in a HELLO that is padded to the size of a full
+    data packet of the chunk size it asks for. If no HELLO_ACK comes back, the HELLO is tried again and then with the
+    next smaller chunk size, down to the original 1024 bytes. The chunk size the server accepted is returned, together
+    with how many bytes of the file the server already has and how many blocks the signature of its copy of the file
+    has, if the client asked for a delta.
+8.  The `request_pieces()` function fetches what the server keeps about the transfer, a few packets at a time: the
+    bitmap of the chunks it already has when a transfer is resumed (`request_state()`), or the signature of its copy of
+    the file for a delta. The `resume_id()` function gives a file the transfer id that lets it be resumed, the same for
+    as long as the file doesn't change, and `delta_id()` the one for sending every version of the file as a delta.
+    The `send_manifest()` function sends the manifest of a batch the same way, a few pieces at a time, until the server
+    has answered every one of them.
+9.  The `send_image()` function is defined that takes a filename, a socket, server IP, server port and optionally a
+    window size, an `RttEstimator`, the largest chunk size to try, a rate controller, a `udp_metrics.Metrics`, the
+    stripe to send, whether to resume or send a delta, a `udp_delta.HashCache`, the forward error correction to use,
+    a `udp_compress.Compressor` and a `udp_batch.Batch` or `udp_stream.Stream` to send instead of the file as
+    parameters.
+10. Nothing is printed for every packet: the packets sent and resent, the ACKs received and the round trip times are
+    counted in the `Metrics`, which can be read while the transfer runs, and every packet is only written out if the
+    `Metrics` has a `udp_metrics.Tracer`.
+11. Inside the function, the size of the image is obtained using `os.path.getsize()` function and the chunk size is
+    agreed on with `handshake()`. If the server already has part of the file, the chunks it has are found out with
+    `request_state()` and skipped. If it has a copy of the file to take a delta against, its signature is fetched with
+    `request_pieces()`.
+12. One packet buffer is allocated for building packets, and a small one for receiving ACKs.
+13. The image file is opened and mapped into memory with `mmap` by `open_source()`, so any chunk can be sent (or sent
+    again) straight from the file. The files of a batch are laid out in chunks one after the other, its manifest is sent
+    with `send_manifest()` and the `Batch` reads every chunk from its own file. For a delta, `udp_delta.compute_delta()`
+    works out the instructions from the server's signature and the file's own signature from the `HashCache`, and every
+    packet from here on is one instruction instead of one chunk. A stream has no file at all: its reader thread reads
+    the source ahead into a queue of a window of pieces, the client takes them as chunks when it has room for them
+    (also waiting for them in `select.select()`) and forgets every chunk once it is ACKed. The end of the stream is
+    an empty chunk flagged `udp_packet.CHUNK_END`.
+14. As long as there is room in the window and the congestion window, and the pacer has the tokens for it, the next
+    chunk is sent with `send_chunk()` and remembered together with its send time and deadline (the current
+    retransmission timeout) as being in flight. With a `Compressor` the chunk is compressed first if the compressor
+    thinks it is worth trying, and the compressed chunk is kept until it is ACKed. With forward error correction the
+    parity packets of a group of chunks are sent with `send_parity()` right after the last chunk of the group, once.
+15. Once the window is full the client waits with `select.select()` for an ACK, but no longer than until the oldest
+    in-flight packet times out or the pacer lets the next packet go.
+16. Every ACK waiting on the socket is read, the cumulative acknowledgement is extracted using
+    `udp_packet.unpack_header()` together with the SACK bitmap behind it, and every packet the ACK covers
+    (`udp_packet.acknowledges()`) is no longer in flight. If the newest of those packets was only sent once, its round
+    trip time is calculated, added to the round trip time histogram and fed to the `RttEstimator`. The rate controller
+    is told how many packets the ACK covered so it can grow the window.
+17. Before the window is filled again it slides past every packet that has been ACKed, and every chunk the server
+    already had, so that new packets can be read from the file.
+18. Every packet whose deadline has passed is sent again from the file with a backed off timeout, and the rate
+    controller cuts the congestion window. If no ACK has arrived for `GIVE_UP_AFTER` seconds when a packet times out, a
+    message is printed and the function returns.
+19. Once all data has been sent and ACKed, the file is unmapped and the summary of the `Metrics` (time, goodput,
+    counters and round trip time percentiles) is printed together with the final round trip time estimate and sending
+    rate.
+20. The socket is closed, and a message is printed indicating the socket has been closed.
+21. The `stripe_ranges()` function splits the file into byte ranges, and the `send_stripe()` function sends one of them
+    with `send_image()` from a socket of its own, with the transfer id, offset and length of the stripe in its HELLO.
+22. The `send_striped()` function sends all of the stripes at the same time from a
+    `concurrent.futures.ProcessPoolExecutor`, to the server's ports in turn, and finally checks that every stripe was
+    ACKed in full and that together they cover the whole file. The `send_batch()` function sends many files, or the
+    files in directories, as one batch with `send_image()`, and `send_stream()` sends a file-like object, socket or
+    iterable of bytes as a stream.
+23. The `main()` function is defined as to resemble a C or C++ program.
+24. The server IP address, port number and file to send are read from the command line with `argparse`, the user is
+    prompted to enter the IP address and port number if they aren't given. `--trace` turns on the per-packet trace. With
+    `--stripes` the file is sent with `send_striped()` instead, to `--ports` ports from the server port up. With
+    `--resume` a failed transfer is tried again, up to `RESUME_ATTEMPTS` times, and every attempt only sends what is
+    still missing. With `--delta` only what changed since the last version sent is sent, and `--hash-cache` keeps the
+    signatures of the files in a file across runs. `--fec K:M` sends M parity packets with every K chunks, and
+    `--compress` compresses the chunks at the zlib level given. Several files or a directory are sent with
+    `send_batch()`, and `-` sends standard input with `send_stream()`.
+25. The server IP and port number are set, and a message is printed indicating the connection has been established.
+26. A UDP socket is created and set to non-blocking mode.
+27. The `send_image()` function is called with the appropriate parameters.
+28. The socket is closed and the exit status tells whether the file got across.
+29. The main function is called if the code is executed directly.
 
 """
 
+import argparse
+import concurrent.futures
+import contextlib
+import heapq
+import mmap
 import os
 import select
 import socket
-import struct
+import sys
 import time
+import zlib
+
+import udp_batch
+import udp_compress
+import udp_delta
+import udp_fec
+import udp_metrics
+import udp_packet
+import udp_stream
 
 
-# Set up the buffer (aka the packet) 1024 bytes of image data and 12 bytes of sequence numbers and filesize information
-BUFFER_SIZE = 1032
+# Set up the buffer big enough for any packet, the most image data per packet (the chunk size) is agreed on with the
+# server when the transfer starts and can go up to udp_packet.MAX_CHUNK_SIZE
+BUFFER_SIZE = udp_packet.BUFFER_SIZE
 TIMEOUT = 1
 
+# Whether the header and the data can be handed to the socket as two separate buffers for one datagram
+SCATTER_GATHER = hasattr(socket.socket, "sendmsg")
 
-# The send_image() method is the driver of the script/program, as this does all of the work on the image file
-def send_image(filename, sock, SERVER_IP, SERVER_PORT):
-    # Get the size of the image (this is sent every packet to track file size vs. sent size)
-    filesize = os.path.getsize(filename)
+# How many times a HELLO of one size is sent before trying the next smaller chunk size, a single lost datagram
+# shouldn't be enough to give up on a size
+PROBE_ATTEMPTS = 2
+
+# Bounds for the retransmission timeout once it is computed from the measured round trip times, in seconds
+# The floor keeps a few scheduler hiccups on a sub-millisecond LAN from being mistaken for lost packets, the
+# ceiling keeps the exponential backoff from growing without limit
+MIN_RTO = 0.005
+MAX_RTO = 60
+
+# The number of packets allowed to be in flight (sent but not yet acknowledged) at the same time
+# A window of 1 is the original idle-RQ (stop-and-wait) behavior, anything bigger is selective repeat
+WINDOW_SIZE = 32
+
+# How long the client keeps trying without hearing back from the server before it gives up, in seconds. It used to be
+# 5 tries at the fixed 1 second timeout, but the retransmission timeout only decides when a packet is sent again: on a
+# LAN it is down at MIN_RTO, and 5 tries of that would give up on a stall of 155 ms
+GIVE_UP_AFTER = 10
+
+# Congestion window bounds in packets, the window starts at 10 packets like TCP does today (RFC 6928) and is never cut
+# below 2 so there is always something in flight to get an ACK for
+INITIAL_WINDOW = 10
+MIN_WINDOW = 2
+
+# The pacer sends at the congestion window per smoothed round trip time times these gains, twice that while the window
+# is still growing fast (slow start) and a little over it afterwards so the window can still fill up, the same gains
+# the Linux TCP pacer uses. PACING_BURST is how many packets may go out back to back when the pacer has been idle
+SLOW_START_PACING_GAIN = 2
+PACING_GAIN = 1.2
+PACING_BURST = 4
+
+# How many times the client connects to the server again with --resume when a transfer fails, every attempt only
+# sends what the attempts before it didn't get across
+RESUME_ATTEMPTS = 3
+
+# Stripes of a striped transfer start at multiples of this many bytes (1 MB), so a small file isn't cut into stripes
+# that are over before the congestion window has opened up
+STRIPE_ALIGNMENT = 1024 * 1024
+
+
+# The RttEstimator class turns the measured round trip times into the retransmission timeout (RTO) the same way TCP
+# does (Jacobson/Karels, RFC 6298): a smoothed round trip time (srtt) and its mean deviation (rttvar) are kept as
+# moving averages and the RTO is srtt + 4 * rttvar, so it sits just above the round trip times the link really has
+# All of the values are in seconds and can be read by the caller at any point, during or after a transfer
+class RttEstimator:
+    # Gains from RFC 6298, 1/8 for the smoothed round trip time and 1/4 for its deviation
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial_rto=TIMEOUT, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        # Until the first sample arrives there is nothing to smooth, so the RTO starts at TIMEOUT like before
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+        # How many times the RTO has been doubled since the last good sample, and when it was last doubled
+        self.backoff = 0
+        self.backoff_time = 0
+
+    # The sample() method is called with the round trip time of a packet that was only sent once
+    # Karn's rule: a packet that was resent can't tell which copy the ACK belongs to, so it must never be sampled
+    def sample(self, rtt):
+        if self.srtt is None:
+            # The first measurement: srtt = R, rttvar = R / 2
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            # rttvar has to be updated first since it uses the old srtt
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        # A good sample also ends any backoff
+        self.backoff = 0
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    # The timed_out() method doubles the RTO (exponential backoff) when a packet sent at send_time (perf_counter_ns)
+    # times out, the doubled RTO is kept until a packet gets through on its first try and gives a fresh sample
+    # Only packets sent after the last doubling count, they are the ones that already waited for the longer RTO, so
+    # a whole window timing out together is one loss event and not window_size of them
+    def timed_out(self, send_time):
+        if send_time < self.backoff_time:
+            return
+        self.backoff += 1
+        self.backoff_time = time.perf_counter_ns()
+        self.rto = min(self.rto * 2, self.max_rto)
+
+
+# The AimdController class decides how fast send_image() sends, so it doesn't overrun the buffers of the switches on the
+# way and of the server's socket and lose whole bursts of packets. Two things limit the sender:
+# - the congestion window (cwnd), how many packets may be in flight at once, which grows additively while the packets
+#   get through and is cut in half (multiplicative decrease) when they time out, like TCP Reno (RFC 5681). It starts in
+#   slow start, growing by one packet for every packet ACKed, until the first loss sets the slow start threshold
+# - a token bucket pacer that spreads those packets over the round trip time instead of sending them back to back,
+#   tokens (bytes) come in at rate bytes per second and every packet sent takes its size out of the bucket
+# send_image() calls start() once the chunk size is known, send_delay()/on_send() for every packet and on_ack() and
+# on_timeout() with the ACK and timeout events it sees. Any object with these methods can be passed to send_image() as
+# its rate_controller, the DelayController below is one
+# rate (bytes per second, None until the first round trip time is known) and cwnd can be read while the transfer runs
+class AimdController:
+    def __init__(self, initial_window=INITIAL_WINDOW, min_window=MIN_WINDOW, burst=PACING_BURST):
+        self.cwnd = initial_window
+        self.min_window = min_window
+        self.max_window = None
+        self.ssthresh = None
+        self.burst = burst
+
+        # The pacing rate in bytes per second, the sender isn't paced before the first round trip time is known
+        self.rate = None
+
+        # The token bucket, in bytes, and when it was last filled up (perf_counter_ns)
+        self.packet_size = 0
+        self.tokens = 0
+        self.filled_time = 0
+
+        # When the window was last cut, the timeouts of packets sent before that are part of the same loss event
+        self.reduced_time = 0
+
+    # The start() method is called once the size of a full packet is known, max_window is the most packets the
+    # sender's own window allows in flight and the congestion window never grows past it
+    def start(self, packet_size, max_window):
+        self.packet_size = packet_size
+        self.max_window = max_window
+        self.cwnd = min(self.cwnd, max_window)
+        self.tokens = self.burst * packet_size
+        self.filled_time = time.perf_counter_ns()
+
+    # The window() method is how many packets may be in flight right now
+    def window(self):
+        return max(int(self.cwnd), 1)
+
+    # The send_delay() method returns 0 if a full packet may be sent at now (perf_counter_ns), otherwise how many
+    # seconds until the bucket has the tokens for one
+    def send_delay(self, now):
+        if self.rate is None:
+            return 0
+        refill = self.rate * (now - self.filled_time) / 1000000000
+        self.tokens = min(self.tokens + refill, self.burst * self.packet_size)
+        self.filled_time = now
+        if self.tokens >= self.packet_size:
+            return 0
+        return (self.packet_size - self.tokens) / self.rate
+
+    # The on_send() method takes the size of a packet that was just sent out of the bucket
+    def on_send(self, size):
+        if self.rate is not None:
+            self.tokens -= size
+
+    # The on_ack() method is called for every ACK with how many packets it took out of flight, the round trip time
+    # measured from it (None if there was no good sample) and the smoothed round trip time, both in seconds
+    def on_ack(self, acked, rtt, srtt):
+        if self.ssthresh is None or self.cwnd < self.ssthresh:
+            # Slow start, the window doubles every round trip
+            self.cwnd += acked
+        else:
+            # Congestion avoidance, the window grows by one packet every round trip
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+        self.update_rate(srtt)
+
+    # The on_timeout() method is called when the packet sent at send_time (perf_counter_ns) timed out, which is taken
+    # as a sign of congestion. Like the RTO backoff, only one cut is made per loss event
+    def on_timeout(self, send_time, srtt):
+        if send_time < self.reduced_time:
+            return
+        self.reduced_time = time.perf_counter_ns()
+        self.ssthresh = max(self.cwnd / 2, self.min_window)
+        self.cwnd = self.ssthresh
+        self.update_rate(srtt)
+
+    # The pacing_gain() method is how much faster than one congestion window per round trip the pacer sends
+    def pacing_gain(self):
+        if self.ssthresh is None or self.cwnd < self.ssthresh:
+            return SLOW_START_PACING_GAIN
+        return PACING_GAIN
+
+    # The update_rate() method sets the pacing rate to the congestion window per round trip time
+    def update_rate(self, srtt):
+        if srtt:
+            self.rate = self.pacing_gain() * self.cwnd * self.packet_size / srtt
+
+
+# The DelayController class is a delay-based version of AimdController along the lines of TCP Vegas: it doesn't wait
+# for packets to be lost to slow down, it watches the round trip time grow as the queues on the way fill up
+# The lowest round trip time seen is taken as the time with empty queues, from it the controller estimates how many
+# of its packets are sitting in queues (cwnd * (1 - base_rtt / rtt)) and grows the window by one packet per round trip
+# while that is below alpha packets and shrinks it by one while it is above beta. Timeouts still cut the window in half
+class DelayController(AimdController):
+    ALPHA = 2
+    BETA = 4
+
+    def __init__(self, initial_window=INITIAL_WINDOW, min_window=MIN_WINDOW, burst=PACING_BURST):
+        super().__init__(initial_window, min_window, burst)
+        self.base_rtt = None
+
+    def on_ack(self, acked, rtt, srtt):
+        if rtt is not None:
+            self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+            queued = self.cwnd * (1 - self.base_rtt / rtt)
+            if queued < self.ALPHA:
+                self.cwnd += acked / self.cwnd
+            elif queued > self.BETA:
+                self.cwnd -= acked / self.cwnd
+            self.cwnd = min(max(self.cwnd, self.min_window), self.max_window)
+        self.update_rate(srtt)
+
+    # The window only grows by a packet per round trip, so the pacer never needs more than a little headroom
+    def pacing_gain(self):
+        return PACING_GAIN
+
+
+# The send_packet() method hands one datagram to the socket, the socket is non-blocking so if the send buffer is
+# full the sendto() raises instead of waiting, in which case select is used to wait until it can be written again
+# packet is either one buffer or a tuple of buffers that are sent one after the other in the same datagram
+def send_packet(sock, packet, address):
+    while True:
+        try:
+            if isinstance(packet, tuple):
+                sock.sendmsg(packet, (), 0, address)
+            else:
+                sock.sendto(packet, address)
+            return
+        except BlockingIOError:
+            # Otherwise it crashes with another WinError -> [WinError 10035]
+            select.select([], [sock], [], MAX_RTO)
+
+
+# The send_gathered() method sends the first size bytes of packet_buffer followed by data as one datagram. Where the
+# socket has sendmsg(), the two are gathered into one datagram by the operating system, so the data goes from the file
+# to the socket without being copied. Windows doesn't have sendmsg(), so there the data is copied behind the rest of the
+# packet in packet_buffer first
+def send_gathered(sock, address, packet_buffer, size, data):
+    if SCATTER_GATHER:
+        send_packet(sock, (memoryview(packet_buffer)[:size], data), address)
+    else:
+        packet_buffer[size:size + len(data)] = data
+        send_packet(sock, memoryview(packet_buffer)[:size + len(data)], address)
+
+
+# The send_chunk() method sends chunk seq_num of the file (source is a memoryview of the whole file, the
+# udp_batch.Batch of a batch or the udp_stream.Stream of a stream) and returns how many bytes of data were in it, the
+# header is packed in packet_buffer and the chunk sent straight out of the file
+# With instructions (a delta from udp_delta.compute_delta()) the packet is instruction seq_num instead, see
+# send_instruction(). With compressed (the chunk from udp_compress.Compressor.compress()) that is sent instead of the
+# chunk, flagged udp_packet.CHUNK_COMPRESSED
+# Only the end of a stream (see udp_stream.Stream) is ever an empty chunk, it is flagged udp_packet.CHUNK_END
+def send_chunk(sock, address, packet_buffer, source, seq_num, chunk_size, instructions=None, compressed=None):
+    if instructions is not None:
+        return send_instruction(sock, address, packet_buffer, source, seq_num, instructions[seq_num - 1])
+    if compressed is not None:
+        udp_packet.pack_data(packet_buffer, seq_num, len(compressed), udp_packet.CHUNK_COMPRESSED)
+        send_gathered(sock, address, packet_buffer, udp_packet.HEADER.size, compressed)
+        return len(compressed)
+    offset = (seq_num - 1) * chunk_size
+    data = source[offset:offset + chunk_size]
+    udp_packet.pack_data(packet_buffer, seq_num, len(data), 0 if len(data) else udp_packet.CHUNK_END)
+    send_gathered(sock, address, packet_buffer, udp_packet.HEADER.size, data)
+    return len(data)
+
+
+# The send_instruction() method sends instruction seq_num of a delta, (offset, length, basis offset), and returns how
+# many bytes were in it behind the header: a COPY when the server can copy the bytes from its own copy of the file,
+# otherwise a LITERAL with the bytes sent straight out of the file like a chunk
+def send_instruction(sock, address, packet_buffer, source, seq_num, instruction):
+    offset, length, basis_offset = instruction
+    if basis_offset is not None:
+        size = udp_packet.pack_copy(packet_buffer, seq_num, offset, basis_offset, length)
+        send_packet(sock, memoryview(packet_buffer)[:size], address)
+        return udp_packet.COPY.size
+    size = udp_packet.pack_literal(packet_buffer, seq_num, offset, length)
+    send_gathered(sock, address, packet_buffer, size, source[offset:offset + length])
+    return udp_packet.LITERAL.size + length
+
+
+# The send_parity() method sends the parity packets of FEC group group of the chunks in source, encoded with fec (a
+# udp_fec.FecCode), and returns how many bytes of parity went out. The parity is only ever sent once
+def send_parity(sock, address, packet_buffer, source, fec, group, chunk_size):
+    first = group * fec.group_size * chunk_size
+    end = min(first + fec.group_size * chunk_size, len(source))
+    chunks = [source[offset:offset + chunk_size] for offset in range(first, end, chunk_size)]
+    for number, parity in enumerate(fec.encode(chunks, chunk_size)):
+        size = udp_packet.pack_parity(packet_buffer, group * fec.parity_count + number, chunk_size)
+        send_gathered(sock, address, packet_buffer, size, parity)
+    return fec.parity_count * chunk_size
+
+
+# The handshake() method agrees on the chunk size with the server and returns it together with how many bytes the
+# server already has from an earlier attempt at the same transfer and how many blocks the signature of its copy of the
+# file has if it can take a delta, or None if the server never answered
+# A HELLO is exactly as big as a full data packet of the chunk size it asks for, so if the network drops datagrams of
+# that size (no jumbo frames, IP fragments filtered, ...) the HELLO is dropped as well and the next smaller size in
+# udp_packet.CHUNK_SIZES is tried. The server answers with the size it accepted, which may be smaller still
+# A stripe of a striped transfer also tells the server its transfer_id and which part of the file it carries, flags
+# are the udp_packet.FLAG_ values and fec the (group size, parity count) of the forward error correction, if any
+def handshake(sock, server_address, filesize, max_chunk_size, rtt_estimator, transfer_id=0, offset=0, length=None,
+              flags=0, fec=None):
+    chunk_sizes = [size for size in udp_packet.CHUNK_SIZES if size < max_chunk_size]
+    chunk_sizes.insert(0, max(min(max_chunk_size, udp_packet.MAX_CHUNK_SIZE), udp_packet.MIN_CHUNK_SIZE))
+
+    buffer = bytearray(BUFFER_SIZE)
+    reply_buffer = bytearray(udp_packet.ACK_BUFFER_SIZE)
+
+    for chunk_size in chunk_sizes:
+        size = udp_packet.pack_hello(buffer, filesize, chunk_size, transfer_id, offset, length, flags, fec)
+
+        # The smallest size is the last chance, it is tried until GIVE_UP_AFTER seconds have gone by without an answer
+        last = chunk_size == chunk_sizes[-1]
+        give_up = time.perf_counter_ns() + GIVE_UP_AFTER * 1000000000
+
+        # The timeout backs off while retrying the same size but starts over for every size, a HELLO that was too
+        # big says nothing about how long the next one will take
+        timeout = rtt_estimator.rto
+        attempt = 0
+        while attempt < PROBE_ATTEMPTS or last and time.perf_counter_ns() < give_up:
+            attempt += 1
+            start_time = time.perf_counter_ns()
+            try:
+                sock.sendto(memoryview(buffer)[:size], server_address)
+            except BlockingIOError:
+                select.select([], [sock], [], MAX_RTO)
+                continue
+            except OSError as e:
+                # The operating system itself won't send datagrams this big (macOS limits them to 9216 bytes
+                # by default), which is just as good as the network dropping them
+                print(f"Can't send {size} byte datagrams: {e}")
+                break
+            print(f"Sent HELLO with chunk size {chunk_size} (try {attempt})")
+
+            # Wait for the HELLO_ACK, ignoring anything else that shows up
+            deadline = start_time + int(timeout * 1000000000)
+            if last:
+                deadline = min(deadline, give_up)
+            while True:
+                wait = (deadline - time.perf_counter_ns()) / 1000000000
+                if wait <= 0 or not select.select([sock], [], [], wait)[0]:
+                    break
+                try:
+                    nbytes, address = sock.recvfrom_into(reply_buffer)
+                except (BlockingIOError, InterruptedError, ConnectionResetError):
+                    continue
+                header = udp_packet.unpack_header(reply_buffer, nbytes)
+                if header is None or header[0] != udp_packet.TYPE_HELLO_ACK:
+                    continue
+                accepted, received, basis_blocks = udp_packet.unpack_hello_ack(reply_buffer)
+                if accepted > chunk_size:
+                    # An answer to an earlier, bigger HELLO that was only delayed, not dropped
+                    continue
+
+                # The first HELLO of a size is the only one whose round trip time is certain (Karn's rule)
+                if attempt == 1:
+                    rtt_estimator.sample((time.perf_counter_ns() - start_time) / 1000000000)
+                print(f"Server accepted chunk size {accepted}")
+                return accepted, received, basis_blocks
+
+            timeout = min(timeout * 2, MAX_RTO)
+
+    return None
+
+
+# The request_pieces() method fetches size bytes the server has for the transfer, the bitmap of a resumed transfer
+# (packet_type STATE) or the signature for a delta (SIGNATURE), and returns as many of them as it got
+# They come in packets of up to chunk_size bytes each, window_size of them are asked for at once and the ones that
+# don't arrive in time are asked for again. Once no piece has arrived for GIVE_UP_AFTER seconds the missing pieces are
+# given up on, and everything after the first of them
+def request_pieces(sock, server_address, packet_type, size, chunk_size, rtt_estimator, window_size=WINDOW_SIZE):
+    offsets = range(0, size, chunk_size)
+    pieces = {}
+
+    request_buffer = bytearray(udp_packet.HEADER.size)
+    reply_buffer = bytearray(udp_packet.HEADER.size + chunk_size)
+    reply_view = memoryview(reply_buffer)
+
+    timeout = rtt_estimator.rto
+    give_up = time.perf_counter() + GIVE_UP_AFTER
+    while time.perf_counter() < give_up:
+        missing = [offset for offset in offsets if offset not in pieces]
+        if not missing:
+            break
+        for first in range(0, len(missing), window_size):
+            waiting = set(missing[first:first + window_size])
+            for offset in waiting:
+                request_size = udp_packet.pack_request(request_buffer, packet_type, offset)
+                send_packet(sock, request_buffer[:request_size], server_address)
+
+            # Wait for the pieces that were asked for, ignoring anything else that shows up
+            deadline = time.perf_counter() + timeout
+            while waiting:
+                wait = min(deadline, give_up) - time.perf_counter()
+                if wait <= 0 or not select.select([sock], [], [], wait)[0]:
+                    break
+                try:
+                    nbytes, address = sock.recvfrom_into(reply_buffer)
+                except (BlockingIOError, InterruptedError, ConnectionResetError):
+                    continue
+                header = udp_packet.unpack_header(reply_buffer, nbytes)
+                if header is not None and header[0] == packet_type and header[2] in waiting and header[1]:
+                    pieces[header[2]] = bytes(udp_packet.payload(reply_view, header[1]))
+                    waiting.discard(header[2])
+                    give_up = time.perf_counter() + GIVE_UP_AFTER
+        timeout = min(timeout * 2, MAX_RTO)
 
-    # Send the size of the image to the server (this is also contained in every packet header)
-    sock.sendto(str(filesize).encode(), (SERVER_IP, SERVER_PORT))
-    print("\nSending data...")
+    data = bytearray()
+    for offset in offsets:
+        if offset not in pieces:
+            print(f"The server stopped answering at {offset}/{size} bytes")
+            break
+        data += pieces[offset]
+    return bytes(data[:size])
 
-    # Open the image file and read 1024 bytes at a time (packet chunks vs. total image or file size)
+
+# The send_manifest() method sends the manifest of a batch (see udp_batch) to the server in MANIFEST pieces of up to
+# chunk_size bytes each and returns whether the server took every piece. Like request_pieces() window_size pieces are
+# sent at once and the ones the server didn't answer in time are sent again, until it hasn't answered any piece for
+# GIVE_UP_AFTER seconds
+def send_manifest(sock, server_address, manifest, chunk_size, rtt_estimator, window_size=WINDOW_SIZE):
+    piece_size = chunk_size - udp_packet.MANIFEST.size
+    offsets = range(0, len(manifest), piece_size)
+    answered = set()
+
+    packet_buffer = bytearray(udp_packet.HEADER.size + chunk_size)
+    reply_buffer = bytearray(udp_packet.ACK_BUFFER_SIZE)
+
+    timeout = rtt_estimator.rto
+    give_up = time.perf_counter() + GIVE_UP_AFTER
+    while time.perf_counter() < give_up:
+        missing = [offset for offset in offsets if offset not in answered]
+        if not missing:
+            break
+        for first in range(0, len(missing), window_size):
+            waiting = set(missing[first:first + window_size])
+            for offset in waiting:
+                size = udp_packet.pack_manifest_piece(packet_buffer, offset, len(manifest),
+                                                      manifest[offset:offset + piece_size])
+                send_packet(sock, memoryview(packet_buffer)[:size], server_address)
+
+            # Wait for the answers to the pieces that were sent, ignoring anything else that shows up
+            deadline = time.perf_counter() + timeout
+            while waiting:
+                wait = min(deadline, give_up) - time.perf_counter()
+                if wait <= 0 or not select.select([sock], [], [], wait)[0]:
+                    break
+                try:
+                    nbytes, address = sock.recvfrom_into(reply_buffer)
+                except (BlockingIOError, InterruptedError, ConnectionResetError):
+                    continue
+                header = udp_packet.unpack_header(reply_buffer, nbytes)
+                if header is not None and header[0] == udp_packet.TYPE_MANIFEST and header[2] in waiting:
+                    answered.add(header[2])
+                    waiting.discard(header[2])
+                    give_up = time.perf_counter() + GIVE_UP_AFTER
+        timeout = min(timeout * 2, MAX_RTO)
+    return len(answered) == len(offsets)
+
+
+# The request_state() method asks the server which of the chunk_count chunks it already has when a transfer is
+# resumed, and returns one byte per chunk, set for the chunks that don't have to be sent again. The chunks of the
+# part of the bitmap that never arrived are simply sent again
+def request_state(sock, server_address, chunk_count, chunk_size, rtt_estimator):
+    bitmap = request_pieces(sock, server_address, udp_packet.TYPE_STATE, (chunk_count + 7) // 8, chunk_size,
+                            rtt_estimator)
+    return udp_packet.unpack_bitmap(bitmap, chunk_count)
+
+
+# The resume_id() method is the transfer id for resuming filename: the same for as long as the file doesn't change, so
+# the server finds the partial file and state of the earlier attempts, and never 0 (no transfer id)
+def resume_id(filename):
+    stat = os.stat(filename)
+    return zlib.crc32(f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}".encode()) or 1
+
+
+# The delta_id() method is the transfer id for sending filename as a delta: the same for every version of the file, so
+# the server finds its copy of the last version to take the delta against, and never 0 (no transfer id)
+def delta_id(filename):
+    return zlib.crc32(os.path.abspath(filename).encode()) or 1
+
+
+# The open_source() method maps filename into memory and yields a memoryview of the length bytes at offset of it, so
+# every chunk can be sent straight from the file (and sent again just as easily) without reading it into a buffer first
+# The mapping is closed again once the with block is done with it, and nothing is looking at it anymore
+@contextlib.contextmanager
+def open_source(filename, filesize, offset, length):
     # with is a 'safer' style of doing a try loop, less error prone -- also the object is closed after
     # the 'with' block is executed
     # Behaves similarly to a C code block that starts with 'FILE *file = fopen(...)' and ends with 'fclose(...)'
     # Has automatic memory management so no C footguns or landmines
     with open(filename, "rb") as f:
-        data = f.read(1024)
-        seq_num = 1
-        total_time = 0
-        retry_count = 0
-
-        # Wait for the acknowledgement from the server with timeout of TIMEOUT
-        sock.settimeout(TIMEOUT)
-
-        # Main loop for sending the image data in 1024 byte chunks to the server
-        while data:
-            # Construct the packet with sequence number, data, and file size
-            # This if...else... is to accept the last packet of less than 1024 bytes of data without throwing
-            # a socket error -> [WinError 10040]
-            if len(data) < 1024:
-                # struct makes a C struct, using a function defined in the Python standard library and in this case
-                # it makes a struct that is big-endian (or network) using the !, I for an unsigned int, s for 1024
-                # bytes of type char[] for the data, and another unsigned int for filesize for a total of 1032 bytes
-                # !I = 4 bytes, s1024 = 1024 bytes and I = 4 bytes
-                packet = struct.pack(f'!I{len(data)}sI', seq_num, data, filesize)
-            else:
-                packet = struct.pack('!I1024sI', seq_num, data, filesize)
+        # An empty file can't be mapped, but then there is nothing to send either
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if filesize else b""
+        source_view = memoryview(source)[offset:offset + length]
+        try:
+            yield source_view
+        finally:
+            source_view.release()
+            if filesize:
+                source.close()
 
-            # The retry errors could be any value, using 5 to just show it works and shuts off so it doesn't keep
-            # running in an infinite loop
-            while retry_count < 5:
-                # Wait until the socket is ready for writing or the timeout expires
-                try:
-                    # Use select to wait for the socket to be ready for writing
-                    # and set it to be non-blocking for allow for immediate return
-                    # Otherwise it crashes with another WinError -> [WinError 10035]
-                    ready = select.select([], [sock], [sock], TIMEOUT)
-                    if not ready[1]:
-                        # Timeout expires
-                        retry_count += 1
-                        print(f"Timeout: retrying packet {seq_num} ({retry_count}/5)")
-                        continue
-                except socket.error as e:
-                    # Handle socket error
-                    print(f"Socket error: {e}")
-                    retry_count += 1
-                    continue
 
+# The send_image() method is the driver of the script/program, as this does all of the work on the image file
+# Packets are sent using selective repeat: up to window_size packets are kept in flight, the server ACKs them a few at a
+# time with one ACK saying which chunks it has and only the packets no ACK covered within the retransmission timeout
+# are sent again
+# The timeout comes from rtt_estimator, pass in an RttEstimator to follow srtt/rttvar/rto while the transfer runs
+# How many of the window_size packets are really in flight and how fast they go out is up to rate_controller, an
+# AimdController unless another one (DelayController) is passed in, its rate and cwnd can be followed the same way
+# chunk_size is the most image data per packet to try, the handshake may settle on less
+# Everything that is counted along the way ends up in metrics, a udp_metrics.Metrics that can be read while the
+# transfer runs, nothing is printed per packet (give the Metrics a udp_metrics.Tracer to see every packet)
+# With a transfer_id only the length bytes at offset of the file are sent, as one stripe of a striped transfer (see
+# send_striped()), the chunks are counted from offset
+# With resume the transfer gets the transfer id from resume_id() (unless it has one), so if it fails it can be started
+# again and only the chunks the server doesn't have yet are sent. The server tells whether it has any in the
+# handshake, a transfer with a transfer id always picks up what the server has
+# With delta the transfer gets the transfer id from delta_id() instead and, if the server still has the last version of
+# the file, only the parts of the file that changed are sent (see udp_delta), the server copies the rest from its own
+# copy. The signatures of the file are kept in hash_cache, udp_delta.default_cache unless another one is given
+# With fec, (group size, parity count), parity packets are sent along with every group of group size chunks (see
+# udp_fec), so the server can rebuild up to parity count lost chunks of the group without waiting for them to time out
+# and be sent again. It costs parity count / group size more bytes on the wire. A delta is sent without FEC
+# With a compressor (a udp_compress.Compressor) every chunk it thinks is worth it is sent compressed, the compressed
+# chunk is kept until it is ACKed so a resend doesn't compress it again. A delta is sent without compression
+# With a batch (a udp_batch.Batch, see send_batch()) the files of the batch are sent instead of filename, all of them
+# in one transfer: the manifest goes first and then the chunks of every file right behind the ones of the file in front
+# of it, as if they were one file. A batch is never a stripe, resumed or a delta
+# With a stream (a udp_stream.Stream, see send_stream()) its source is sent instead of filename, as it is read and
+# without knowing its length: every piece the source has is sent as soon as there is room for it in the window and the
+# empty chunk that ends the stream goes last. Only the chunks in flight are kept. A stream is never a stripe, resumed,
+# a delta or sent with FEC
+def send_image(filename, sock, SERVER_IP, SERVER_PORT, window_size=WINDOW_SIZE, rtt_estimator=None,
+               chunk_size=udp_packet.MAX_CHUNK_SIZE, rate_controller=None, metrics=None, transfer_id=0, offset=0,
+               length=None, resume=False, delta=False, hash_cache=None, fec=None, compressor=None, batch=None,
+               stream=None):
+    server_address = (SERVER_IP, SERVER_PORT)
+
+    if rtt_estimator is None:
+        rtt_estimator = RttEstimator()
+    if rate_controller is None:
+        rate_controller = AimdController()
+    if metrics is None:
+        metrics = udp_metrics.Metrics()
+    tracer = metrics.tracer
+    metrics.start()
+
+    # Get the size of the image, the server needs it to know when the file is complete, and the part of it to send
+    if batch is not None:
+        filesize = batch.size
+        transfer_id, offset, length, resume, delta = 0, 0, None, False, False
+    elif stream is not None:
+        filesize = 0
+        transfer_id, offset, length, resume, delta, fec = 0, 0, None, False, False, None
+    else:
+        filesize = os.path.getsize(filename)
+    if length is None:
+        length = filesize - offset
+    metrics.filesize = length
+    if (resume or delta) and not transfer_id:
+        transfer_id = delta_id(filename) if delta else resume_id(filename)
+    if hash_cache is None:
+        hash_cache = udp_delta.default_cache
+    fec_code = udp_fec.FecCode(*fec) if fec else None
+
+    # The socket is driven by select from here on, so it must never block on its own
+    sock.setblocking(False)
+
+    # Send the size of the image to the server and agree on how much of it goes in every packet
+    flags = (udp_packet.FLAG_DELTA if delta else 0) | (udp_packet.FLAG_BATCH if batch is not None else 0) | \
+        (udp_packet.FLAG_STREAM if stream is not None else 0)
+    agreed = handshake(sock, server_address, filesize, chunk_size, rtt_estimator, transfer_id, offset, length, flags,
+                       fec)
+    if agreed is None:
+        print("Connection failed: the server did not answer.")
+        metrics.finish(False)
+        sock.close()
+        return False
+    chunk_size, received, basis_blocks = agreed
+    metrics.chunk_size = chunk_size
+
+    # The server has a copy of the file to take a delta against, the signature of it is fetched here and the delta
+    # worked out once the file is mapped
+    signature = None
+    if basis_blocks:
+        signature = request_pieces(sock, server_address, udp_packet.TYPE_SIGNATURE,
+                                   basis_blocks * udp_delta.BLOCK.size, chunk_size, rtt_estimator)
+        metrics.signature_bytes = len(signature)
+        signature = signature[:len(signature) - len(signature) % udp_delta.BLOCK.size]
+
+    # The part of the file being sent is split into chunk_count chunks, chunk seq_num is the chunk_size bytes at
+    # (seq_num - 1) * chunk_size from offset, only the last one can be shorter. A stream has as many chunks as its
+    # source has produced so far, the reader thread starts reading it now that the chunk size is known
+    chunk_count = -(-length // chunk_size)
+    if stream is not None:
+        stream.start(chunk_size, window_size)
+
+    # The files of a batch are sent one after the other like one file, the server needs the manifest with their names
+    # and sizes before the first chunk to know which file every part of a chunk goes into
+    if batch is not None:
+        if not send_manifest(sock, server_address, batch.manifest, chunk_size, rtt_estimator, window_size):
+            print("Connection failed: the server did not take the manifest.")
+            metrics.finish(False)
+            sock.close()
+            return False
+        print(f"Batch: {len(batch.names)} files in {chunk_count} chunks")
+
+    # The chunks the server already has from an earlier attempt, have[seq_num - 1] is set for those, they are
+    # skipped as if they had been sent and ACKed
+    if received:
+        print(f"Resuming: the server already has {received}/{length} bytes")
+        have = request_state(sock, server_address, chunk_count, chunk_size, rtt_estimator)
+        metrics.resumed = have.count(1)
+    else:
+        have = bytearray(chunk_count)
+
+    # Packets are put together in this buffer when they can't be sent straight from the file (see send_chunk())
+    packet_buffer = bytearray(udp_packet.HEADER.size + chunk_size)
+    rate_controller.start(len(packet_buffer), window_size)
+
+    # The ACKs are received into this buffer instead of a new bytes object each, an ACK is never bigger than
+    # udp_packet.ACK_BUFFER_SIZE so there's no need for a buffer the size of a data packet
+    ack_buffer = bytearray(udp_packet.ACK_BUFFER_SIZE)
+    ack_view = memoryview(ack_buffer)
+
+    # Open the image file and map it into memory (open_source()), so every chunk can be sent straight from the file,
+    # a batch reads its chunks from the files they are in itself and a stream keeps the chunks in flight
+    source = batch if batch is not None else stream
+    with open_source(filename, filesize, offset, length) if source is None else source as source_view:
+        # A delta is sent one instruction per packet instead of one chunk per packet, the file's own signature
+        # saves hashing every block of it that is still where it was
+        instructions = None
+        if signature is not None:
+            block_size = udp_packet.delta_block_size(chunk_size)
+            instructions = udp_delta.compute_delta(source_view, signature, block_size,
+                                                   hash_cache.signature(filename, block_size, source_view))
+            chunk_count = len(instructions)
+            have = bytearray(chunk_count)
+            metrics.bytes_copied = sum(copy_length for _, copy_length, basis_offset in instructions
+                                       if basis_offset is not None)
+            print(f"Delta: {chunk_count} instructions, {metrics.bytes_copied}/{length} bytes copied from the "
+                  f"server's copy")
+            fec_code = None
+            compressor = None
+        print("\nSending data...")
+
+        # base is the oldest packet that has not been ACKed yet and next_seq_num is the next packet to be sent
+        # for the first time, everything in between is in flight
+        base = 1
+        next_seq_num = 1
+
+        # in_flight maps a sequence number to [send time, retry count, deadline] for every unacknowledged packet,
+        # the packet itself doesn't need to be kept since it can be made again from the file at any time
+        # deadlines is a heap of (deadline, seq_num) so the next packet to time out is always deadlines[0], entries
+        # for packets that were ACKed or resent in the meantime are left in the heap and skipped when popped
+        in_flight = {}
+        deadlines = []
+
+        # The compressed chunks that are in flight, chunks that are sent as they are aren't in here
+        compressed_chunks = {}
+
+        # When the server was last heard from, the transfer is given up on once that is GIVE_UP_AFTER seconds ago
+        last_heard = time.perf_counter_ns()
+
+        # Main loop for sending the image data in chunk_size byte chunks to the server
+        while True:
+            # Slide the window past every packet that has been ACKed, and every chunk the server already has
+            while received and next_seq_num <= chunk_count and have[next_seq_num - 1]:
+                next_seq_num += 1
+            while base < next_seq_num and base not in in_flight:
+                base += 1
+
+            # A stream takes as many of the chunks the reader thread has ready as fit in the window
+            if stream is not None:
+                chunk_count = stream.take(base + window_size - 1)
+                if stream.error is not None:
+                    print(f"Connection failed: reading the stream failed: {stream.error}")
+                    metrics.finish(False)
+                    sock.close()
+                    return False
+
+            # Fill the window with new packets from the file, as far as the congestion window and the pacer let
+            # it, pacing_delay is how long the pacer wants to wait before the next one
+            pacing_delay = None
+            while (next_seq_num <= chunk_count and next_seq_num < base + window_size and
+                   len(in_flight) < rate_controller.window()):
                 # Record the start time for the packet
-                # time.perf_counter_ns() queries QueryPerformanceFrequency and QueryPerformanceCounter if using Windows
+                # time.perf_counter_ns() queries QueryPerformanceFrequency and QueryPerformanceCounter if using
+                # Windows
                 start_time = time.perf_counter_ns()
+                pacing_delay = rate_controller.send_delay(start_time)
+                if pacing_delay:
+                    break
+
+                # Compress the chunk, if the compressor thinks it is worth trying and it does get smaller
+                compressed = None
+                if compressor is not None:
+                    chunk_offset = (next_seq_num - 1) * chunk_size
+                    with memoryview(source_view[chunk_offset:chunk_offset + chunk_size]) as chunk:
+                        compressed = compressor.compress(chunk)
+                        if compressed is not None:
+                            compressed_chunks[next_seq_num] = compressed
+                            metrics.compressed += 1
+                            metrics.bytes_saved += len(chunk) - len(compressed)
+
+                sent = send_chunk(sock, server_address, packet_buffer, source_view, next_seq_num, chunk_size,
+                                  instructions, compressed)
+                rate_controller.on_send(udp_packet.HEADER.size + sent)
+                metrics.packets_sent += 1
+                metrics.bytes_sent += sent
+                if tracer is not None:
+                    tracer.event("send", next_seq_num, bytes=sent)
+
+                deadline = start_time + int(rtt_estimator.rto * 1000000000)
+                in_flight[next_seq_num] = [start_time, 0, deadline]
+                heapq.heappush(deadlines, (deadline, next_seq_num))
+                seq_num = next_seq_num
+                next_seq_num += 1
+                while received and next_seq_num <= chunk_count and have[next_seq_num - 1]:
+                    next_seq_num += 1
+
+                # Right behind the last chunk of a group that is sent go the parity packets of the group
+                # The chunks of the group still in flight can't be rebuilt before the parity gets there, so their
+                # retransmission timeout starts over from here instead of running out while the group is sent
+                if fec_code is not None:
+                    group = (seq_num - 1) // fec_code.group_size
+                    if next_seq_num > chunk_count or (next_seq_num - 1) // fec_code.group_size != group:
+                        parity = send_parity(sock, server_address, packet_buffer, source_view, fec_code, group,
+                                             chunk_size)
+                        rate_controller.on_send(fec_code.parity_count * udp_packet.HEADER.size + parity)
+                        metrics.parity_sent += fec_code.parity_count
+                        if tracer is not None:
+                            tracer.event("parity", group, packets=fec_code.parity_count)
+                        deadline = time.perf_counter_ns() + int(rtt_estimator.rto * 1000000000)
+                        for group_seq_num in range(group * fec_code.group_size + 1, seq_num):
+                            entry = in_flight.get(group_seq_num)
+                            if entry is not None and entry[1] == 0:
+                                entry[2] = deadline
+                                heapq.heappush(deadlines, (deadline, group_seq_num))
+
+            # Everything has been sent and ACKed, the transfer is done, a stream once its end has been
+            if not in_flight and next_seq_num > chunk_count and (stream is None or stream.ended):
+                break
+
+            # Throw away heap entries for packets that are no longer waiting on the deadline they were pushed with
+            while deadlines and (deadlines[0][1] not in in_flight or
+                                 deadlines[0][0] != in_flight[deadlines[0][1]][2]):
+                heapq.heappop(deadlines)
 
-                # Send the packet to the server
-                sock.sendto(packet, (SERVER_IP, SERVER_PORT))
-                print(f"Sent packet {seq_num} with {len(data)} bytes of data")
+            # Wait for an ACK, but no longer than until the oldest in-flight packet times out or the pacer lets
+            # the next packet go. A stream with room in the window is also waited on for its next chunk
+            wait = MAX_RTO
+            if deadlines:
+                wait = max(0, deadlines[0][0] - time.perf_counter_ns()) / 1000000000
+            if pacing_delay:
+                wait = min(wait, pacing_delay)
+            readable = [sock]
+            if stream is not None and stream.waiting(next_seq_num) and next_seq_num < base + window_size:
+                readable.append(stream)
+            try:
+                ready = select.select(readable, [], [], wait)
+            except socket.error as e:
+                # Handle socket error
+                print(f"Socket error: {e}")
+                ready = ([], [], [])
 
+            # Read every ACK that is waiting on the socket before going back to sending
+            while ready[0]:
                 try:
-                    # This is for the ack_data from the server, buffer could be smaller to save data on the network
-                    # as this should only contain the ACK data containing the sequence number in this program
-                    ack_data, server_address = sock.recvfrom(BUFFER_SIZE)
-
-                    # Record the end time for the packet and calculate the packet time (for the data packet)
-                    end_time = time.perf_counter_ns()
-                    packet_time = end_time - start_time
-                    print(f"Client to server packet time: {packet_time}ns")
-
-                    # Unpack the acknowledgement packet and get the sequence number
-                    ack_seq_num = struct.unpack('!I', ack_data)[0]
-
-                    # Record the start time for the ACK and calculate the ACK time
-                    ack_start_time = time.perf_counter_ns()
-                    ack_time = ack_start_time - end_time
-
-                    # Trash conversion from ack_time (ns) time TIMEOUT in seconds
-                    if ack_time > TIMEOUT*1000000000:
-                        # Timeout if ACK time exceeds a certain value
-                        raise socket.timeout("ACK time exceeded maximum value")
-
-                    # Formatted print for client output
-                    print(f"Received ACK for packet {ack_seq_num}")
-                    print(f"Server to client ACK time: {ack_time}ns")
-
-                    # Record round trip time and display (again, for more output)
-                    round_trip_time = packet_time + ack_time
-                    print(f"Round-trip time: {round_trip_time}ns\n")
-
-                    # Add the packet time and ACK time to the total round trip time
-                    # Once the packets are done being sent, this is pulled out of this loop and used
-                    # at the end of the program for total time and average time to output
-                    total_time += (packet_time + ack_time)
-
-                    # Exit the retry loop and continue to the next packet
-                    retry_count = 0
+                    # This is for the ack_data from the server, buffer could be smaller to save data on the
+                    # network as this should only contain the ACK data containing the sequence number
+                    ack_length, ack_address = sock.recvfrom_into(ack_buffer)
+                except (BlockingIOError, InterruptedError):
                     break
+                except ConnectionResetError:
+                    # Windows reports an ICMP port unreachable from an earlier sendto() here, treat it as a loss
+                    continue
+
+                # Record the end time for the packet
+                end_time = time.perf_counter_ns()
+
+                # Unpack the acknowledgement packet and get the cumulative acknowledgement and the SACK bitmap, a
+                # HELLO_ACK for a HELLO that was sent again is ignored here
+                header = udp_packet.unpack_header(ack_buffer, ack_length)
+                if header is None or header[0] != udp_packet.TYPE_ACK:
+                    continue
+                cumulative = header[2]
+                bitmap = udp_packet.payload(ack_view, header[1])
+                metrics.acks_received += 1
+                last_heard = end_time
+
+                # Every packet in flight the ACK covers is done, packets it covered before (the packet was resent
+                # and both copies made it, or an older ACK arrived late) are no longer in flight and simply skipped
+                newest_send_time = None
+                acked = 0
+                for ack_seq_num in [seq_num for seq_num in in_flight
+                                    if udp_packet.acknowledges(cumulative, bitmap, seq_num)]:
+                    entry = in_flight.pop(ack_seq_num)
+                    compressed_chunks.pop(ack_seq_num, None)
+                    if stream is not None:
+                        stream.release(ack_seq_num)
+                    acked += 1
+
+                    if tracer is not None:
+                        tracer.event("ack", ack_seq_num, cumulative=cumulative)
+
+                    # A resent packet can't tell which of its copies was ACKed so it isn't timed
+                    if entry[1] == 0 and (newest_send_time is None or entry[0] > newest_send_time):
+                        newest_send_time = entry[0]
+
+                # Record the round trip time, only the newest packet the ACK covers is timed, the older ones
+                # also spent time waiting at the server for the ACK to be sent
+                round_trip_time = None
+                if newest_send_time is not None:
+                    round_trip_time = (end_time - newest_send_time) / 1000000000
+                    metrics.rtt.add(round_trip_time)
+
+                    # Feed the measurement to the estimator so the next packets get a timeout that fits the link
+                    rtt_estimator.sample(round_trip_time)
+
+                # Packets got through, so the rate controller can open up the window
+                if acked:
+                    rate_controller.on_ack(acked, round_trip_time, rtt_estimator.srtt)
+
+            # Resend every packet whose ACK did not show up in time
+            now = time.perf_counter_ns()
+            while deadlines and deadlines[0][0] <= now:
+                deadline, seq_num = heapq.heappop(deadlines)
+                entry = in_flight.get(seq_num)
+                if entry is None or deadline != entry[2]:
+                    continue
+
+                # Increment the retry count
+                entry[1] += 1
+
+                # If the server hasn't been heard from for too long, close the socket and exit the program
+                if now - last_heard >= GIVE_UP_AFTER * 1000000000:
+                    print(f"Connection failed: no ACK for {GIVE_UP_AFTER} seconds, packet {seq_num} was sent "
+                          f"{entry[1]} times.")
+                    metrics.finish(False)
+                    print(metrics.summary())
+                    sock.close()
+                    return False
 
-                except socket.timeout:
-                    # Increment the retry count and print the retry message
-                    retry_count += 1
-                    print(
-                        f"Timeout: retrying packet {seq_num} ({retry_count}/5)")
+                # A timeout backs off the retransmission timeout and tells the rate controller to slow down
+                rtt_estimator.timed_out(entry[0])
+                rate_controller.on_timeout(entry[0], rtt_estimator.srtt)
 
-            # If we've reached the maximum number of retries, close the socket and exit the program
-            if retry_count >= 5:
-                print("Connection failed: max number of retries reached.")
-                sock.close()
-                return
+                entry[0] = time.perf_counter_ns()
+                entry[2] = entry[0] + int(rtt_estimator.rto * 1000000000)
+                sent = send_chunk(sock, server_address, packet_buffer, source_view, seq_num, chunk_size,
+                                  instructions, compressed_chunks.get(seq_num))
+                rate_controller.on_send(udp_packet.HEADER.size + sent)
+                metrics.packets_sent += 1
+                metrics.retransmissions += 1
+                metrics.bytes_sent += sent
+                if tracer is not None:
+                    tracer.event("resend", seq_num, bytes=sent, retry=entry[1])
+                heapq.heappush(deadlines, (entry[2], seq_num))
 
-            # Obviously, this is iterated every loop until the data is done being read by the client and sent
-            # to the server
-            seq_num += 1
-            data = f.read(1024)
+    # Only now is it known how long a stream was
+    if stream is not None:
+        metrics.filesize = stream.size
+    metrics.finish(True)
 
-        # Calculate the total time and average round trip time and print the result
-        print(f"Total time: {total_time}ns")
-        avg_round_trip_time = total_time / seq_num
-        print(f"Average round trip time: {avg_round_trip_time}ns")
+    # Print the summary of the transfer, and where the round trip time estimate and the sending rate ended up
+    print(metrics.summary())
+    if compressor is not None:
+        print(compressor.summary())
+    if rtt_estimator.srtt is not None:
+        print(f"Smoothed round trip time: {rtt_estimator.srtt * 1000000000:.0f}ns, "
+              f"deviation: {rtt_estimator.rttvar * 1000000000:.0f}ns, "
+              f"retransmission timeout: {rtt_estimator.rto * 1000000000:.0f}ns")
+    if rate_controller.rate is not None:
+        print(f"Sending rate: {rate_controller.rate / 1000000:.2f} MB/s, "
+              f"congestion window: {rate_controller.cwnd:.1f} packets")
 
     # Close the socket and print a message
     sock.close()
     print("Client socket closed.")
+    return True
+
+
+# The send_batch() method sends the files in paths, and every file in the directories in paths, to the server in one
+# batch (see udp_batch) and returns whether all of them got across. The other arguments are the ones of send_image()
+# Small files go much faster than one transfer per file: there is only one handshake, the window is never drained at
+# the end of a file and small files share full-size chunks instead of taking a packet each
+def send_batch(paths, sock, SERVER_IP, SERVER_PORT, **kwargs):
+    batch = udp_batch.Batch(paths)
+    print(f"Sending {len(batch.names)} files, {batch.size} bytes, as one batch")
+    return send_image(None, sock, SERVER_IP, SERVER_PORT, batch=batch, **kwargs)
+
+
+# The send_stream() method sends source, a file-like object, socket or iterable of bytes-like objects (see
+# udp_stream.pieces()), to the server as a stream of a length nobody has to know up front and returns whether all of it
+# got across. The other arguments are the ones of send_image()
+def send_stream(source, sock, SERVER_IP, SERVER_PORT, **kwargs):
+    print("Sending a stream")
+    return send_image(None, sock, SERVER_IP, SERVER_PORT, stream=udp_stream.Stream(source), **kwargs)
+
+
+# The stripe_ranges() method splits a file of filesize bytes into at most stripes (offset, length) byte ranges of
+# about the same size that follow each other without gaps, an empty file is one empty stripe
+def stripe_ranges(filesize, stripes):
+    stripe_size = -(-filesize // max(stripes, 1))
+    stripe_size = max(-(-stripe_size // STRIPE_ALIGNMENT) * STRIPE_ALIGNMENT, STRIPE_ALIGNMENT)
+    return [(offset, min(stripe_size, filesize - offset)) for offset in range(0, filesize, stripe_size)] or [(0, 0)]
+
+
+# The send_stripe() method sends one stripe, the length bytes at offset of the file, from a socket of its own to
+# SERVER_PORT and returns the offset and what udp_metrics.Metrics counted as a dict. It runs in a worker process of
+# send_striped(), the output of send_image() is thrown away and the trace (if any) goes to a file of its own, or to
+# stderr for trace '-' so it is neither thrown away with the output nor mixed into the client's own
+def send_stripe(filename, SERVER_IP, SERVER_PORT, transfer_id, offset, length, chunk_size=udp_packet.MAX_CHUNK_SIZE,
+                trace=None, trace_every=1, fec=None, compress=None):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.setblocking(False)
+    tracer = udp_metrics.Tracer(trace, trace_every, sys.stderr) if trace else None
+    metrics = udp_metrics.Metrics(tracer)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            send_image(filename, client_socket, SERVER_IP, SERVER_PORT, chunk_size=chunk_size, metrics=metrics,
+                       transfer_id=transfer_id, offset=offset, length=length, fec=fec,
+                       compressor=udp_compress.Compressor(compress) if compress else None)
+    finally:
+        client_socket.close()
+        if tracer is not None:
+            tracer.close()
+    return offset, metrics.snapshot()
+
+
+# The send_striped() method sends the file as several stripes at the same time, one send_image() per stripe in a pool
+# of worker processes, so the per-packet work of the stripes runs on as many cores as there are processes instead of
+# sharing one interpreter lock. Stripe number n goes to the port ports[n % len(ports)], a server run with --workers
+# receives every port in its own process and writes all stripes into the same file
+# stripes defaults to one per port and processes to one per stripe. With resume the stripes pick up what an earlier
+# send_striped() of the same file got across. Once every stripe is done, the final check makes
+# sure every stripe was ACKed in full by the server and that together they cover the whole file, only then does this
+# return True. The trace filename gets the number of the stripe added, every stripe writes its own (trace '-' goes to
+# stderr, see send_stripe()), and every stripe uses the forward error correction fec and compresses its chunks at the
+# zlib level compress, if given
+def send_striped(filename, SERVER_IP, ports, stripes=None, chunk_size=udp_packet.MAX_CHUNK_SIZE, processes=None,
+                 transfer_id=None, trace=None, trace_every=1, resume=False, fec=None, compress=None):
+    filesize = os.path.getsize(filename)
+    ranges = stripe_ranges(filesize, stripes or len(ports))
+
+    # The server knows which stripes belong together by the transfer id, anything but 0 (a plain transfer) will do,
+    # resume_id() so the stripes can be resumed (with the same number of stripes)
+    if transfer_id is None:
+        transfer_id = resume_id(filename) if resume else int.from_bytes(os.urandom(4), "big") or 1
+    print(f"Sending {filesize} bytes as {len(ranges)} stripes (transfer {transfer_id:08x})...")
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(ranges)) as pool:
+        futures = []
+        for number, (offset, length) in enumerate(ranges):
+            stripe_trace = trace if trace in (None, "-") else f"{trace}.{number}"
+            futures.append(pool.submit(send_stripe, filename, SERVER_IP, ports[number % len(ports)], transfer_id,
+                                       offset, length, chunk_size, stripe_trace, trace_every, fec, compress))
+        results = dict(future.result() for future in futures)
+    elapsed = time.perf_counter() - start_time
+
+    for number, (offset, length) in enumerate(ranges):
+        snapshot = results[offset]
+        print(f"Stripe {number} ({offset}-{offset + length}): {'complete' if snapshot['completed'] else 'failed'}, "
+              f"{snapshot['elapsed']:.3f}s, {snapshot['goodput'] / 1000000:.2f} MB/s, "
+              f"{snapshot['retransmissions']} resent")
+
+    # The final check: every stripe has to be complete and the stripes have to follow each other from the start to
+    # the end of the file, or part of the file never got across
+    end = 0
+    for offset in sorted(results):
+        if offset != end or not results[offset]["completed"]:
+            break
+        end += results[offset]["filesize"]
+    if end != filesize or not all(snapshot["completed"] for snapshot in results.values()):
+        print(f"Striped transfer failed: only the first {end} of {filesize} bytes are complete.")
+        return False
+
+    print(f"All {len(ranges)} stripes complete: {filesize} bytes in {elapsed:.3f}s, "
+          f"goodput {filesize / elapsed / 1000000:.2f} MB/s")
+    return True
+
+
+# The parse_fec() method reads the K:M of --fec, the group size and parity count of the forward error correction
+def parse_fec(text):
+    try:
+        fec = tuple(int(number) for number in text.split(":"))
+        udp_fec.FecCode(*fec)
+    except (TypeError, ValueError) as error:
+        raise argparse.ArgumentTypeError(f"{text} isn't K:M with K + M <= {udp_fec.MAX_SYMBOLS}: {error}")
+    return fec
 
 
 # Define the main function to run the client
-def main():
+# The server address and the file can be given on the command line (python udp_client.py 192.168.1.2 5000 test.jpg)
+# so the client can be run from a script, whatever is left out is asked for like before
+# --stripes N sends the file as N stripes at once (see send_striped()), to --ports M ports from the server port up
+# --delta sends only what changed since the last version of the file sent to the server, a striped transfer is always
+# sent in full. --fec K:M adds M parity packets to every K chunks, which costs M / K more bytes but repairs up to M
+# lost chunks of every K without a retransmission. --compress sends the chunks that compress compressed, with zlib at
+# level 1 or the level given
+# More than one file, or a directory, is sent as one batch with send_batch() (python udp_client.py 192.168.1.2 5000
+# logs/ a.txt b.txt), which is never striped, resumed or sent as a delta
+# The file - is standard input, sent as a stream with send_stream() as it is read (tar c logs | python udp_client.py
+# 192.168.1.2 5000 -), which can't be read a second time to be striped or resumed either
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send an image to the UDP server")
+    parser.add_argument("ip_address", nargs="?", help="IP address of the server")
+    parser.add_argument("server_port", nargs="?", type=int, help="port of the server")
+    parser.add_argument("filenames", nargs="*", default=["test.jpg"], metavar="filename",
+                        help="file to send (default: test.jpg), several files or directories are sent as one batch "
+                             "and - streams standard input")
+    parser.add_argument("--trace", help="write every packet sent and ACKed to this JSON-lines file, - for the screen "
+                        "(stderr with --stripes)")
+    parser.add_argument("--trace-every", type=int, default=1, help="only trace every Nth packet")
+    parser.add_argument("--stripes", type=int, default=1,
+                        help="send the file as this many stripes at once, each from its own process")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"only send what an earlier attempt didn't get across, and try up to {RESUME_ATTEMPTS} "
+                             "times")
+    parser.add_argument("--ports", type=int, default=1,
+                        help="server ports to spread the stripes over, from the server port up (udp_server.py "
+                             "--workers)")
+    parser.add_argument("--delta", action="store_true",
+                        help="only send what changed since the version of the file the server already has")
+    parser.add_argument("--hash-cache", help="keep the signatures of the files sent with --delta in this JSON file")
+    parser.add_argument("--fec", type=parse_fec, metavar="K:M",
+                        help="send M forward error correction parity packets with every K chunks, e.g. 16:2")
+    parser.add_argument("--compress", type=int, nargs="?", const=udp_compress.DEFAULT_LEVEL, choices=range(1, 10),
+                        metavar="LEVEL", help="compress the chunks that compress with zlib at this level, 1 (fastest, "
+                                              "the default) to 9 (smallest)")
+    args = parser.parse_args(argv)
+
     # Set up the client-server connection
     # Prompt the user to enter the IP address
-    ip_address = input("Enter the IP address: ")
+    ip_address = args.ip_address
+    if ip_address is None:
+        ip_address = input("Enter the IP address: ")
 
     # Prompt the user to enter the port number
-    server_port = input("Enter the port number: ")
+    server_port = args.server_port
+    if server_port is None:
+        server_port = input("Enter the port number: ")
 
-    # Conver the user input for the port number to an integer
-    server_port = int(server_port)
+        # Conver the user input for the port number to an integer
+        server_port = int(server_port)
 
     # Set up the SERVER_IP and SERVER_PORT
     SERVER_IP = ip_address
@@ -238,17 +1275,65 @@ def main():
     # Display connection output to user
     print(f"Client connected to server at {SERVER_IP}:{SERVER_PORT}")
 
-    # Create a UDP socket
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # The signatures of the files sent as deltas are kept across runs with --hash-cache
+    hash_cache = udp_delta.HashCache(args.hash_cache) if args.hash_cache else None
 
-    # Set the socket to be non-blocking
-    client_socket.setblocking(False)
+    # Several files, or a directory, go as one batch, and standard input as a stream
+    batch = len(args.filenames) > 1 or os.path.isdir(args.filenames[0])
+    stream = args.filenames == ["-"]
+    filename = args.filenames[0]
+
+    # With --resume a failed transfer is tried again, every attempt picks up where the one before it stopped
+    attempts = RESUME_ATTEMPTS if args.resume and not batch and not stream else 1
+    for attempt in range(attempts):
+        if attempt:
+            print(f"Connecting again to resume the transfer ({attempt + 1}/{attempts})...")
+
+        # A striped transfer opens its own sockets, one per stripe
+        if args.stripes > 1 and not batch and not stream:
+            ports = [SERVER_PORT + number for number in range(max(args.ports, 1))]
+            succeeded = send_striped(filename, SERVER_IP, ports, args.stripes, trace=args.trace,
+                                     trace_every=args.trace_every, resume=args.resume, fec=args.fec,
+                                     compress=args.compress)
+            if succeeded:
+                break
+            continue
+
+        # Create a UDP socket
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Set the socket to be non-blocking
+        client_socket.setblocking(False)
+
+        # Nothing is printed per packet unless it is traced
+        tracer = udp_metrics.Tracer(args.trace, args.trace_every) if args.trace else None
+
+        # Call the send_image function to send the image file, send_batch for the batch or send_stream for the stream
+        compressor = udp_compress.Compressor(args.compress) if args.compress else None
+        if stream:
+            succeeded = send_stream(sys.stdin.buffer, client_socket, SERVER_IP, SERVER_PORT,
+                                    metrics=udp_metrics.Metrics(tracer), compressor=compressor)
+        elif batch:
+            try:
+                succeeded = send_batch(args.filenames, client_socket, SERVER_IP, SERVER_PORT,
+                                       metrics=udp_metrics.Metrics(tracer), fec=args.fec, compressor=compressor)
+            except ValueError as error:
+                print(f"Can't send the batch: {error}")
+                succeeded = False
+        else:
+            succeeded = send_image(filename, client_socket, SERVER_IP, SERVER_PORT,
+                                   metrics=udp_metrics.Metrics(tracer), resume=args.resume, delta=args.delta,
+                                   hash_cache=hash_cache, fec=args.fec, compressor=compressor)
 
-    # Call the send_image function to send the image file
-    send_image("test.jpg", client_socket, SERVER_IP, SERVER_PORT)
+        # Close the socket and the trace
+        client_socket.close()
+        if tracer is not None:
+            tracer.close()
+        if succeeded:
+            break
 
-    # Close the socket
-    client_socket.close()
+    # The exit status tells a script whether the file got across
+    return 0 if succeeded else 1
 
 
 # Call the main function if this file is being run directly
@@ -256,4 +1341,4 @@ def main():
 # This could be written as a script, considering how short it is and doesn't really need a modular
 # design
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Compression of the chunks the client sends. Logs, CSV and other text shrink to a fraction of their size with zlib,
+so compressing every chunk before it is sent saves most of the bandwidth for them. JPEGs, archives and other data that
+is compressed already don't shrink at all, and compressing them again only costs CPU time, so a `Compressor` stops
+trying once chunks stop compressing and only samples a chunk every now and then to find out whether the data changed.
+
+Every chunk is compressed on its own, so the server can decompress any chunk as soon as it arrives, in whatever order,
+and write it to its offset in the file. A compressed chunk goes out with `udp_packet.CHUNK_COMPRESSED` in the flags of
+its header, any other chunk is sent as it is (stored).
+
+`time` - The `time` module provides functions for working with time. `time.thread_time()` measures the CPU time spent
+compressing, which is what compression costs the client.
+
+`time`: https://docs.python.org/3/library/time.html
+
+`zlib` - The `zlib` module provides compression functions and checksums. Chunks are compressed with `zlib.compress()`
+at the level asked for, 1 (fastest) to 9 (smallest), and the Adler-32 checksum in every compressed chunk is checked
+again when the server decompresses it.
+
+`zlib`: https://docs.python.org/3/library/zlib.html
+
+"""
+
+import time
+import zlib
+
+
+# The zlib level used unless another one is asked for, the fastest one: on a network the time saved by sending fewer
+# bytes is gone quickly if compressing them takes longer than sending them
+DEFAULT_LEVEL = 1
+
+# A chunk is only sent compressed if that makes it at least 10% smaller, otherwise it isn't worth decompressing
+MAX_RATIO = 0.9
+
+# After a chunk that didn't compress the next chunk isn't tried, after two in a row the next two aren't, and so on
+# doubling up to this many chunks between tries, so incompressible data is hardly ever compressed but a part of the file
+# that compresses again is found within MAX_SKIP chunks
+MAX_SKIP = 256
+
+
+# The Compressor class compresses the chunks of one transfer at zlib level level and decides which chunks are worth it
+# tried, compressed, bytes_in and bytes_out count the chunks it compressed, the ones that went out compressed and their
+# sizes before and after, seconds is the CPU time it spent compressing
+class Compressor:
+    def __init__(self, level=DEFAULT_LEVEL, max_skip=MAX_SKIP):
+        if not 1 <= level <= 9:
+            raise ValueError(f"zlib level {level} isn't between 1 and 9")
+        self.level = level
+        self.max_skip = max_skip
+
+        # How many more chunks are sent without trying, and how many were skipped after the last chunk that didn't
+        # compress
+        self.skip = 0
+        self.backoff = 0
+
+        self.tried = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    # The compress() method returns the chunk data (bytes or a memoryview) compressed, or None if it is to be sent as
+    # it is: the chunk didn't compress well enough, or the chunks before it didn't and this one isn't sampled
+    def compress(self, data):
+        if self.skip:
+            self.skip -= 1
+            return None
+        start_time = time.thread_time()
+        compressed = zlib.compress(data, self.level)
+        self.seconds += time.thread_time() - start_time
+        self.tried += 1
+
+        if len(compressed) > len(data) * MAX_RATIO:
+            self.backoff = min(max(self.backoff * 2, 1), self.max_skip)
+            self.skip = self.backoff
+            return None
+        self.backoff = 0
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    # The summary() method returns a line about what compression did for the transfer
+    def summary(self):
+        saved = self.bytes_in - self.bytes_out
+        return (f"Compression: {self.compressed}/{self.tried} chunks tried compressed at level {self.level}, "
+                f"{saved} bytes saved, {self.seconds * 1000:.1f}ms CPU")
+
+
+# The decompress() method returns the compressed chunk data decompressed, or None unless it is exactly length bytes of
+# zlib data with nothing behind it. length is the length the chunk has in the file, nothing past it is decompressed
+# Without exact the chunk can be shorter than length, like the chunks of a stream, which are as long as they are
+def decompress(data, length, exact=True):
+    decompressor = zlib.decompressobj()
+    try:
+        chunk = decompressor.decompress(data, length)
+    except zlib.error:
+        return None
+    if exact and len(chunk) != length or not decompressor.eof or decompressor.unused_data:
+        return None
+    return chunk
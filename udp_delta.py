@@ -0,0 +1,306 @@
+"""
+Delta transfers: when the server already has an older version of the file, the client only sends the parts of the
+file that changed and tells the server to copy everything else from its own copy, the way rsync does.
+
+`hashlib` - The `hashlib` module implements secure hashes and message digests. BLAKE2b with a 16 byte digest is the
+strong hash that decides whether two blocks really are the same.
+
+`hashlib`: https://docs.python.org/3/library/hashlib.html
+
+`json` - The `json` module encodes Python objects as JSON. A `HashCache` can be saved to a JSON file, so the signatures
+of files that didn't change are still there the next time the client or server is started.
+
+`json`: https://docs.python.org/3/library/json.html
+
+`mmap` - The `mmap` module provides memory-mapped file objects. A file that isn't in the cache is mapped into memory
+to be hashed, so a big file is never read into memory all at once.
+
+`mmap`: https://docs.python.org/3/library/mmap.html
+
+`os` - The `os` module provides a way of interacting with the operating system. `os.stat()` gives the size and
+modification time a cached signature is checked against, and `os.replace()` saves the cache file in one step.
+
+`os`: https://docs.python.org/3/library/os.html
+
+`struct` - The `struct` module performs conversions between Python values and C structs. Every block of a signature
+is packed with the precompiled `BLOCK` struct.
+
+`struct`: https://docs.python.org/3/library/struct.html
+
+`threading` - The `threading` module constructs higher-level threading interfaces. A `HashCache` can be used from
+several threads at once, a `threading.Lock` keeps them from saving the cache file at the same time.
+
+`threading`: https://docs.python.org/3/library/threading.html
+
+`zlib` - The `zlib` module provides compression functions and checksums. `zlib.adler32()` is the weak hash of a block,
+which can also be rolled along the file one byte at a time.
+
+`zlib`: https://docs.python.org/3/library/zlib.html
+
+--- How a delta works ---
+
+1.  The client asks for a delta with `udp_packet.FLAG_DELTA` in its HELLO. If the server has a copy of the file (the
+    basis), the HELLO_ACK says how many blocks its signature has and the client fetches the signature with SIGNATURE
+    packets. The block size is the chunk size minus the offset a LITERAL carries (`udp_packet.delta_block_size()`).
+2.  The signature is a weak and a strong hash of every whole block of the basis (`block_signature()`), 20 bytes a
+    block. The last block of the basis, if it is shorter than the block size, isn't part of it.
+3.  `compute_delta()` walks through the client's file looking for blocks of the basis: wherever the weak hash of the
+    block_size bytes at a position is one of the basis', the strong hash has to match too. Every block found becomes a
+    copy of that block, whatever lies between the blocks found is sent as literal data.
+4.  After a block that isn't in the basis the next block_size - 1 positions are tried as well, with the weak hash
+    rolled one byte at a time, so a block is found again right after bytes were inserted or removed in front of it.
+    Rolling runs in Python, so it is skipped where one of the next few blocks is still where it was in the basis (the
+    block was changed in place) and mostly skipped in long stretches of new data.
+5.  The client sends the delta as LITERAL and COPY packets instead of DATA packets, one per instruction. The server
+    writes them into a new file next to the basis, copying from the basis for the COPY packets, and replaces the basis
+    with it once the whole file is there.
+
+Hashing a big file takes time, so the signatures are kept in a `HashCache` by path, size and modification time, and a
+file that didn't change since it was last hashed isn't read again.
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+# One block of a signature: the weak hash (Adler-32) and the strong hash (16 bytes of BLAKE2b)
+BLOCK = struct.Struct('!I16s')
+
+# The modulus of Adler-32, both of its sums are kept below it
+ADLER_MOD = 65521
+
+# After this many bytes (1 MB) without finding a block of the basis the file is most likely new there, from then on
+# the weak hash is only rolled behind every ROLL_EVERY-th block until a block is found again. Rolling runs in Python
+# one byte at a time and would otherwise cost more than sending the bytes
+ROLL_WINDOW = 1024 * 1024
+ROLL_EVERY = 16
+
+# How many blocks ahead changed_in_place() looks for a block that is still where it was
+IN_PLACE_BLOCKS = 4
+
+# Neighbouring blocks that are copied from neighbouring blocks of the basis are sent as one COPY of up to this many
+# bytes (16 MB)
+MAX_COPY = 16 * 1024 * 1024
+
+
+# The strong_hash() method is the strong hash of a block
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# The block_signature() method returns the signature of view (a memoryview of the file) for block_size blocks: the
+# weak and strong hash of every whole block one after the other, packed with BLOCK. With signature (an empty
+# bytearray) every block is added to it as soon as it is hashed, so another thread can hand out the start of the
+# signature while the rest is still being hashed
+def block_signature(view, block_size, signature=None):
+    if signature is None:
+        signature = bytearray()
+    for offset in range(0, len(view) - block_size + 1, block_size):
+        block = view[offset:offset + block_size]
+        signature += BLOCK.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(signature)
+
+
+# The HashCache class keeps the signature of every file it hashed, keyed by the absolute path and checked against the
+# size and modification time of the file (and the block size), so a file that didn't change isn't hashed again
+# Only the latest signature of a path is kept. With a filename the cache is loaded from that JSON file and saved to it
+# whenever a file is hashed. hits and misses count how often a signature came from the cache or had to be computed
+class HashCache:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if filename is not None:
+            self.load()
+
+    # The load() method reads the cache file, a cache file that is missing or can't be read is an empty cache
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for path, (size, mtime_ns, block_size, signature) in entries.items():
+            self.entries[path] = (size, mtime_ns, block_size, bytes.fromhex(signature))
+
+    # The save() method writes the cache file, to a temporary file first so a crash never leaves half a cache behind
+    def save(self):
+        temporary = f"{self.filename}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({path: [size, mtime_ns, block_size, signature.hex()]
+                       for path, (size, mtime_ns, block_size, signature) in self.entries.items()}, f)
+        os.replace(temporary, self.filename)
+
+    # The signature() method returns the signature of filename for block_size blocks, from the cache if the file
+    # hasn't changed since it was hashed. source is the file's contents if the caller already has them mapped,
+    # otherwise the file is mapped with hash_file(). With progress (an empty bytearray) the signature is also put in
+    # there as it is hashed, see block_signature()
+    def signature(self, filename, block_size, source=None, progress=None):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns, block_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == key:
+            self.hits += 1
+            if progress is not None:
+                progress += entry[3]
+            return entry[3]
+
+        self.misses += 1
+        if source is not None:
+            with memoryview(source) as view:
+                signature = block_signature(view, block_size, progress)
+        else:
+            signature = hash_file(path, block_size, progress)
+        with self.lock:
+            self.entries[path] = key + (signature,)
+            if self.filename is not None:
+                self.save()
+        return signature
+
+
+# The hash_file() method returns the signature of the file at path for block_size blocks, hashed straight out of the
+# file mapped into memory (an empty file can't be mapped and has no blocks anyway). progress is the one of
+# block_signature()
+def hash_file(path, block_size, progress=None):
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            return block_signature(view, block_size, progress)
+
+
+# The cache used when no other one is given, it lives as long as the process
+default_cache = HashCache()
+
+
+# The block_hashes() method returns (weak, strong) of the block_size bytes at position of source, from own_blocks (the
+# file's own signature as a list) where the block is one of its blocks, otherwise strong is None until it is needed
+def block_hashes(source, position, block_size, own_blocks):
+    block_number, misaligned = divmod(position, block_size)
+    if not misaligned and block_number < len(own_blocks):
+        return own_blocks[block_number]
+    return zlib.adler32(source[position:position + block_size]), None
+
+
+# The find_block() method returns the index of the block of the basis that the block_size bytes at position of source
+# are, or None. weak is their weak hash, strong their strong hash if it is already known. table maps the weak hashes
+# of the basis to {strong hash: index} and blocks is the signature as a list of (weak, strong), the block right after
+# the last one copied (expected) is preferred so neighbouring blocks turn into one COPY
+def find_block(source, position, block_size, weak, strong, table, blocks, expected):
+    candidates = table.get(weak)
+    if candidates is None:
+        return None
+    if strong is None:
+        strong = strong_hash(source[position:position + block_size])
+    if expected < len(blocks) and blocks[expected] == (weak, strong):
+        return expected
+    return candidates.get(strong)
+
+
+# The roll_block() method looks for a block of the basis at the positions after position up to and including last,
+# rolling the weak hash of the block at position (weak) along one byte at a time, and returns (position, index) of the
+# first one found or None. Moving the block one byte on takes the byte at its start out of both Adler-32 sums and adds
+# the byte after its end: a' = a - out + in, b' = b - block_size * out + a' - 1
+def roll_block(source, position, last, block_size, weak, table, blocks, expected):
+    a = weak & 0xffff
+    b = weak >> 16
+    outgoing = bytes(source[position:last])
+    incoming = bytes(source[position + block_size:last + block_size])
+    for step, (out, new) in enumerate(zip(outgoing, incoming), 1):
+        a = (a - out + new) % ADLER_MOD
+        b = (b - block_size * out + a - 1) % ADLER_MOD
+        weak = b << 16 | a
+        if weak in table:
+            index = find_block(source, position + step, block_size, weak, None, table, blocks, expected)
+            if index is not None:
+                return position + step, index
+    return None
+
+
+# The changed_in_place() method tells whether one of the IN_PLACE_BLOCKS blocks after the one at position is still the
+# block of the basis it would be if nothing had moved since block expected, the one the block at position would have
+# been. Then the blocks up to it were changed in place and rolling through them can't find a block any sooner
+def changed_in_place(source, position, block_size, own_blocks, blocks, expected):
+    for step in range(1, IN_PLACE_BLOCKS + 1):
+        following = position + step * block_size
+        if following + block_size > len(source) or expected + step >= len(blocks):
+            return False
+        weak, strong = block_hashes(source, following, block_size, own_blocks)
+        if weak != blocks[expected + step][0]:
+            continue
+        if strong is None:
+            strong = strong_hash(source[following:following + block_size])
+        if strong == blocks[expected + step][1]:
+            return True
+    return False
+
+
+# The add_literal() method adds the bytes from start to end of the file to instructions as literal data, in pieces of
+# at most block_size bytes so every piece fits in one LITERAL
+def add_literal(instructions, start, end, block_size):
+    for offset in range(start, end, block_size):
+        instructions.append((offset, min(block_size, end - offset), None))
+
+
+# The compute_delta() method returns the instructions that make source (a memoryview of the client's file) out of the
+# basis the server has, given the basis' signature for block_size blocks. Every instruction is (offset, length, basis
+# offset) with basis offset None for literal data, together they cover the whole file in order
+# own_signature is the signature of source itself (from a HashCache): where the file is still lined up with its blocks
+# their hashes are taken from it instead of being computed again
+def compute_delta(source, signature, block_size, own_signature=None):
+    size = len(source)
+    blocks = list(BLOCK.iter_unpack(signature))
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    own_blocks = list(BLOCK.iter_unpack(own_signature)) if own_signature else []
+
+    instructions = []
+    literal_start = 0
+    position = 0
+    expected = 0
+    while position + block_size <= size:
+        weak, strong = block_hashes(source, position, block_size, own_blocks)
+        index = find_block(source, position, block_size, weak, strong, table, blocks, expected)
+
+        # Not a block of the basis, roll on through the positions up to the next block unless there has been nothing
+        # but new data for a while, or a block right after it is still where it was in the basis: then the block was
+        # only changed in place and rolling wouldn't find anything sooner than that
+        literal = position - literal_start
+        if index is None and (literal < ROLL_WINDOW or not (literal // block_size) % ROLL_EVERY) and \
+                not changed_in_place(source, position, block_size, own_blocks, blocks, expected):
+            found = roll_block(source, position, min(position + block_size - 1, size - block_size), block_size,
+                               weak, table, blocks, expected)
+            if found is not None:
+                position, index = found
+        if index is None:
+            position += block_size
+            continue
+
+        # Whatever is in front of the block is new, the block itself is copied, together with the blocks in front of
+        # it if they were copied from right in front of it in the basis
+        add_literal(instructions, literal_start, position, block_size)
+        basis_offset = index * block_size
+        if instructions and instructions[-1][2] is not None:
+            offset, length, previous = instructions[-1]
+            if offset + length == position and previous + length == basis_offset and \
+                    length + block_size <= MAX_COPY:
+                instructions[-1] = (offset, length + block_size, previous)
+                basis_offset = None
+        if basis_offset is not None:
+            instructions.append((position, block_size, basis_offset))
+        position += block_size
+        literal_start = position
+        expected = index + 1
+
+    add_literal(instructions, literal_start, size, block_size)
+    return instructions
@@ -0,0 +1,262 @@
+"""
+A network emulator for testing the client and server on one machine: a UDP proxy that sits between them and delays,
+drops, duplicates and reorders the datagrams passing through, like a slow or lossy network would. The client sends to
+the emulator instead of the server and the emulator forwards everything to the server and the replies back.
+
+`argparse` - The `argparse` module makes it easy to write user-friendly command-line interfaces. It is used for the
+addresses and network conditions when the emulator is run on its own.
+
+`argparse`: https://docs.python.org/3/library/argparse.html
+
+`heapq` - The `heapq` module provides an implementation of the heap queue algorithm. It keeps the delayed datagrams
+ordered by the time they are due to be delivered.
+
+`heapq`: https://docs.python.org/3/library/heapq.html
+
+`itertools` - The `itertools` module provides functions creating iterators for efficient looping. `itertools.count()`
+numbers the delayed datagrams so two of them due at the same time are delivered in the order they arrived.
+
+`itertools`: https://docs.python.org/3/library/itertools.html
+
+`random` - The `random` module implements pseudo-random number generators. It decides which datagrams are lost,
+duplicated or reordered and how much jitter each one gets, with a seed the same run can be repeated exactly.
+
+`random`: https://docs.python.org/3/library/random.html
+
+`selectors` - The `selectors` module allows high-level and efficient I/O multiplexing. It is used to wait on the socket
+facing the clients and the sockets facing the server at the same time.
+
+`selectors`: https://docs.python.org/3/library/selectors.html
+
+`threading` - The `threading` module constructs higher-level threading interfaces. The emulator runs in a background
+thread so it can be started from the benchmark (or a test) that also runs the client.
+
+`threading`: https://docs.python.org/3/library/threading.html
+
+--- Network conditions ---
+
+Every condition applies to both directions, data packets on the way to the server and ACKs on the way back.
+
+delay       Every datagram is held for this many seconds before it is passed on (half the round trip time).
+
+jitter      Every datagram is held for up to this many seconds more or less than delay, picked at random.
+
+loss        The chance (0 to 1) that a datagram is dropped.
+
+duplicate   The chance that a datagram is delivered twice.
+
+reorder     The chance that a datagram is held back an extra `REORDER_DELAY` seconds, so the datagrams sent after it
+            overtake it.
+
+Every client gets its own socket towards the server, so the server still sees every client at its own address.
+
+Run with `python udp_emulator.py --help` to put the emulator between a client and a server by hand.
+
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+
+# How long a reordered datagram is held back on top of its delay and jitter, in seconds
+REORDER_DELAY = 0.002
+
+# Size of the socket buffers asked for, the emulator must not be the one losing datagrams by accident
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+# The NetworkEmulator class is the proxy itself: datagrams sent to its address are passed on to target_address after
+# going through the network conditions, and the replies are passed back the same way. delay and jitter are in seconds,
+# loss, duplicate and reorder are chances from 0 to 1
+# The counters (forwarded, dropped, duplicated, reordered) can be read while it runs
+class NetworkEmulator:
+    def __init__(self, target_address, delay=0, jitter=0, loss=0, duplicate=0, reorder=0, seed=None,
+                 listen_address=("127.0.0.1", 0)):
+        self.target_address = target_address
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+        # The socket the clients send to
+        self.sock = self.open_socket()
+        self.sock.bind(listen_address)
+        self.address = self.sock.getsockname()
+
+        # One socket towards the server per client address
+        self.upstreams = {}
+
+        # The delayed datagrams, a heap of (delivery time, arrival number, socket, datagram, destination)
+        self.queue = []
+        self.arrivals = itertools.count()
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # The open_socket() method creates a non-blocking UDP socket with big buffers
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+            except OSError:
+                pass
+        return sock
+
+    # The start() method runs the emulator in a background thread and returns it
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    # The stop() method stops the background thread and closes every socket, datagrams still held are lost
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.selector.close()
+        self.sock.close()
+        for upstream in self.upstreams.values():
+            upstream.close()
+
+    # The upstream_address() method is the address the server sees the client at client_address as
+    def upstream_address(self, client_address):
+        return self.upstreams[client_address].getsockname()
+
+    # The run() method is the emulator's loop: receive whatever arrives on any socket, put it through the network
+    # conditions and deliver every held datagram once it is due
+    def run(self):
+        while not self.stop_event.is_set():
+            # Wake up when the next held datagram is due, and at least ten times a second to check stop_event
+            timeout = 0.1
+            if self.queue:
+                timeout = min(timeout, max(0, self.queue[0][0] - time.perf_counter()))
+
+            for key, events in self.selector.select(timeout):
+                self.receive(key.fileobj, key.data)
+
+            now = time.perf_counter()
+            while self.queue and self.queue[0][0] <= now:
+                delivery_time, number, sock, datagram, destination = heapq.heappop(self.queue)
+                self.send(sock, datagram, destination)
+
+    # The receive() method reads every datagram waiting on sock, client_address is the client a socket towards the
+    # server belongs to or None for the socket the clients send to
+    def receive(self, sock, client_address):
+        while True:
+            try:
+                datagram, address = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                # Windows reports an ICMP port unreachable from an earlier sendto() here
+                continue
+
+            if client_address is None:
+                # From a client, on to the server through the client's own socket
+                upstream = self.upstreams.get(address)
+                if upstream is None:
+                    upstream = self.open_socket()
+                    upstream.bind((self.address[0], 0))
+                    self.upstreams[address] = upstream
+                    self.selector.register(upstream, selectors.EVENT_READ, address)
+                self.emulate(upstream, datagram, self.target_address)
+            else:
+                # From the server, back to the client
+                self.emulate(self.sock, datagram, client_address)
+
+    # The emulate() method puts one datagram through the network conditions and sends or holds every copy of it that
+    # survives
+    def emulate(self, sock, datagram, destination):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+
+        for _ in range(copies):
+            hold = self.delay
+            if self.jitter:
+                hold += self.random.uniform(-self.jitter, self.jitter)
+            if self.random.random() < self.reorder:
+                self.reordered += 1
+                hold += self.jitter + REORDER_DELAY
+
+            # Nothing to wait for, straight through
+            if hold <= 0 and not self.queue:
+                self.send(sock, datagram, destination)
+            else:
+                heapq.heappush(self.queue, (time.perf_counter() + max(hold, 0), next(self.arrivals), sock, datagram,
+                                            destination))
+
+    # The send() method passes a datagram on, a full socket buffer loses it just like a full router queue would
+    def send(self, sock, datagram, destination):
+        try:
+            sock.sendto(datagram, destination)
+            self.forwarded += 1
+        except (BlockingIOError, ConnectionResetError):
+            self.dropped += 1
+        except OSError:
+            # The socket was closed by stop() while a datagram was still due
+            pass
+
+
+# The parse_address() method turns 'host:port' into a (host, port) tuple for argparse
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+# The main() method runs the emulator in front of a server until Ctrl+C is pressed, the client is then pointed at the
+# emulator's port instead of the server's
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDP proxy that adds delay, jitter, loss, duplication and reordering")
+    parser.add_argument("target", type=parse_address, help="server address, host:port")
+    parser.add_argument("--listen", type=parse_address, default=("127.0.0.1", 0),
+                        help="address the clients send to, host:port (default: any free port on 127.0.0.1)")
+    parser.add_argument("--delay", type=float, default=0, help="one way delay in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="delay variation in milliseconds")
+    parser.add_argument("--loss", type=float, default=0, help="datagrams lost, in percent")
+    parser.add_argument("--duplicate", type=float, default=0, help="datagrams duplicated, in percent")
+    parser.add_argument("--reorder", type=float, default=0, help="datagrams reordered, in percent")
+    parser.add_argument("--seed", type=int, help="random seed, to repeat a run exactly")
+    args = parser.parse_args(argv)
+
+    emulator = NetworkEmulator(args.target, delay=args.delay / 1000, jitter=args.jitter / 1000,
+                               loss=args.loss / 100, duplicate=args.duplicate / 100, reorder=args.reorder / 100,
+                               seed=args.seed, listen_address=args.listen)
+    print(f"Emulating the network from {emulator.address[0]}:{emulator.address[1]} "
+          f"to {args.target[0]}:{args.target[1]}")
+    emulator.start()
+    try:
+        while emulator.thread.is_alive():
+            emulator.thread.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+    print(f"Forwarded {emulator.forwarded}, dropped {emulator.dropped}, duplicated {emulator.duplicated}, "
+          f"reordered {emulator.reordered} datagrams")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Forward error correction for the data packets: for every group of chunks the client also sends a few parity packets,
+and the server rebuilds up to that many lost chunks of the group from them, without waiting a retransmission timeout
+and a round trip for the client to send them again.
+
+The code is a systematic Reed-Solomon code over GF(2^8) built from a Cauchy matrix: the chunks themselves are sent as
+they are and parity packet j of a group is the sum of every chunk of the group multiplied by matrix[j][i]. Any square
+part of a Cauchy matrix can be inverted, so any parity_count parity packets can stand in for any parity_count lost
+chunks. Every column of the matrix is scaled so that the first row is all ones, the first parity packet is then simply
+the XOR of the chunks, and with one parity packet per group the code is plain XOR parity.
+
+Adding in GF(2^8) is XOR, multiplying a whole chunk by a constant is `bytes.translate()` with a 256 byte table for the
+constant, so both run in C over the whole chunk at once. The XOR of two chunks is done on them as big integers
+(`int.from_bytes()`), a chunk shorter than chunk_size is padded with zeros that way without copying it.
+
+`functools` - The `functools` module provides higher-order functions. `functools.lru_cache()` keeps the
+multiplication tables that have been built, there are at most 255 of them.
+
+`functools`: https://docs.python.org/3/library/functools.html
+
+"""
+
+import functools
+
+
+# The polynomial GF(2^8) is built with, x^8 + x^4 + x^3 + x^2 + 1 like in most Reed-Solomon codes
+POLYNOMIAL = 0x11d
+
+# The exponent and logarithm tables of the generator 2, EXP is twice as long so EXP[LOG[a] + LOG[b]] never wraps
+EXP = [0] * 510
+LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    EXP[_power] = EXP[_power + 255] = _value
+    LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= POLYNOMIAL
+
+# A group and its parity packets are numbered with the elements of GF(2^8), so together they can't be more than 256
+MAX_SYMBOLS = 256
+
+
+# The gf_mul() method multiplies two elements of GF(2^8)
+def gf_mul(a, b):
+    if not a or not b:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+# The gf_inv() method is the inverse of an element of GF(2^8) that isn't 0
+def gf_inv(a):
+    return EXP[255 - LOG[a]]
+
+
+# The multiplication_table() method is the bytes.translate() table that multiplies every byte by factor
+@functools.lru_cache(maxsize=None)
+def multiplication_table(factor):
+    return bytes(gf_mul(factor, value) for value in range(256))
+
+
+# The scaled() method returns data (bytes or a memoryview) multiplied by factor as a big integer, little-endian so a
+# short chunk counts as if it was padded with zeros at the end
+def scaled(factor, data):
+    if factor == 1:
+        return int.from_bytes(data, "little")
+    return int.from_bytes(bytes(data).translate(multiplication_table(factor)), "little")
+
+
+# The invert() method inverts the square matrix rows over GF(2^8) with Gauss-Jordan elimination, the rows of a Cauchy
+# matrix always have an inverse
+def invert(rows):
+    size = len(rows)
+    matrix = [list(row) + [int(column == number) for column in range(size)] for number, row in enumerate(rows)]
+    for column in range(size):
+        pivot = next(number for number in range(column, size) if matrix[number][column])
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        inverse = gf_inv(matrix[column][column])
+        matrix[column] = [gf_mul(inverse, value) for value in matrix[column]]
+        for number in range(size):
+            factor = matrix[number][column]
+            if number != column and factor:
+                matrix[number] = [value ^ gf_mul(factor, pivot_value)
+                                  for value, pivot_value in zip(matrix[number], matrix[column])]
+    return [row[size:] for row in matrix]
+
+
+# The FecCode class encodes and decodes groups of up to group_size chunks with parity_count parity packets each
+# The coefficients are the Cauchy matrix 1 / (x_j + y_i) with x_j = group_size + j for parity packet j and y_i = i for
+# chunk i, every column divided by its first row. A shorter group (the last one of a file) uses the first columns only
+class FecCode:
+    def __init__(self, group_size, parity_count):
+        if group_size < 1 or parity_count < 1 or group_size + parity_count > MAX_SYMBOLS:
+            raise ValueError(f"can't have {parity_count} parity packets for groups of {group_size} chunks")
+        self.group_size = group_size
+        self.parity_count = parity_count
+        cauchy = [[gf_inv((group_size + parity) ^ chunk) for chunk in range(group_size)]
+                  for parity in range(parity_count)]
+        self.matrix = [[gf_mul(value, gf_inv(first)) for value, first in zip(row, cauchy[0])] for row in cauchy]
+
+    # The encode() method returns the parity packets of chunks (the chunks of one group, bytes or memoryviews of up to
+    # chunk_size bytes each), chunk_size bytes each
+    def encode(self, chunks, chunk_size):
+        parities = []
+        for row in self.matrix:
+            parity = 0
+            for factor, chunk in zip(row, chunks):
+                parity ^= scaled(factor, chunk)
+            parities.append(parity.to_bytes(chunk_size, "little"))
+        return parities
+
+    # The decode() method rebuilds the lost chunks of one group: chunks has the chunks of the group that arrived and
+    # None for the lost ones, parities maps the number of every parity packet that arrived to its data. It returns
+    # {index in the group: chunk_size bytes} for the lost chunks, the caller cuts a short last chunk down to size, or
+    # None if fewer parity packets than lost chunks arrived
+    def decode(self, chunks, parities, chunk_size):
+        lost = [index for index, chunk in enumerate(chunks) if chunk is None]
+        if len(parities) < len(lost):
+            return None
+        if not lost:
+            return {}
+        used = sorted(parities)[:len(lost)]
+
+        # What is left of every parity packet once the chunks that did arrive are taken out of it is the sum of the
+        # lost chunks times their coefficients, a small system of equations that the inverse matrix solves
+        remainders = []
+        for parity in used:
+            remainder = int.from_bytes(parities[parity], "little")
+            for factor, chunk in zip(self.matrix[parity], chunks):
+                if chunk is not None:
+                    remainder ^= scaled(factor, chunk)
+            remainders.append(remainder.to_bytes(chunk_size, "little"))
+
+        inverse = invert([[self.matrix[parity][index] for index in lost] for parity in used])
+        rebuilt = {}
+        for index, row in zip(lost, inverse):
+            chunk = 0
+            for factor, remainder in zip(row, remainders):
+                chunk ^= scaled(factor, remainder)
+            rebuilt[index] = chunk.to_bytes(chunk_size, "little")
+        return rebuilt
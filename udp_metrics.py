@@ -0,0 +1,219 @@
+"""
+Counters, round trip time histograms and per-packet tracing for the client and the server, in place of printing every
+packet. Nothing is printed or written while a transfer runs unless tracing is turned on, counting a packet is only an
+attribute increment, and a summary is printed once the transfer is done. The numbers can also be read at any time
+while the transfer runs with `Metrics.snapshot()`.
+
+`bisect` - The `bisect` module provides support for maintaining a list in sorted order without having to sort the list
+after each insertion. It finds the histogram bucket a round trip time belongs in with a binary search that runs in C.
+
+`bisect`: https://docs.python.org/3/library/bisect.html
+
+`json` - The `json` module encodes Python objects as JSON. Every traced event is written as one line of JSON
+(JSON-lines), which can be read back line by line with `json.loads()` or loaded with most data tools.
+
+`json`: https://docs.python.org/3/library/json.html
+
+`sys` - The `sys` module provides access to variables and functions of the interpreter. A trace can be written to
+`sys.stdout` to watch the packets go by like the old per-packet output.
+
+`sys`: https://docs.python.org/3/library/sys.html
+
+`time` - The `time` module provides functions for working with time. `time.perf_counter()` times the transfer and
+stamps the traced events.
+
+`time`: https://docs.python.org/3/library/time.html
+
+--- Counters ---
+
+packets_sent        Data packets sent, resent ones included (client)
+bytes_sent          Bytes of image data in them, with the offsets of the instructions of a delta (client)
+retransmissions     Data packets sent again after a timeout (client)
+resumed             Chunks not sent because the server had them from an earlier attempt (client)
+bytes_copied        Bytes of a delta copied from the server's old copy of the file instead of sent (client and server)
+signature_bytes     Bytes of the signature of the server's copy fetched for a delta, not in bytes_sent (client)
+parity_sent         Forward error correction parity packets sent, not counted in packets_sent (client)
+compressed          Chunks sent (client) or received (server) compressed, resent ones not counted again
+bytes_saved         Bytes of image data the compressed chunks didn't have to send, bytes_sent is what they did (client)
+acks_received       ACKs received (client)
+packets_received    Data packets received (server)
+bytes_received      Bytes of image data in them (server)
+duplicates          Data packets received for a chunk that was already written (server)
+out_of_order        Data packets that arrived while a chunk in front of them was still missing (server)
+ignored             Data packets dropped because they are not a chunk of the file (server)
+parity_received     Parity packets received, not counted in packets_received (server)
+fec_repaired        Lost chunks rebuilt from parity packets instead of being sent again after a timeout (server)
+acks_sent           ACKs sent (server)
+
+--- Tracing ---
+
+A `Tracer` writes one line per event, for example:
+
+    {"t": 0.001234, "event": "send", "seq": 17, "bytes": 65499}
+
+t is the number of seconds since the tracer was created. The client traces send, ack and resend (after a timeout) events
+and the server traces receive, duplicate, ignore and ack events. With forward error correction the client also traces
+parity events and the server repair events. With `every` set to N only the packets whose sequence
+number is a multiple of N are traced, with all of their events, which keeps the trace small at high packet rates.
+
+"""
+
+import bisect
+import json
+import sys
+import time
+
+
+# The upper bounds of the round trip time histogram buckets in seconds, 1, 2 and 5 for every power of ten from 10
+# microseconds to 50 seconds. Anything slower ends up in one last bucket
+RTT_BUCKETS = tuple(step * 10 ** exponent for exponent in range(-5, 2) for step in (1, 2, 5))
+
+
+# The RttHistogram class counts round trip times in the fixed RTT_BUCKETS buckets, adding a sample takes the same time
+# and memory no matter how many samples there are. The percentiles are the upper bound of the bucket they fall in
+class RttHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(RTT_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    # The add() method counts one round trip time, in seconds
+    def add(self, rtt):
+        self.counts[bisect.bisect_left(RTT_BUCKETS, rtt)] += 1
+        self.count += 1
+        self.total += rtt
+        if self.min is None or rtt < self.min:
+            self.min = rtt
+        if self.max is None or rtt > self.max:
+            self.max = rtt
+
+    # The mean() method is the average round trip time, 0 without samples
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    # The percentile() method is the round trip time fraction (0 to 1) of the samples are at or below, 0 without
+    # samples. It is never more than the slowest sample
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = max(fraction * self.count, 1)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if bucket == len(RTT_BUCKETS):
+            return self.max
+        return min(RTT_BUCKETS[bucket], self.max)
+
+    # The buckets() method returns (upper bound, count) for every bucket with samples in it, the last bound is None
+    def buckets(self):
+        bounds = RTT_BUCKETS + (None,)
+        return [(bounds[bucket], count) for bucket, count in enumerate(self.counts) if count]
+
+
+# The Tracer class writes sampled per-packet events to a JSON-lines file, path '-' writes them to the screen: stdout,
+# or the screen given (sys.stderr where stdout is taken for something else)
+# Only packets whose sequence number is a multiple of every are traced, so every=1 traces everything
+class Tracer:
+    def __init__(self, path, every=1, screen=None):
+        self.path = path
+        self.every = max(every, 1)
+        self.f = (screen or sys.stdout) if path == "-" else open(path, "w")
+        self.origin = time.perf_counter()
+
+    # The event() method writes one event about packet seq_num if it is sampled, fields are added to the line
+    def event(self, event, seq_num, **fields):
+        if seq_num % self.every:
+            return
+        record = {"t": round(time.perf_counter() - self.origin, 6), "event": event, "seq": seq_num}
+        record.update(fields)
+        self.f.write(json.dumps(record) + "\n")
+
+    # The close() method flushes the trace and closes the file (but not the screen)
+    def close(self):
+        if self.path == "-":
+            self.f.flush()
+        else:
+            self.f.close()
+
+
+# The Metrics class is everything counted about one transfer, on either side. The client and server update the
+# counters as attributes, which is about as cheap as counting gets in Python, and only call the tracer (if there is
+# one) behind an 'if metrics.tracer is not None'. Read the counters directly or call snapshot() at any time
+class Metrics:
+    COUNTERS = ("packets_sent", "bytes_sent", "retransmissions", "resumed", "bytes_copied", "signature_bytes",
+                "parity_sent", "compressed", "bytes_saved", "acks_received", "packets_received", "bytes_received",
+                "duplicates", "out_of_order", "ignored", "parity_received", "fec_repaired", "acks_sent")
+
+    def __init__(self, tracer=None):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.rtt = RttHistogram()
+        self.tracer = tracer
+
+        self.filesize = 0
+        self.chunk_size = None
+        self.completed = False
+
+        # perf_counter() times of the start and end of the transfer
+        self.start_time = None
+        self.end_time = None
+
+    # The start() method marks the start of the transfer
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    # The finish() method marks the end of the transfer, completed tells whether the whole file got across
+    def finish(self, completed):
+        self.end_time = time.perf_counter()
+        self.completed = completed
+
+    # The elapsed() method is how long the transfer took, or has taken so far, in seconds
+    def elapsed(self):
+        if self.start_time is None:
+            return 0
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    # The goodput() method is how many bytes of the file got across per second, resent packets don't count
+    def goodput(self):
+        elapsed = self.elapsed()
+        return self.filesize / elapsed if self.completed and elapsed else 0
+
+    # The retransmission_ratio() method is the share of all data packets sent that were sent again
+    def retransmission_ratio(self):
+        return self.retransmissions / self.packets_sent if self.packets_sent else 0
+
+    # The snapshot() method returns every counter and what is computed from them as a dict, times in seconds
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.COUNTERS}
+        snapshot.update({
+            "filesize": self.filesize,
+            "chunk_size": self.chunk_size,
+            "completed": self.completed,
+            "elapsed": self.elapsed(),
+            "goodput": self.goodput(),
+            "retransmission_ratio": self.retransmission_ratio(),
+            "rtt_samples": self.rtt.count,
+            "rtt_mean": self.rtt.mean(),
+            "rtt_p50": self.rtt.percentile(0.5),
+            "rtt_p90": self.rtt.percentile(0.9),
+            "rtt_p99": self.rtt.percentile(0.99),
+        })
+        return snapshot
+
+    # The summary() method returns the report printed at the end of a transfer, counters that stayed 0 are left out
+    def summary(self):
+        lines = [f"{self.filesize} bytes in {self.elapsed():.3f}s, goodput {self.goodput() / 1000000:.2f} MB/s"]
+        counters = [f"{name.replace('_', ' ')}: {getattr(self, name)}" for name in self.COUNTERS if getattr(self, name)]
+        if counters:
+            lines.append(", ".join(counters))
+        if self.rtt.count:
+            lines.append(f"Round trip time: mean {self.rtt.mean() * 1000:.3f}ms, "
+                         f"p50 {self.rtt.percentile(0.5) * 1000:.3f}ms, p90 {self.rtt.percentile(0.9) * 1000:.3f}ms, "
+                         f"p99 {self.rtt.percentile(0.99) * 1000:.3f}ms, max {self.rtt.max * 1000:.3f}ms "
+                         f"({self.rtt.count} samples)")
+        return "\n".join(lines)
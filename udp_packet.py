@@ -0,0 +1,343 @@
+"""
+The packet format shared by the client and the server, and the functions that build and take apart packets without
+copying the image data around.
+
+`struct` - The `struct` module provides functions for working with structured binary data, such as data in a binary file
+or data sent over a network. A `struct.Struct` object compiles its format string once, so packing and unpacking with it
+doesn't parse the format again for every packet, and its `pack_into()` and `unpack_from()` methods work directly on an
+existing buffer instead of creating a new bytes object.
+
+`struct`: https://docs.python.org/3/library/struct.html
+
+--- Packet format ---
+
+Every packet starts with the same 8 byte header, all integers are big-endian (network order):
+
+    +--------------+--------------+-----------------+-----------------+
+    | type         | flags        | length          | sequence number |
+    | 1 byte (!B)  | 1 byte (!B)  | 2 bytes (!H)    | 4 bytes (!I)    |
+    +--------------+--------------+-----------------+-----------------+
+
+length is the number of bytes that follow the header, so a packet is always exactly 8 + length bytes long. The only
+header flags are `CHUNK_COMPRESSED` and `CHUNK_END` on a DATA packet, every other packet has flags 0.
+
+HELLO (client to server) starts a transfer. The sequence number is 0 and the body is the file size, the chunk size
+(image data per packet) the client would like to use, the stripe of the file the transfer carries, flags and the
+forward error correction it uses, padded with zeros to the chunk size:
+
+    +------------+------------+-------------+------------+------------+--------+-----------+------------+------------+
+    | file size  | chunk size | transfer id | offset     | length     | flags  | FEC group | FEC parity | zeros      |
+    | 8 bytes !Q | 2 bytes !H | 4 bytes !I  | 8 bytes !Q | 8 bytes !Q | 1 byte | 1 byte    | 1 byte     | chunk - 33 |
+    +------------+------------+-------------+------------+------------+--------+-----------+------------+------------+
+
+A plain transfer has transfer id 0 and carries the whole file, offset 0 and length file size. A striped transfer sends
+the file as several stripes at once, each from its own socket: every stripe is a transfer of its own with the same
+(random, non-zero) transfer id, which tells the server they all go into the same file, and carries the length bytes
+of the file at offset. The chunks and sequence numbers of a stripe count from the start of the stripe.
+
+With `FLAG_DELTA` the client would like to send a delta against the copy of the file the server already has (see
+`udp_delta.py`). With `FLAG_BATCH` the transfer is a batch of many files (see `udp_batch.py`), file size is the size
+of all of them together and the client sends the manifest of the batch in MANIFEST packets before any data. With
+`FLAG_STREAM` the transfer is a stream of a length nobody knows yet (see `udp_stream.py`), file size and length are 0.
+
+With a FEC parity count other than 0 the client sends that many PARITY packets for every FEC group chunks (see
+`udp_fec.py`), otherwise both are 0.
+
+The padding makes the HELLO exactly as big as a full data packet would be, so the HELLO is also the probe for whether
+datagrams of that size make it to the server at all. If the HELLO is dropped the client tries again with a smaller
+chunk size.
+
+HELLO_ACK (server to client) answers a HELLO with the chunk size the server accepted, which is never more than the
+client asked for, how many bytes of the file (or stripe) the server already has from an earlier attempt and how many
+blocks the signature of the server's copy of the file has if the transfer is a delta:
+
+    +-----------------+-----------------+-----------------+
+    | chunk size      | received        | basis blocks    |
+    | 2 bytes (!H)    | 8 bytes (!Q)    | 4 bytes (!I)    |
+    +-----------------+-----------------+-----------------+
+
+received is only ever more than 0 when the transfer has a transfer id, the server keeps the partial file and a
+bitmap of the chunks in it for those (see `udp_server.py`). The client then asks for that bitmap with STATE packets and
+only sends the chunks that are missing.
+
+STATE (both ways) carries the bitmap of the chunks the server has, in the same bit order as the SACK bitmap below but
+starting at chunk 1: the highest bit of bitmap byte 0 is chunk 1. The client asks for the bitmap bytes from sequence
+number on with an empty STATE, the server answers with a STATE with the same sequence number and as many bitmap
+bytes from there as fit in a packet of the chunk size. A lost request or answer is simply asked for again.
+
+SIGNATURE (both ways) is asked for and answered the same way, it carries the signature of the server's copy of the
+file for a delta transfer, `udp_delta.BLOCK.size` bytes per block.
+
+LITERAL and COPY (client to server) take the place of DATA in a delta transfer. The sequence numbers count the
+instructions of the delta, and every instruction says where in the file it goes. LITERAL carries length - 8 bytes of
+the file for offset, COPY tells the server to copy length bytes from basis offset in its own copy of the file to
+offset:
+
+    LITERAL                                    COPY
+    +-----------------+-----------------       +-----------------+-----------------+-----------------+
+    | offset          | data                   | offset          | basis offset    | length          |
+    | 8 bytes (!Q)    | length - 8 bytes       | 8 bytes (!Q)    | 8 bytes (!Q)    | 8 bytes (!Q)    |
+    +-----------------+-----------------       +-----------------+-----------------+-----------------+
+
+MANIFEST (both ways) carries the manifest of a batch to the server. The client sends the manifest in pieces, the
+sequence number is where the piece starts in the manifest and the body is the size of the whole manifest followed by
+the piece, so the server knows how much more is coming from whichever piece arrives first. The server answers every
+piece it took with an empty MANIFEST with the same sequence number, a piece without an answer is simply sent again:
+
+    +-----------------+-----------------
+    | manifest size   | piece
+    | 4 bytes (!I)    | length - 4 bytes
+    +-----------------+-----------------
+
+DATA (client to server) carries length bytes of the image data of chunk number sequence number (starting at 1), every
+chunk is chunk size bytes except for the last one. With `CHUNK_COMPRESSED` the data is the chunk compressed with zlib
+instead (see `udp_compress.py`) and length is its compressed size. The chunks of a stream are up to chunk size bytes,
+as much as the source had, and the stream ends with an empty chunk flagged `CHUNK_END`, which is ACKed and sent again
+like any other chunk.
+
+PARITY (client to server) carries chunk size bytes of parity data for a group of chunks, parity packet number
+sequence number % FEC parity of group number sequence number // FEC parity. Group g is chunks g * FEC group + 1 up to
+(g + 1) * FEC group, the last group of the file can be shorter. Parity packets are never ACKed or sent again.
+
+ACK (server to client) acknowledges many chunks at once. The sequence number is the cumulative acknowledgement, every
+chunk up to and including it has arrived, and the body is a selective acknowledgement (SACK) bitmap of the chunks
+after that which have arrived as well, length is the number of bitmap bytes (0 up to `MAX_SACK_BYTES`):
+
+    +-----------------+-----------------+-----
+    | bitmap byte 0   | bitmap byte 1   | ...
+    | 1 byte          | 1 byte          |
+    +-----------------+-----------------+-----
+
+The highest bit (0x80) of byte 0 is chunk sequence number + 2, the next bit chunk sequence number + 3 and so on. Chunk
+sequence number + 1 is never in the bitmap, it hasn't arrived or it would be part of the cumulative acknowledgement. The
+server doesn't answer every data packet, it sends an ACK once every few packets or after a short delay, and the client
+takes every chunk the ACK covers out of flight in one go.
+
+--- Buffers ---
+
+The client packs the header of a data packet into a small preallocated buffer with `pack_data()` and sends it
+together with a `memoryview` of the chunk in the memory-mapped file, so the image data is never copied in Python. Where
+the header and data have to be in one buffer, the data is read or copied into the payload area of a `bytearray` of
+`HEADER.size + chunk size` bytes (`payload_view()`) behind the header. The server receives into a preallocated buffer
+of `BUFFER_SIZE` bytes with `recvfrom_into()`, `unpack_header()` reads the header and `payload()` hands back a
+`memoryview` of the image data that can be written to the file as it is.
+
+"""
+
+import struct
+
+
+# Packet types
+TYPE_HELLO = 1
+TYPE_HELLO_ACK = 2
+TYPE_DATA = 3
+TYPE_ACK = 4
+TYPE_STATE = 5
+TYPE_SIGNATURE = 6
+TYPE_LITERAL = 7
+TYPE_COPY = 8
+TYPE_PARITY = 9
+TYPE_MANIFEST = 10
+
+# HELLO flags
+FLAG_DELTA = 0x01
+FLAG_BATCH = 0x02
+FLAG_STREAM = 0x04
+
+# Header flags
+CHUNK_COMPRESSED = 0x01
+CHUNK_END = 0x02
+
+# Precompiled structs for the header every packet starts with and the bodies of the HELLO, HELLO_ACK, LITERAL (in
+# front of the data), COPY and MANIFEST (in front of the piece)
+HEADER = struct.Struct('!BBHI')
+HELLO = struct.Struct('!QHIQQBBB')
+HELLO_ACK = struct.Struct('!HQI')
+LITERAL = struct.Struct('!Q')
+COPY = struct.Struct('!QQQ')
+MANIFEST = struct.Struct('!I')
+
+# The smallest chunk size is the 1024 bytes the protocol always used, the biggest is whatever still fits in one UDP
+# datagram over IPv4 (65535 - 20 bytes IP header - 8 bytes UDP header = 65507) after our own header
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 65507 - HEADER.size
+
+# The chunk sizes the client tries, biggest first: near 64 KB datagrams, 32 KB, 16 KB, a 9000 byte jumbo frame and
+# a standard 1500 byte Ethernet frame without IP fragmentation (minus 20 bytes IP, 8 bytes UDP and our 8 byte header),
+# and the original 1024 bytes
+CHUNK_SIZES = (MAX_CHUNK_SIZE, 32768, 16384, 9000 - 36, 1500 - 36, MIN_CHUNK_SIZE)
+
+# A buffer that can hold any packet
+BUFFER_SIZE = HEADER.size + MAX_CHUNK_SIZE
+
+# The most bytes of SACK bitmap in one ACK, 8 chunks per byte, and a buffer that can hold any ACK (or HELLO_ACK), the
+# client doesn't need a BUFFER_SIZE buffer for the replies it gets
+MAX_SACK_BYTES = 128
+ACK_BUFFER_SIZE = HEADER.size + MAX_SACK_BYTES
+
+# Turns the receiver's one byte per chunk (0 or 1) into the digits of a binary number, and back
+SACK_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+HAVE_BYTES = bytes.maketrans(b'01', b'\x00\x01')
+
+
+# The payload_view() method returns the part of a packet buffer the image data goes into, for readinto()
+def payload_view(buffer, chunk_size):
+    return memoryview(buffer)[HEADER.size:HEADER.size + chunk_size]
+
+
+# The pack_data() method writes the header in front of the length bytes of image data that are already in the buffer
+# and returns the size of the finished packet, flags is CHUNK_COMPRESSED for a compressed chunk
+def pack_data(buffer, seq_num, length, flags=0):
+    HEADER.pack_into(buffer, 0, TYPE_DATA, flags, length, seq_num)
+    return HEADER.size + length
+
+
+# The pack_parity() method writes the header of parity packet seq_num in front of the chunk_size bytes of parity data
+# and returns the size of the header, the parity data is sent behind it like the data of a chunk
+def pack_parity(buffer, seq_num, chunk_size):
+    HEADER.pack_into(buffer, 0, TYPE_PARITY, 0, chunk_size, seq_num)
+    return HEADER.size
+
+
+# The unpack_header() method reads the header of a received packet, the first nbytes of buffer, and returns
+# (type, length, sequence number), or None if the packet is cut short or doesn't match its own length. The flags are
+# left out, only a DATA packet has any and header_flags() reads them
+def unpack_header(buffer, nbytes):
+    if nbytes < HEADER.size:
+        return None
+    packet_type, flags, length, seq_num = HEADER.unpack_from(buffer, 0)
+    if HEADER.size + length != nbytes:
+        return None
+    return packet_type, length, seq_num
+
+
+# The header_flags() method returns the flags in the header of a received packet
+def header_flags(buffer):
+    return buffer[1]
+
+
+# The payload() method returns a memoryview of the length bytes behind the header of a received packet
+def payload(view, length):
+    return view[HEADER.size:HEADER.size + length]
+
+
+# The pack_hello() method writes a HELLO for a file of filesize bytes into buffer (at least HEADER.size + chunk_size
+# bytes) and returns its size, the padding is zeroed since the buffer may hold an earlier, bigger HELLO
+# A stripe of a striped transfer passes its transfer_id and the offset and length of the stripe, the whole file
+# otherwise, flags are the FLAG_ values and fec is (group size, parity count) of the forward error correction or None
+def pack_hello(buffer, filesize, chunk_size, transfer_id=0, offset=0, length=None, flags=0, fec=None):
+    if length is None:
+        length = filesize - offset
+    fec_group, fec_parity = fec or (0, 0)
+    HEADER.pack_into(buffer, 0, TYPE_HELLO, 0, chunk_size, 0)
+    HELLO.pack_into(buffer, HEADER.size, filesize, chunk_size, transfer_id, offset, length, flags, fec_group,
+                    fec_parity)
+    buffer[HEADER.size + HELLO.size:HEADER.size + chunk_size] = bytes(chunk_size - HELLO.size)
+    return HEADER.size + chunk_size
+
+
+# The unpack_hello() method returns (file size, chunk size, transfer id, offset, length, flags, FEC group, FEC parity)
+# from a received HELLO
+def unpack_hello(buffer):
+    return HELLO.unpack_from(buffer, HEADER.size)
+
+
+# The pack_hello_ack() method writes the HELLO_ACK for chunk_size into buffer and returns its size, received is how
+# many bytes the server already has and basis_blocks how many blocks the signature for a delta has
+def pack_hello_ack(buffer, chunk_size, received=0, basis_blocks=0):
+    HEADER.pack_into(buffer, 0, TYPE_HELLO_ACK, 0, HELLO_ACK.size, 0)
+    HELLO_ACK.pack_into(buffer, HEADER.size, chunk_size, received, basis_blocks)
+    return HEADER.size + HELLO_ACK.size
+
+
+# The unpack_hello_ack() method returns (chunk size, received, basis blocks) from a received HELLO_ACK
+def unpack_hello_ack(buffer):
+    return HELLO_ACK.unpack_from(buffer, HEADER.size)
+
+
+# The pack_bitmap() method turns have, one byte per chunk (0 or 1), into a bitmap of one bit per chunk, the highest
+# bit of the first byte is the first chunk. Like in pack_ack() the loop over the chunks runs in C
+def pack_bitmap(have):
+    length = (len(have) + 7) // 8
+    if not length:
+        return b''
+    return int(have.translate(SACK_DIGITS).ljust(length * 8, b'0'), 2).to_bytes(length, 'big')
+
+
+# The unpack_bitmap() method turns a bitmap back into one byte per chunk for count chunks, chunks the bitmap is too
+# short for are missing
+def unpack_bitmap(bitmap, count):
+    digits = format(int.from_bytes(bitmap, 'big'), f'0{len(bitmap) * 8}b').encode()[:count] if bitmap else b''
+    return bytearray(digits.translate(HAVE_BYTES)).ljust(count, b'\x00')
+
+
+# The pack_request() method writes the STATE or SIGNATURE (packet_type) asking for the bytes from offset on, or the
+# MANIFEST answering the piece at offset, and returns its size
+def pack_request(buffer, packet_type, offset):
+    HEADER.pack_into(buffer, 0, packet_type, 0, 0, offset)
+    return HEADER.size
+
+
+# The pack_piece() method writes the STATE or SIGNATURE answering the request for offset with the bytes piece and
+# returns its size, buffer has to have room for HEADER.size + len(piece) bytes
+def pack_piece(buffer, packet_type, offset, piece):
+    HEADER.pack_into(buffer, 0, packet_type, 0, len(piece), offset)
+    buffer[HEADER.size:HEADER.size + len(piece)] = piece
+    return HEADER.size + len(piece)
+
+
+# The pack_manifest_piece() method writes the MANIFEST with the bytes piece from offset of a manifest of
+# manifest_size bytes and returns its size. The server answers it with pack_request(buffer, TYPE_MANIFEST, offset)
+def pack_manifest_piece(buffer, offset, manifest_size, piece):
+    HEADER.pack_into(buffer, 0, TYPE_MANIFEST, 0, MANIFEST.size + len(piece), offset)
+    MANIFEST.pack_into(buffer, HEADER.size, manifest_size)
+    buffer[HEADER.size + MANIFEST.size:HEADER.size + MANIFEST.size + len(piece)] = piece
+    return HEADER.size + MANIFEST.size + len(piece)
+
+
+# The delta_block_size() method is the block size of a delta for chunk_size, a whole block of literal data fits in a
+# LITERAL of chunk_size bytes
+def delta_block_size(chunk_size):
+    return chunk_size - LITERAL.size
+
+
+# The pack_literal() method writes the header and the offset of instruction seq_num, a LITERAL of length bytes of
+# the file, and returns how many bytes that is, the data goes behind them like for pack_data()
+def pack_literal(buffer, seq_num, offset, length):
+    HEADER.pack_into(buffer, 0, TYPE_LITERAL, 0, LITERAL.size + length, seq_num)
+    LITERAL.pack_into(buffer, HEADER.size, offset)
+    return HEADER.size + LITERAL.size
+
+
+# The pack_copy() method writes instruction seq_num, a COPY of length bytes from basis_offset to offset, and returns
+# its size
+def pack_copy(buffer, seq_num, offset, basis_offset, length):
+    HEADER.pack_into(buffer, 0, TYPE_COPY, 0, COPY.size, seq_num)
+    COPY.pack_into(buffer, HEADER.size, offset, basis_offset, length)
+    return HEADER.size + COPY.size
+
+
+# The pack_ack() method writes an ACK into buffer (at least ACK_BUFFER_SIZE bytes) and returns its size. cumulative is
+# the highest chunk with every chunk up to it received, have is one byte per chunk (have[seq - first] is set once chunk
+# seq has arrived, first is 1 unless have only starts further on) and highest is the highest chunk received, the bitmap
+# covers the chunks in between
+# The bitmap is built by pack_bitmap(), turning the bytes of have into '0' and '1' digits and reading them as one
+# binary number, so the loop over the chunks runs in C instead of Python
+def pack_ack(buffer, cumulative, have, highest, first=1):
+    bits = min(max(highest - cumulative - 1, 0), MAX_SACK_BYTES * 8)
+    length = (bits + 7) // 8
+    HEADER.pack_into(buffer, 0, TYPE_ACK, 0, length, cumulative)
+    if length:
+        # have[cumulative + 2 - first] is chunk cumulative + 2, the first chunk in the bitmap
+        start = cumulative + 2 - first
+        buffer[HEADER.size:HEADER.size + length] = pack_bitmap(have[start:start + bits])
+    return HEADER.size + length
+
+
+# The acknowledges() method tells whether an ACK with the cumulative acknowledgement cumulative and the SACK bitmap
+# bitmap (its payload()) covers chunk seq_num
+def acknowledges(cumulative, bitmap, seq_num):
+    if seq_num <= cumulative:
+        return True
+    bit = seq_num - cumulative - 2
+    return 0 <= bit < len(bitmap) * 8 and bitmap[bit >> 3] & (0x80 >> (bit & 7)) != 0
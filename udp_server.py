@@ -6,139 +6,1347 @@ Author: Alexander Michalak
 The `socket` module provides low-level network functionality, while the `struct` module performs conversions between
 Python values and C structs.
 
+`os` - The `os` module provides a way of interacting with the operating system. It is used to reserve the space for
+the output file and to write every chunk at its own offset in the file.
+
+`os`: https://docs.python.org/3/library/os.html
+
+`argparse` - The `argparse` module makes it easy to write user-friendly command-line interfaces. It is used to take the
+address to listen on from the command line, so the server can be run from a script.
+
+`argparse`: https://docs.python.org/3/library/argparse.html
+
+`asyncio` - The `asyncio` module is a library to write concurrent code using the async/await syntax. `receive_stream()`
+hands the data of a stream to a coroutine, with the server running in the event loop's executor.
+
+`asyncio`: https://docs.python.org/3/library/asyncio.html
+
+`multiprocessing` - The `multiprocessing` module supports spawning processes. With `--workers` every port the server
+listens on is served by a process of its own, so the stripes of a striped transfer are received on several cores.
+
+`multiprocessing`: https://docs.python.org/3/library/multiprocessing.html
+
+`selectors` - The `selectors` module allows high-level and efficient I/O multiplexing, built upon the `select` module
+primitives. It is used to wait for datagrams from many clients on one socket without blocking on any one of them.
+
+`selectors`: https://docs.python.org/3/library/selectors.html
+
 `socket` - The `socket` module provides a low-level interface for network communication. It provides functions for
 creating and manipulating sockets, which are the endpoints of a two-way communication link between two programs running
 on a network. The `socket` module is used to create network connection,s send a receive data over the network, and more.
 
 `socket`: https://docs.python.org/3/library/socket.html
 
-`struct` - The `struct` module provides functions for working with structured binary data, such as data in a binary file
-or data sent over a network. It provides functions for packing and unpacking data into and from byte strings, and for
-working with different byte orders and data types. The `struct` module is used to convert data between Python objects
-and binary data.
+`struct` - The `struct` module performs conversions between Python values and C structs. It packs the header of the
+state file a resumable transfer keeps next to its partial file.
 
 `struct`: https://docs.python.org/3/library/struct.html
 
+`udp_batch` - The `udp_batch` module is the manifest of a batch of files sent in one transfer, and where every chunk
+of the batch goes in which file.
+
+`udp_compress` - The `udp_compress` module decompresses the chunks the client sent compressed, checking that every one
+of them decompresses to exactly the chunk it stands for.
+
+`udp_delta` - The `udp_delta` module computes the signature of the server's copy of a file that a client sending a
+delta needs, and keeps the signatures of files that didn't change in a `HashCache`.
+
+`udp_fec` - The `udp_fec` module is the forward error correction code, it rebuilds chunks that were lost from the
+parity packets the client sends along with them.
+
+`udp_metrics` - The `udp_metrics` module counts what happens during a transfer (packets, bytes, retransmissions,
+duplicates, round trip times) instead of printing every packet, and writes a sampled per-packet trace when asked to.
+
+`udp_packet` - The `udp_packet` module is the packet format shared by the client and the server. It uses precompiled
+`struct.Struct` objects to pack and unpack the packet header in place, so packets are received with `recvfrom_into()`
+into buffers that are reused for every packet instead of creating new bytes objects.
+
+`udp_stream` - The `udp_stream` module delivers the chunks of a stream of unknown length in order, to a callback, a
+writable or a `StreamReader` a coroutine reads with `async for`.
+
+`threading` - The `threading` module constructs higher-level threading interfaces. The signature of the basis of a
+delta is hashed in a thread of its own, while the server goes on with the other clients.
+
+`threading`: https://docs.python.org/3/library/threading.html
+
+`time` - The `time` module provides functions for working with time. It is used to measure how long the server has
+been lingering after a transfer and how long each client has been quiet.
+
+`time`: https://docs.python.org/3/library/time.html
+
 --- Behavior --- Top to bottom explaination
 
-1.  The code imports two modules: `socket` and `struct`.
-2.  The code defines a constant variable `BUFFER_SIZE` with a value of 1032. This value will be used as the size of the
-    buffer for receiving data over the network.
-3.  The code defines a function `receive_image()` that takes one argument, `sock`, which is a socket object. The function
-    receives an image data from a client, unpacks it and writes it to a file.
-4.  The `receive_image()` function first receives the size of the image data from the client using the `recvfrom()`
-    method on the socket object `sock`. It then converts the data to an integer using the `decode()` method.
-5.  The function then opens a new file in binary write mode with the name "test2.jpg" using the `open()` method.
-6.  The function uses a while loop to receive packets of data from the client. It receives a packet using the
-    `recvfrom()` method on the sock object and unpacks it using the `struct.unpack()` method, which returns a tuple
-    containing the sequence number, data, and file size.
-7.  The function checks if the sequence number of the packet matches the expected sequence number, and if it does not
-    match, it ignores the packet and continues waiting for the next packet.
-8.  If the sequence number matches the expected sequence number, the function writes the data from the packet to the
-    file using the `write()` method.
-9.  The function sends an acknowledgement packet to the client with the sequence number of the packet using the
-    `sendto()` method on the `sock` object.
-10. The function increments the sequence number by 1 and checks if it has received all the data by comparing the
-    current position of the file pointer with the total size of the image data. If it has received all the data, the
-    function breaks out of the while loop.
-11. The function prints a message indicating that the file has been received successfully.
-12. The code defines a main function that sets up the server parameters, accepts user input to set up the server IP and
-    port, creates a UDP socket, binds the socket to the server address and port, and calls the `receive_image()` function
-    to receive the image data.
-13. Finally, the main function closes the socket and prints a message indicating that the server socket has been closed.
-14. The code checks if the file is being run directly using the `__name__` variable, and if it is, it calls the
-    main function. This is to have the program/script resemble C or C++ code.
+1.  The code imports sixteen modules: `argparse`, `asyncio`, `multiprocessing`, `os`, `selectors`, `socket`, `struct`,
+    `threading`, `time`, `udp_batch`, `udp_compress`, `udp_delta`, `udp_fec`, `udp_metrics`, `udp_packet` and
+    `udp_stream`.
+2.  The code defines a constant variable `BUFFER_SIZE` big enough for the biggest packet. This value will be used as the
+    size of the buffer for receiving data over the network. `MAX_CHUNK_SIZE` is the most image data per packet the
+    server accepts, `LINGER` is how long it keeps answering after a file is complete, `SESSION_TIMEOUT` is how long a
+    client can go quiet before its transfer is dropped, `RECEIVE_BUFFER_SIZE` is the socket buffer asked for and
+    `ACK_EVERY` and `ACK_DELAY` are how many chunks or how long an ACK waits at most. `STATE` is the header of the state
+    file of a resumable transfer and `COPY_BUFFER_SIZE` how much of the old copy of a file a delta copies at a time
+    without `os.copy_file_range()`. `STREAM_WINDOW` is how far ahead of the next chunk of a stream chunks are taken.
+3.  The `enlarge_receive_buffer()` function asks the operating system for the bigger socket receive buffer, and the
+    `send_reply()` function sends a reply without waiting for the socket.
+4.  The `preallocate()` function makes the output file its full size before anything is written, with
+    `os.posix_fallocate()` where available, and the `write_at()` function writes data at an offset in the file with
+    `os.pwrite()` (or a seek and write on Windows), which `read_at()` reads back. `open_shared()` opens the file the
+    stripes of a striped transfer all write into without truncating it, and `copy_range()` copies part of one file
+    into another, inside the kernel with `os.copy_file_range()` where available.
+5.  The `session_filename()` function picks the output filename for a client from its address, or for a striped transfer
+    from its transfer id, `state_filename()` the name of the state file next to it and `delta_filename()` the name of
+    the new file a delta is written to.
+6.  The `ReceiveSession` class holds the state of one client's transfer: the output file, the expected size, the chunk
+    size and which chunks have been written, one byte per chunk. A session of one stripe of a striped transfer only
+    receives its own byte range of the file, at the offset the HELLO gave. A session of a transfer with a transfer id
+    keeps a bitmap of the chunks in the file in a state file next to it (`open_state()`), which a later session of the
+    same transfer picks up, so a client that lost its connection only has to send what is missing. A session of a delta
+    opens the copy of the file the server already has as its basis (`open_basis()`), with its signature from a
+    `udp_delta.HashCache` that is hashed in a thread of its own while the server goes on with the other clients, and
+    writes the new version of the file next to it. A session of a batch receives many files
+    into a directory of their own: its `handle_manifest()` method puts the manifest together from the MANIFEST pieces
+    the client sends and `open_batch()` lays out the files one after the other, `write_chunk()` then writes every part
+    of a chunk into the file it belongs to (opened by `batch_file()` when its first part arrives). A session of a
+    stream doesn't know its size until the empty chunk flagged `CHUNK_END` at its end arrives, and delivers its chunks
+    in order to a sink from `udp_stream.sink()` instead of writing them at their offsets.
+7.  Its `hello_ack()` method returns the HELLO_ACK with the chunk size the session uses and how many bytes it already
+    has, and for a delta how many blocks the signature of the basis has. Its `piece()` method returns a piece of the
+    bitmap for a client that asks for it with a STATE, or of the signature for a client that asks with a SIGNATURE.
+8.  Its `handle_data()` method takes the sequence number and data of a data packet. Packets that aren't a chunk of the
+    file, or don't have the right length for it, are ignored. Chunks that were already written are ACKed again right
+    away. Any other chunk is written straight from the receive buffer to its own offset in the file with `write_at()`,
+    so chunks can arrive in any order and nothing is kept in memory, a compressed chunk once it is decompressed with
+    `udp_compress.decompress()`. The byte of the state file's bitmap the chunk is in is written right after it. The
+    packets of a delta are instructions instead (`instruction()`): the data of a LITERAL is written at the offset it
+    carries and a COPY is copied over from the basis with `copy_range()`. The method returns the ACK for the caller to
+    send once `ACK_EVERY` chunks have arrived since the last one, otherwise the ACK is delayed by up to `ACK_DELAY`
+    seconds and the caller sends it when `ack_due()` says so. The chunks of a stream go to `handle_stream()` instead,
+    which hands the next chunk to the sink straight from the receive buffer and keeps the chunks that arrive ahead of
+    it (no further than `STREAM_WINDOW`) until the chunks in front of them are there.
+9.  With forward error correction its `handle_parity()` method keeps the PARITY packets of every group of chunks until
+    the group is complete, and `repair()` rebuilds the chunks of the group that were lost with `udp_fec.FecCode` as
+    soon as there is as much parity as there are chunks missing, from the chunks read back from the file, so those
+    chunks don't have to wait for the client to time out and send them again.
+10. Its `ack()` method packs the ACK with `udp_packet.pack_ack()`: the cumulative acknowledgement, the chunk in front of
+    the oldest chunk that hasn't arrived, and a SACK bitmap of the chunks that arrived after it, so one ACK covers every
+    chunk the session has.
+11. Once the number of bytes written reaches the expected size, `finish()` closes the file and prints a message
+    indicating that the file has been received successfully, and removes the state file (or replaces the basis with the
+    new file of a delta), followed by the summary of the session's `udp_metrics.Metrics`. Nothing is printed for the
+    packets themselves, they are counted (received, duplicates, out of order, ignored, ACKs sent) and only written out
+    by a `udp_metrics.Tracer` if there is one.
+12. The `handle_datagram()` function unpacks the header of every received datagram using `udp_packet.unpack_header()`,
+    which returns a tuple containing the packet type, the length of the data and the sequence number. A HELLO starts a
+    session for the client with the file size and the chunk size it asked for (never more than `MAX_CHUNK_SIZE`) and is
+    answered with a HELLO_ACK, a data packet, LITERAL or COPY is handed to the session of the client address it came
+    from, and so are PARITY and MANIFEST packets and STATE and SIGNATURE requests. The files of a batch go into a
+    directory named after the file `filename_for` gives the client, a stream goes to what `stream_for` returns for the
+    client or, without it, into that file. The work is done by `dispatch_datagram()`, a file that can't be created or
+    written (`OSError`) only closes and forgets the session of its client.
+13. The `receive_image()` function takes a socket object, and optionally the output filename and largest chunk size, and
+    receives exactly one file from the first client that sends a HELLO. Every datagram is received with
+    `recvfrom_into()` into one reused buffer. After the file is complete it keeps ACKing packets the client sends again
+    for `LINGER` seconds, in case the last ACKs were lost. Delayed ACKs are sent once they are due by waiting for the
+    next datagram no longer than that. With `stream` it delivers a stream to it instead of writing a file, which is
+    what `receive_stream()` does for a coroutine: an async generator of the data of one stream.
+14. The `serve()` function receives files from any number of clients at the same time. A `selectors` loop reads every
+    datagram that arrives on the socket and hands it to `handle_datagram()` with the sessions of all clients, then sends
+    the delayed ACKs that are due. Finished sessions are forgotten after `LINGER` seconds and sessions whose client went
+    quiet after `SESSION_TIMEOUT` seconds.
+15. The code defines a main function that sets up the server parameters, reads the server IP and port from the command
+    line with `argparse` or accepts user input to set them up, creates a UDP socket, binds the socket to the server
+    address and port, and calls the `serve()` function to receive image data from clients until Ctrl+C is pressed.
+    `--hash-cache` keeps the signatures of the files received in a file across runs.
+16. With `--workers N` the main function binds N sockets on consecutive ports and calls `serve_workers()` instead, which
+    runs `serve()` on every socket in a worker process of its own (`serve_worker()`), so the stripes of a striped
+    transfer are received on as many cores as there are workers.
+17. Finally, the main function closes the sockets and prints a message indicating that the server socket has been
+    closed.
+18. The code checks if the file is being run directly using the `__name__` variable, and if it is, it calls the main
+    function. This is to have the program/script resemble C or C++ code.
 
 """
 
+import argparse
+import asyncio
+import multiprocessing
+import os
+import selectors
 import socket
 import struct
+import threading
+import time
+
+import udp_batch
+import udp_compress
+import udp_delta
+import udp_fec
+import udp_metrics
+import udp_packet
+import udp_stream
+
+
+# Define the buffer size, big enough for the biggest packet any client may ask for in its HELLO
+BUFFER_SIZE = udp_packet.BUFFER_SIZE
+
+# The biggest chunk size (image data per packet) the server accepts, clients asking for more are told to use this
+MAX_CHUNK_SIZE = udp_packet.MAX_CHUNK_SIZE
+
+# How long the server keeps answering after the last packet was written, the last ACKs could be lost
+# and without this the client would be left retrying packets nobody is listening for anymore
+LINGER = 2
+
+# How long a client can go quiet in the middle of a transfer before the server gives up on it, in seconds
+SESSION_TIMEOUT = 30
+
+# Size of the socket receive buffer asked for, every client can have a full window in flight at once and anything that
+# doesn't fit in the buffer is dropped by the operating system
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Delayed ACKs: one ACK covers every chunk received so far, so the server only sends one once ACK_EVERY new chunks have
+# arrived or ACK_DELAY seconds (1000 microseconds) after the first chunk it hasn't ACKed yet, whichever comes first
+# The delay has to stay well below the client's smallest retransmission timeout or the client resends for nothing
+ACK_EVERY = 8
+ACK_DELAY = 0.001
+
+# The header of the state file kept next to the partial file of a transfer with a transfer id: a magic number, the file
+# size, the chunk size and the offset and length of the stripe, followed by the bitmap of the chunks in the file
+STATE = struct.Struct('!4sQHQQ')
+STATE_MAGIC = b'UDPS'
+
+# The most bytes (1 MB) copied from the old copy of a file in one go where os.copy_file_range() can't do it
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# How far past the next chunk to deliver the chunks of a stream are taken, as far as the SACK bitmap of an ACK reaches.
+# Only the chunks in between are ever held in memory, the client has no more than its window in flight anyway
+STREAM_WINDOW = udp_packet.MAX_SACK_BYTES * 8
+
+
+# The enlarge_receive_buffer() method asks for a RECEIVE_BUFFER_SIZE socket receive buffer, with big chunk sizes even
+# one client's window is more than the default buffer holds
+def enlarge_receive_buffer(sock):
+    # The operating system may cap this, whatever it gives is still better than the default
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    except OSError:
+        pass
+
+
+# The preallocate() method makes the file f the full size of the transfer before anything is written to it, so the
+# chunks can be written at their offsets in any order and running out of disk space shows up right away instead of
+# halfway through. posix_fallocate() reserves the disk blocks where the system has it, otherwise the file is only
+# extended (the operating system fills it in as the chunks are written). A size the file can't have (bigger than the
+# file system allows) raises OSError from truncate(), the caller drops the transfer then
+def preallocate(f, filesize):
+    if filesize and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, filesize)
+        except OSError:
+            # Not every file system supports it
+            pass
+
+    # The file of a transfer with a transfer id is opened as it is: it may be an older, bigger version of the file or
+    # already hold what other stripes of a striped transfer wrote. Either way it is set to exactly filesize, which cuts
+    # off whatever is past the end and keeps everything before it
+    if f.seek(0, os.SEEK_END) != filesize:
+        f.truncate(filesize)
+
+
+# The open_shared() method opens the file every stripe of a striped transfer writes into, without truncating it, so
+# the sessions of the stripes (in this process or in another worker) can each open it and write their own part
+def open_shared(filename):
+    return os.fdopen(os.open(filename, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666), "r+b",
+                     buffering=0)
+
+
+# The write_at() method writes data to the file f at offset, pwrite() does that in one system call without moving the
+# file position, Windows doesn't have it so there the position is moved first
+def write_at(f, data, offset):
+    if hasattr(os, "pwrite"):
+        os.pwrite(f.fileno(), data, offset)
+    else:
+        f.seek(offset)
+        f.write(data)
+
+
+# The read_at() method reads length bytes at offset of the file f back, with pread() like write_at() where there is one
+def read_at(f, length, offset):
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), length, offset)
+    f.seek(offset)
+    return f.read(length)
+
+
+# The copy_range() method copies length bytes at source_offset of the file source to offset in the file f, inside the
+# kernel with os.copy_file_range() where the system has it, otherwise COPY_BUFFER_SIZE bytes at a time
+def copy_range(source, f, offset, source_offset, length):
+    while length > 0:
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(source.fileno(), f.fileno(), length, source_offset, offset)
+            except OSError:
+                # Not every file system supports it
+                pass
+        if not copied:
+            source.seek(source_offset)
+            data = source.read(min(length, COPY_BUFFER_SIZE))
+            if not data:
+                return
+            write_at(f, data, offset)
+            copied = len(data)
+        offset += copied
+        source_offset += copied
+        length -= copied
+
+
+# The send_reply() method sends a reply without waiting, if the socket buffer is full the reply is dropped and the
+# client will send its packet again and get another chance at the reply
+def send_reply(sock, reply, client_address):
+    try:
+        sock.sendto(reply, client_address)
+    except (BlockingIOError, ConnectionResetError):
+        pass
+
+
+# The state_filename() method is the name of the state file kept next to filename for the stripe starting at offset
+def state_filename(filename, offset):
+    return f"{filename}.{offset}.state"
+
+
+# The delta_filename() method is the name of the file a delta is written to before it replaces filename
+def delta_filename(filename):
+    return f"{filename}.delta"
+
+
+# The session_filename() method picks the name a client's file is written to when more than one client is served,
+# 'test2.jpg' as per the requirements for the project with the client address added so clients don't overwrite
+# each other. The stripes of a striped transfer come from different ports, so their file is named after the transfer id
+def session_filename(client_address, transfer_id=0):
+    if transfer_id:
+        return f"test2_{client_address[0]}_{transfer_id:08x}.jpg"
+    return f"test2_{client_address[0]}_{client_address[1]}.jpg"
+
+
+# The ReceiveSession class is everything the server has to remember about one client's transfer: where the file is
+# being written, how big it will be, how big the chunks are and which chunks it already has. The server keeps one of
+# these per client address
+# The output file is created at its full size right away and every chunk is written straight to its own place in the
+# file, chunk seq_num at (seq_num - 1) * chunk_size, so chunks can be written in whatever order they arrive and
+# nothing has to be held in memory waiting for the chunks in front of it
+# Chunks are not ACKed one by one: the ACK says which chunks the session has (see udp_packet.pack_ack()) and is only
+# sent every ack_every chunks or ack_delay seconds, the caller checks ack_due() to send the ones that waited long enough
+# Nothing is printed per packet, what happens is counted in metrics (a udp_metrics.Metrics) and summed up at the end
+# A session of one stripe of a striped transfer (transfer_id isn't 0) only receives the length bytes at offset of the
+# file, its chunks count from the start of the stripe, and shares the file with the sessions of the other stripes
+# Every transfer with a transfer id can be resumed: which chunks are in the file is kept in a state file next to it
+# (state_filename()), one bit per chunk, which is updated as every chunk is written and removed once the file is
+# complete. A new session for the same file and stripe picks up where the state file left off, with the chunk size
+# the chunks were written with, and tells the client how much it already has in the HELLO_ACK and which chunks with
+# piece()
+# A transfer of the whole file with a transfer id can be a delta (delta is set), if the server already has a copy of
+# the file (the basis) and it isn't the partial file of a transfer that can be resumed: the client is told how many
+# blocks the signature of the basis has (see udp_delta) and sends the file as LITERAL and COPY instructions instead of
+# chunks. They are written into a new file next to the basis (delta_filename()) that replaces the basis once it is
+# complete, so the basis is never half overwritten. The signatures come from hash_cache, udp_delta.default_cache
+# unless another one is given
+# With fec, (group size, parity count) from the HELLO, the client sends parity packets for every group of chunks (see
+# udp_fec) and lost chunks of a group are rebuilt from them (repair()) as soon as enough of its parity has arrived, read
+# back from the file the chunks that did arrive were written to. A delta has no groups of chunks and never uses FEC
+# A session of a batch (batch is set) receives many files, filesize bytes of them together, into the directory
+# filename. It has no chunks until the manifest with their names and sizes has arrived (handle_manifest()), then the
+# files follow each other like the parts of one file (see udp_batch) and a chunk is written into every file it has a
+# part of (write_chunk()). Every file is created when its first part arrives and closed when its last one does, so only
+# the files the window is in are open at once
+# A session of a stream (stream is set) doesn't know how long it will be. It delivers every chunk to sink (a callback,
+# a writable or a udp_stream.StreamReader, see udp_stream.sink()), or writes it to the file filename without one, in
+# order as soon as every chunk in front of it is delivered (handle_stream()). Chunks that arrive ahead of a lost one
+# wait in memory, at most STREAM_WINDOW of them, and the stream is done once the chunk flagged CHUNK_END is delivered
+class ReceiveSession:
+    def __init__(self, client_address, filesize, chunk_size, filename, ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 metrics=None, transfer_id=0, offset=0, length=None, delta=False, hash_cache=None, fec=None,
+                 batch=False, stream=False, sink=None):
+        self.client_address = client_address
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.filename = filename
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.transfer_id = transfer_id
+        self.offset = offset
+        self.length = filesize - offset if length is None else length
+
+        self.metrics = metrics if metrics is not None else udp_metrics.Metrics()
+        self.metrics.filesize = self.length
+        self.metrics.chunk_size = chunk_size
+        self.metrics.start()
+        self.tracer = self.metrics.tracer
+
+        # The basis of a delta and the signature of it the client asks for
+        self.basis = None
+        self.basis_size = 0
+        self.signature = b''
+        self.signature_size = 0
+        if delta and transfer_id and 0 < self.length == filesize and not os.path.exists(state_filename(filename, 0)):
+            self.open_basis(hash_cache if hash_cache is not None else udp_delta.default_cache)
+
+        # Open a new file to write the image data to and make it the size of the finished file, a stripe opens the
+        # file of its transfer as it is and a delta writes a new file next to the basis. The chunks are read back from
+        # the file to rebuild lost ones with FEC. A batch opens its files as their chunks arrive, a stream without a
+        # sink is written to its file from start to end, in order
+        if batch:
+            self.f = None
+        elif stream:
+            self.f = open(filename, "wb") if sink is None else None
+        elif self.basis is not None:
+            self.f = open(delta_filename(filename), "wb", buffering=0)
+        else:
+            self.f = open_shared(filename) if transfer_id else open(filename, "w+b", buffering=0)
+        if self.f is not None and not stream:
+            try:
+                preallocate(self.f, filesize)
+            except OSError:
+                # A file of this size can't be made here, the HELLO isn't answered and handle_datagram() drops the
+                # client
+                self.f.close()
+                if self.basis is not None:
+                    self.basis.close()
+                raise
+
+        # One byte per chunk, set once the chunk is in the file
+        # The client decides how many instructions a delta has, every one of them covers at least one byte and every
+        # COPY a whole block, so there can't be more than three per block
+        self.chunk_count = -(-self.length // chunk_size)
+        if self.basis is not None:
+            self.chunk_count = 3 * -(-self.length // udp_packet.delta_block_size(chunk_size)) + 1
+        if batch:
+            self.chunk_count = 0
+        self.have = bytearray(self.chunk_count)
+        self.received = 0
+
+        # Since receiving, seq_num starts at 1 as it is expecting 1 from the client
+        # seq_num is always the oldest chunk that has not been written yet, highest the newest chunk that has
+        self.seq_num = 1
+        self.highest = 0
+
+        # The state file of a resumable transfer, and the bitmap in it
+        self.state_file = None
+        self.bitmap = None
+        self.piece_buffer = None
+        if transfer_id and self.basis is None and not batch:
+            self.open_state()
+
+        # The pieces of the manifest of a batch that have arrived, {offset: piece}, and once all of them have the name
+        # and size of every file, where every file starts in the batch, the open files (None for the ones that aren't)
+        # and how many bytes every file is still missing
+        self.batch = batch
+        self.manifest_pieces = {}
+        self.entries = None
+        self.sizes = []
+        self.offsets = []
+        self.files = []
+        self.created = set()
+        self.directories = set()
+        self.remaining = []
+
+        # What the chunks of a stream are delivered to, the chunks that arrived ahead of the next one to deliver,
+        # {seq_num: data}, and the chunk flagged CHUNK_END once it has arrived
+        self.sink = None
+        if stream:
+            self.sink = udp_stream.sink(self.f if sink is None else sink)
+        self.pending = {}
+        self.end = None
+
+        # The FEC code and the parity packets of every group that still has chunks missing, {group: {number: data}}
+        self.fec = None
+        self.parity = {}
+        if fec and self.basis is None and not stream:
+            try:
+                self.fec = udp_fec.FecCode(*fec)
+            except ValueError as error:
+                print(f"Not using FEC: {error}")
+
+        # How many chunks arrived since the last ACK and when the ACK for them is due, None if there is nothing to ACK
+        self.unacked = 0
+        self.ack_deadline = None
+
+        # The replies are packed into the same small buffer every time
+        self.reply_buffer = bytearray(udp_packet.ACK_BUFFER_SIZE)
+        self.reply_view = memoryview(self.reply_buffer)
+
+        # Used to time out clients that went away and to know when to stop lingering
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.completed = None
+
+        # An empty file (or stripe), or one the earlier attempts already finished, is complete before a single packet
+        # arrives. A batch isn't complete before its manifest is there, it may still have empty files to create, and a
+        # stream not before its end
+        if self.received >= self.length and not batch and not stream:
+            self.finish()
+
+    # The open_state() method opens the state file, if the one already there is for the same file and stripe the
+    # chunks it says are in the file are taken over, otherwise it is started over with no chunks
+    def open_state(self):
+        filename = state_filename(self.filename, self.offset)
+        bitmap_size = (self.chunk_count + 7) // 8
+        try:
+            with open(filename, "rb") as f:
+                state = f.read()
+            magic, filesize, chunk_size, offset, length = STATE.unpack_from(state)
+        except (OSError, struct.error):
+            magic = None
+
+        # The chunks can only be taken over if they were written with a chunk size the client can still use, the
+        # session then uses that one
+        if magic == STATE_MAGIC and (filesize, offset, length) == (self.filesize, self.offset, self.length) and \
+                chunk_size <= self.chunk_size:
+            self.chunk_size = chunk_size
+            self.metrics.chunk_size = chunk_size
+            self.chunk_count = -(-self.length // chunk_size)
+            bitmap_size = (self.chunk_count + 7) // 8
+            self.have = udp_packet.unpack_bitmap(state[STATE.size:STATE.size + bitmap_size], self.chunk_count)
+            self.bitmap = bytearray(udp_packet.pack_bitmap(self.have))
+            self.state_file = open(filename, "r+b", buffering=0)
+
+            # Everything else follows from which chunks are there
+            chunks = self.have.count(1)
+            self.received = chunks * chunk_size
+            if chunks and self.have[-1]:
+                self.received -= chunk_size - self.chunk_length(self.chunk_count)
+            self.highest = self.have.rfind(1) + 1
+            while self.seq_num <= self.chunk_count and self.have[self.seq_num - 1]:
+                self.seq_num += 1
+            if self.received:
+                print(f"Resuming {self.filename} with {self.received}/{self.length} bytes already received")
+            return
+
+        self.bitmap = bytearray(bitmap_size)
+        self.state_file = open(filename, "wb", buffering=0)
+        self.state_file.write(STATE.pack(STATE_MAGIC, self.filesize, self.chunk_size, self.offset, self.length))
+        self.state_file.write(self.bitmap)
 
+    # The open_basis() method opens the copy of the file the server already has as the basis of a delta, if there is
+    # one, and gets its signature for the block size of the chunk size from hash_cache. A copy smaller than one block
+    # has nothing a COPY could point at, the client sends the whole file as plain chunks then and so no basis is kept
+    # How big the signature is follows from the size of the basis, the signature itself is hashed in a thread of its
+    # own so a big basis doesn't hold up the other clients, and piece() hands it out as far as it is done
+    def open_basis(self, hash_cache):
+        try:
+            basis = open(self.filename, "rb")
+        except OSError:
+            return
+        basis_size = os.fstat(basis.fileno()).st_size
+        block_size = udp_packet.delta_block_size(self.chunk_size)
+        if basis_size < block_size:
+            basis.close()
+            return
+        self.basis = basis
+        self.basis_size = basis_size
+        self.signature_size = basis_size // block_size * udp_delta.BLOCK.size
+        self.signature = bytearray()
+        threading.Thread(target=hash_cache.signature, args=(self.filename, block_size),
+                         kwargs={"progress": self.signature}, daemon=True).start()
+        print(f"Delta against {self.filename} ({self.basis_size} bytes, "
+              f"{self.signature_size // udp_delta.BLOCK.size} blocks)")
 
-# Define the buffer size (increased packet size to include packet header)
-BUFFER_SIZE = 1032
+    # The hello_ack() method returns the HELLO_ACK telling the client which chunk size to use, how many bytes the
+    # session already has and how many blocks the signature of the basis of a delta has
+    def hello_ack(self):
+        self.last_active = time.monotonic()
+        size = udp_packet.pack_hello_ack(self.reply_buffer, self.chunk_size, self.received,
+                                         self.signature_size // udp_delta.BLOCK.size)
+        return self.reply_view[:size]
+
+    # The piece() method returns the STATE with the bitmap bytes, or the SIGNATURE with the signature bytes, from offset
+    # on, as many as fit in a packet of the chunk size, for a client resuming the transfer or sending a delta
+    def piece(self, packet_type, offset):
+        self.last_active = time.monotonic()
+        data = self.bitmap if packet_type == udp_packet.TYPE_STATE else self.signature
+        if not data:
+            return None
+
+        # A piece of the signature that is still being hashed isn't answered, the client asks for it again
+        if packet_type == udp_packet.TYPE_SIGNATURE and len(data) < min(offset + self.chunk_size, self.signature_size):
+            return None
+        if self.piece_buffer is None:
+            self.piece_buffer = bytearray(udp_packet.HEADER.size + self.chunk_size)
+        size = udp_packet.pack_piece(self.piece_buffer, packet_type, offset, data[offset:offset + self.chunk_size])
+        return memoryview(self.piece_buffer)[:size]
+
+    # The instruction() method returns (offset, basis offset, length) of the LITERAL or COPY packet_data of a delta,
+    # basis offset is None for a LITERAL, or None if it isn't an instruction that fits the file and the basis
+    def instruction(self, packet_type, packet_data):
+        if packet_type == udp_packet.TYPE_LITERAL and len(packet_data) > udp_packet.LITERAL.size:
+            offset, = udp_packet.LITERAL.unpack_from(packet_data)
+            basis_offset, length = None, len(packet_data) - udp_packet.LITERAL.size
+        elif packet_type == udp_packet.TYPE_COPY and len(packet_data) == udp_packet.COPY.size:
+            offset, basis_offset, length = udp_packet.COPY.unpack_from(packet_data)
+            if not length or basis_offset + length > self.basis_size:
+                return None
+        else:
+            return None
+        if offset + length > self.length:
+            return None
+        return offset, basis_offset, length
+
+    # The handle_manifest() method takes the MANIFEST piece of a batch at offset and returns the answer that it took the
+    # piece, or None if it didn't. The files are set up (open_batch()) once the last piece has arrived, a manifest that
+    # doesn't add up to the size of the batch is never answered and the client gives up on it
+    def handle_manifest(self, offset, packet_data):
+        self.last_active = time.monotonic()
+        if not self.batch or len(packet_data) <= udp_packet.MANIFEST.size:
+            return None
+        if self.entries is None:
+            manifest_size, = udp_packet.MANIFEST.unpack_from(packet_data)
+            piece = bytes(packet_data[udp_packet.MANIFEST.size:])
+            if offset + len(piece) > manifest_size:
+                return None
+            self.manifest_pieces[offset] = piece
+
+            # The manifest is complete once the pieces follow each other up to its size
+            position = 0
+            for piece_offset in sorted(self.manifest_pieces):
+                if piece_offset != position:
+                    break
+                position += len(self.manifest_pieces[piece_offset])
+            if position == manifest_size:
+                manifest = b''.join(self.manifest_pieces[piece_offset] for piece_offset in sorted(self.manifest_pieces))
+                entries = udp_batch.unpack_manifest(manifest)
+                if entries is None or sum(size for name, size in entries) != self.length:
+                    del self.manifest_pieces[offset]
+                    print(f"Manifest from {self.client_address[0]}:{self.client_address[1]} doesn't match its batch")
+                    return None
+                self.open_batch(entries)
+        size = udp_packet.pack_request(self.reply_buffer, udp_packet.TYPE_MANIFEST, offset)
+        return self.reply_view[:size]
+
+    # The open_batch() method lays out the files of the manifest entries one after the other and creates the empty
+    # ones, which are never written to
+    def open_batch(self, entries):
+        self.manifest_pieces = {}
+        self.entries = entries
+        self.sizes = [size for name, size in entries]
+        self.offsets = udp_batch.file_offsets(self.sizes)
+        self.chunk_count = -(-self.length // self.chunk_size)
+        self.have = bytearray(self.chunk_count)
+        self.files = [None] * len(entries)
+        self.remaining = list(self.sizes)
+        print(f"Batch of {len(entries)} files, {self.chunk_count} chunks -> {self.filename}")
+        for index, size in enumerate(self.sizes):
+            if not size:
+                self.batch_file(index).close()
+                self.files[index] = None
+        if self.received >= self.length:
+            self.finish()
+
+    # The batch_file() method returns the open file number index of the batch, it is created (with its directories)
+    # at its full size the first time and opened again as it is after it was closed
+    # The files of a batch of small files are written in one or two parts, those aren't preallocated and every
+    # directory is only made once: creating the files is what a batch of small files spends most of its time on
+    def batch_file(self, index):
+        f = self.files[index]
+        if f is None:
+            name, size = self.entries[index]
+            path = udp_batch.batch_path(self.filename, name)
+            if index in self.created:
+                f = open(path, "r+b", buffering=0)
+            else:
+                directory = os.path.dirname(path)
+                if directory not in self.directories:
+                    os.makedirs(directory, exist_ok=True)
+                    self.directories.add(directory)
+                f = open(path, "w+b", buffering=0)
+                if size > self.chunk_size:
+                    try:
+                        preallocate(f, size)
+                    except OSError:
+                        f.close()
+                        raise
+                self.created.add(index)
+            self.files[index] = f
+        return f
+
+    # The write_chunk() method writes the data of chunk seq_num to its offset in the file, or every part of it to the
+    # file of the batch it belongs to. A file of a batch that has all of its bytes now is closed, FEC opens it again if
+    # it has to read from it
+    def write_chunk(self, seq_num, data):
+        if self.entries is None:
+            write_at(self.f, data, self.offset + (seq_num - 1) * self.chunk_size)
+            return
+        position = 0
+        for index, offset, length in udp_batch.spans(self.offsets, self.sizes, (seq_num - 1) * self.chunk_size,
+                                                     len(data)):
+            write_at(self.batch_file(index), data[position:position + length], offset)
+            position += length
+            self.remaining[index] -= length
+            if not self.remaining[index]:
+                self.files[index].close()
+                self.files[index] = None
+
+    # The read_chunk() method reads chunk seq_num back from the file (or files) it was written to
+    def read_chunk(self, seq_num):
+        length = self.chunk_length(seq_num)
+        if self.entries is None:
+            return read_at(self.f, length, self.offset + (seq_num - 1) * self.chunk_size)
+        return b''.join(read_at(self.batch_file(index), part, offset) for index, offset, part in
+                        udp_batch.spans(self.offsets, self.sizes, (seq_num - 1) * self.chunk_size, length))
+
+    # The handle_data() method takes the sequence number and data (a memoryview of the receive buffer) of one data
+    # packet from the client and returns the ACK to send back now, or None if the packet is ignored or the ACK can wait
+    # The packet of a delta is a LITERAL or COPY (packet_type) instead, its sequence number is the instruction's
+    # The receive buffer is reused for the next datagram, so nothing may hold on to the data after this returns
+    # A chunk with udp_packet.CHUNK_COMPRESSED in its header flags is decompressed (udp_compress.decompress()) before it
+    # is written, and ignored unless it decompresses to exactly the length of the chunk
+    def handle_data(self, packet_seq_num, packet_data, packet_type=udp_packet.TYPE_DATA, flags=0):
+        now = time.monotonic()
+        self.last_active = now
+
+        # Count the packet, the length of the data comes from the packet header
+        metrics = self.metrics
+        metrics.packets_received += 1
+        metrics.bytes_received += len(packet_data)
+
+        # Every chunk but the last is exactly chunk_size bytes, anything that isn't a chunk of this file (or an
+        # instruction of the delta) is ignored. How long a compressed chunk is only shows once it is decompressed
+        compressed = flags & udp_packet.CHUNK_COMPRESSED
+        instruction = None
+        valid = 1 <= packet_seq_num <= self.chunk_count
+        if self.basis is not None:
+            instruction = self.instruction(packet_type, packet_data)
+            valid = valid and instruction is not None and not compressed
+        else:
+            valid = valid and packet_type == udp_packet.TYPE_DATA and \
+                (compressed or len(packet_data) == self.chunk_length(packet_seq_num))
+        if not valid:
+            metrics.ignored += 1
+            if self.tracer is not None:
+                self.tracer.event("ignore", packet_seq_num, bytes=len(packet_data), client=self.client_address[1])
+            return None
+
+        # Chunks that were already written only need the ACK again, theirs must have been lost since the client sent
+        # them again, so that ACK goes out right away
+        if self.have[packet_seq_num - 1]:
+            metrics.duplicates += 1
+            if self.tracer is not None:
+                self.tracer.event("duplicate", packet_seq_num, client=self.client_address[1])
+            return self.ack()
+
+        # Only a chunk that isn't in the file yet is worth decompressing
+        if compressed:
+            packet_data = udp_compress.decompress(packet_data, self.chunk_length(packet_seq_num))
+            if packet_data is None:
+                metrics.ignored += 1
+                if self.tracer is not None:
+                    self.tracer.event("ignore", packet_seq_num, client=self.client_address[1])
+                return None
+            metrics.compressed += 1
+
+        # A chunk past the oldest missing one arrived ahead of it (or the one in front of it was lost)
+        if packet_seq_num != self.seq_num:
+            metrics.out_of_order += 1
+        if self.tracer is not None:
+            self.tracer.event("receive", packet_seq_num, bytes=len(packet_data), client=self.client_address[1],
+                              in_order=packet_seq_num == self.seq_num)
+
+        # Write the data from the packet to the file -- the opposite of what is done in the client, rb or
+        # read-binary vs. write-binary -- straight out of the receive buffer and at its own offset
+        # The literal data of a delta says where it goes itself, a COPY is copied over from the basis
+        if instruction is None:
+            self.write_chunk(packet_seq_num, packet_data)
+            written = len(packet_data)
+        else:
+            offset, basis_offset, written = instruction
+            if basis_offset is None:
+                write_at(self.f, packet_data[udp_packet.LITERAL.size:], offset)
+            else:
+                copy_range(self.basis, self.f, offset, basis_offset, written)
+                metrics.bytes_copied += written
+        self.store(packet_seq_num, written)
+
+        # The chunk may be the last one its group was missing, or leave no more missing than there is parity for
+        chunks = 1
+        if self.fec is not None:
+            group = (packet_seq_num - 1) // self.fec.group_size
+            if group in self.parity:
+                chunks += self.repair(group)
+        return self.acknowledge(now, chunks)
+
+    # The handle_stream() method is handle_data() for a session of a stream: it takes the sequence number, data and
+    # header flags of one DATA packet, delivers the chunk (and every chunk waiting behind it) if it is the next one and
+    # keeps it until it is otherwise, and returns the ACK to send back now or None
+    # A chunk is up to chunk_size bytes and only the chunk flagged CHUNK_END can be empty, chunks further ahead than
+    # STREAM_WINDOW or past the end are ignored. The next chunk is delivered straight out of the receive buffer
+    def handle_stream(self, packet_seq_num, packet_data, flags=0):
+        now = time.monotonic()
+        self.last_active = now
+        metrics = self.metrics
+        metrics.packets_received += 1
+        metrics.bytes_received += len(packet_data)
+
+        compressed = flags & udp_packet.CHUNK_COMPRESSED
+        end = flags & udp_packet.CHUNK_END
+        valid = 1 <= packet_seq_num <= self.seq_num + STREAM_WINDOW and len(packet_data) <= self.chunk_size and \
+            bool(packet_data or end)
+        if self.end is not None:
+            valid = valid and (packet_seq_num == self.end if end else packet_seq_num < self.end)
+        elif end:
+            valid = valid and packet_seq_num >= self.highest
+        if not valid:
+            metrics.ignored += 1
+            if self.tracer is not None:
+                self.tracer.event("ignore", packet_seq_num, bytes=len(packet_data), client=self.client_address[1])
+            return None
+
+        # Chunks that were already delivered, or are waiting to be, only need the ACK again
+        if packet_seq_num < self.seq_num or packet_seq_num in self.pending:
+            metrics.duplicates += 1
+            if self.tracer is not None:
+                self.tracer.event("duplicate", packet_seq_num, client=self.client_address[1])
+            return self.ack()
+
+        if compressed:
+            packet_data = udp_compress.decompress(packet_data, self.chunk_size, exact=False)
+            if packet_data is None:
+                metrics.ignored += 1
+                if self.tracer is not None:
+                    self.tracer.event("ignore", packet_seq_num, client=self.client_address[1])
+                return None
+            metrics.compressed += 1
+
+        if packet_seq_num != self.seq_num:
+            metrics.out_of_order += 1
+        if self.tracer is not None:
+            self.tracer.event("receive", packet_seq_num, bytes=len(packet_data), client=self.client_address[1],
+                              in_order=packet_seq_num == self.seq_num)
+        if end:
+            self.end = packet_seq_num
+        self.received += len(packet_data)
+        self.highest = max(self.highest, packet_seq_num)
+
+        # The receive buffer is reused for the next datagram, so a chunk that has to wait is copied
+        if packet_seq_num != self.seq_num:
+            self.pending[packet_seq_num] = bytes(packet_data)
+            return self.acknowledge(now, 1)
+        self.sink.write(packet_data)
+        self.seq_num += 1
+        while self.seq_num in self.pending:
+            self.sink.write(self.pending.pop(self.seq_num))
+            self.seq_num += 1
+        return self.acknowledge(now, 1)
+
+    # The handle_parity() method takes the sequence number and data of one PARITY packet, keeps it with the parity of
+    # its group and rebuilds the lost chunks of the group if there is enough parity now. It returns the ACK to send
+    # back now or None, like handle_data()
+    def handle_parity(self, packet_seq_num, packet_data):
+        now = time.monotonic()
+        self.last_active = now
+        metrics = self.metrics
+        metrics.parity_received += 1
+
+        # Parity is always chunk_size bytes, and only for the groups of this file
+        if self.fec is None or len(packet_data) != self.chunk_size or \
+                packet_seq_num // self.fec.parity_count * self.fec.group_size >= self.chunk_count:
+            metrics.ignored += 1
+            return None
+        group, number = divmod(packet_seq_num, self.fec.parity_count)
+        if self.completed is not None or not self.missing(group):
+            return None
+
+        self.parity.setdefault(group, {})[number] = bytes(packet_data)
+        chunks = self.repair(group)
+        return self.acknowledge(now, chunks) if chunks else None
+
+    # The missing() method returns the sequence numbers of the chunks of FEC group group that haven't arrived yet
+    def missing(self, group):
+        first = group * self.fec.group_size + 1
+        last = min(first + self.fec.group_size, self.chunk_count + 1)
+        return [seq_num for seq_num in range(first, last) if not self.have[seq_num - 1]]
+
+    # The repair() method rebuilds the lost chunks of FEC group group if as many of its parity packets arrived as it
+    # has chunks missing, writes them to the file and returns how many it rebuilt. The chunks that did arrive are read
+    # back from the file. Once the group is complete its parity is dropped
+    def repair(self, group):
+        missing = self.missing(group)
+        parity = self.parity.get(group, {})
+        if len(parity) < len(missing):
+            return 0
+        if missing:
+            first = group * self.fec.group_size + 1
+            last = min(first + self.fec.group_size, self.chunk_count + 1)
+            chunks = [self.read_chunk(seq_num) if self.have[seq_num - 1] else None for seq_num in range(first, last)]
+            for index, data in self.fec.decode(chunks, parity, self.chunk_size).items():
+                seq_num = first + index
+                length = self.chunk_length(seq_num)
+                self.write_chunk(seq_num, memoryview(data)[:length])
+                self.store(seq_num, length)
+                if self.tracer is not None:
+                    self.tracer.event("repair", seq_num, client=self.client_address[1])
+            self.metrics.fec_repaired += len(missing)
+        self.parity.pop(group, None)
+        return len(missing)
+
+    # The store() method notes that chunk seq_num, written bytes of the file, is in the file now
+    def store(self, seq_num, written):
+        self.have[seq_num - 1] = 1
+
+        # Only once the chunk is in the file can the state file say so, only the one byte of the bitmap it is in
+        # changes
+        if self.state_file is not None:
+            index = (seq_num - 1) >> 3
+            self.bitmap[index] |= 0x80 >> ((seq_num - 1) & 7)
+            write_at(self.state_file, self.bitmap[index:index + 1], STATE.size + index)
+        self.received += written
+        self.highest = max(self.highest, seq_num)
+        while self.seq_num <= self.chunk_count and self.have[self.seq_num - 1]:
+            self.seq_num += 1
+
+    # The acknowledge() method returns the ACK to send now that chunks more chunks are in the file, or None if it can
+    # wait, and finishes the file once every byte has been written
+    def acknowledge(self, now, chunks):
+        # If we have received all the data the file is done, a stream once its end has been delivered
+        # No checksum or data validity check, but essentially a size parity check
+        # test.jpg == test2.jpg?
+        if self.sink is None and self.received >= self.length or self.end is not None and self.seq_num > self.end:
+            ack = self.ack()
+            self.finish()
+            return ack
+
+        # Otherwise the ACK waits for more chunks to cover, up to ack_every of them or ack_delay seconds
+        self.unacked += chunks
+        if self.unacked >= self.ack_every:
+            return self.ack()
+        if self.ack_deadline is None:
+            self.ack_deadline = now + self.ack_delay
+        return None
+
+    # The ack() method returns the ACK for every chunk received so far: the cumulative acknowledgement (the chunk in
+    # front of the oldest missing one) and the bitmap of the chunks received after it
+    # A stream has no byte per chunk for all of its chunks, only the ones from the next chunk to deliver on are made up
+    # from the chunks waiting to be delivered
+    def ack(self):
+        self.unacked = 0
+        self.ack_deadline = None
+        self.metrics.acks_sent += 1
+        if self.tracer is not None:
+            self.tracer.event("ack", self.seq_num - 1, highest=self.highest, client=self.client_address[1])
+        have, first = self.have, 1
+        if self.sink is not None:
+            have, first = bytearray(self.highest - self.seq_num + 1), self.seq_num
+            for seq_num in self.pending:
+                have[seq_num - first] = 1
+        size = udp_packet.pack_ack(self.reply_buffer, self.seq_num - 1, have, self.highest, first)
+        return self.reply_view[:size]
+
+    # The ack_due() method tells the caller a delayed ACK has waited long enough and has to be sent with ack() now
+    def ack_due(self, now):
+        return self.ack_deadline is not None and now >= self.ack_deadline
+
+    # The chunk_length() method is how many bytes of data chunk seq_num has, chunk_size for all but the last one
+    def chunk_length(self, seq_num):
+        return min(self.chunk_size, self.length - (seq_num - 1) * self.chunk_size)
+
+    # The close_files() method closes the file of the session, or every file of a batch that is still open
+    def close_files(self):
+        if self.f is not None:
+            self.f.close()
+        for f in self.files:
+            if f is not None:
+                f.close()
+        self.files = [None] * len(self.files)
+
+    # The finish() method closes the file once every byte has been written, the file no longer needs a state file and
+    # the file of a delta takes the place of its basis. A stream is as long as what was delivered, its sink is told it
+    # ended
+    def finish(self):
+        if self.sink is not None:
+            self.sink.end()
+            self.length = self.filesize = self.metrics.filesize = self.received
+        self.close_files()
+        if self.basis is not None:
+            self.basis.close()
+            os.replace(delta_filename(self.filename), self.filename)
+        if self.state_file is not None:
+            self.state_file.close()
+            self.state_file = None
+            try:
+                os.remove(state_filename(self.filename, self.offset))
+            except OSError:
+                pass
+        self.completed = time.monotonic()
+        self.metrics.finish(True)
+
+        # Print a message indicating the file (or the stripe of it, or the batch) has been received, and the summary
+        # of the transfer
+        if self.batch:
+            received = f"Batch of {len(self.entries)} files"
+        elif self.sink is not None:
+            received = "Stream"
+        elif self.length == self.filesize:
+            received = "File"
+        else:
+            received = f"Stripe {self.offset}-{self.offset + self.length} of {self.filesize} bytes"
+        print(f"{received} from {self.client_address[0]}:{self.client_address[1]} received successfully "
+              f"({self.length} bytes in {self.completed - self.started:.3f}s) -> {self.filename or 'its reader'}")
+        print(self.metrics.summary())
+
+    # The close() method drops an unfinished transfer, the partial file is left behind (with its state file, so the
+    # transfer can be resumed if it has a transfer id). An unfinished delta is thrown away, the basis is still there
+    # The sink of an unfinished stream is told it won't end, unless the client started over (restarted) before any
+    # of it was delivered and the new session delivers it from the start. reason is what is printed for the transfer
+    def close(self, restarted=False, reason="timed out"):
+        if self.completed is None:
+            if self.sink is not None and not restarted:
+                self.sink.abort()
+            self.close_files()
+            if self.basis is not None:
+                self.basis.close()
+                try:
+                    os.remove(delta_filename(self.filename))
+                except OSError:
+                    pass
+            if self.state_file is not None:
+                self.state_file.close()
+            self.metrics.finish(False)
+            print(f"Transfer from {self.client_address[0]}:{self.client_address[1]} {reason} after "
+                  f"{self.received}{'' if self.sink is not None else f'/{self.length}'} bytes")
+
+    # The expired() method tells the server the session can be forgotten: either the file is done and the client has
+    # had LINGER seconds to collect its last ACKs, or the client stopped sending in the middle of the transfer
+    def expired(self, now, idle_timeout=SESSION_TIMEOUT):
+        if self.completed is not None:
+            return now - self.last_active >= LINGER
+        return now - self.last_active >= idle_timeout
+
+
+# The handle_datagram() method is where every datagram the server receives ends up, the first nbytes of the memoryview
+# view, coming from client_address. It looks at the packet type, finds or starts the client's session in sessions and
+# returns the reply to send back, or None if there is nothing to send. A new session counts into
+# metrics_for(client_address), or a Metrics of its own without metrics_for. The file of a stripe of a striped transfer
+# is filename_for(client_address, transfer_id), so every stripe from the same host ends up in the same file
+# The signatures for deltas come from hash_cache, udp_delta.default_cache unless another one is given
+# A stream is delivered to stream_for(client_address), a callback, writable or udp_stream.StreamReader, or written to
+# the file filename_for(client_address) without stream_for
+# A file that can't be created or written (OSError) only ends the transfer of the client it belongs to, its session is
+# closed and forgotten and the server goes on with everyone else
+def handle_datagram(sessions, view, nbytes, client_address, filename_for, max_chunk_size, metrics_for=None,
+                    hash_cache=None, stream_for=None):
+    try:
+        return dispatch_datagram(sessions, view, nbytes, client_address, filename_for, max_chunk_size, metrics_for,
+                                 hash_cache, stream_for)
+    except OSError as error:
+        print(f"\nDropping {client_address[0]}:{client_address[1]}: {error}")
+        session = sessions.pop(client_address, None)
+        if session is not None:
+            session.close(reason="failed")
+        return None
+
+
+# The dispatch_datagram() method is handle_datagram() without the OSError handling: it hands the datagram to the
+# client's session, or starts one for a HELLO
+def dispatch_datagram(sessions, view, nbytes, client_address, filename_for, max_chunk_size, metrics_for=None,
+                      hash_cache=None, stream_for=None):
+    # Unpack the header and get the packet type, the length of the data and the sequence number
+    # No error checking or data validity but that is out of scope -- could be done with a checksum sent with the
+    # packet header
+    header = udp_packet.unpack_header(view, nbytes)
+    if header is None:
+        return None
+    packet_type, length, seq_num = header
+    session = sessions.get(client_address)
+
+    if packet_type == udp_packet.TYPE_HELLO:
+        # The size of the HELLO is the chunk size the client wants, it made it here so the path can carry it
+        filesize, chunk_size, transfer_id, offset, stripe_length, flags, fec_group, fec_parity = \
+            udp_packet.unpack_hello(view)
+        chunk_size = max(min(chunk_size, length, max_chunk_size), udp_packet.MIN_CHUNK_SIZE)
+
+        # A stripe has to be part of the file
+        if offset + stripe_length > filesize:
+            return None
+
+        # A HELLO from a client that is already sending data (or the manifest of a batch) is a copy of one that was
+        # already answered, the client just didn't get the answer in time, otherwise it (re)starts the transfer with
+        # what it asked for this time
+        if session is None or session.completed is not None or \
+                session.received == 0 and session.entries is None and not session.manifest_pieces:
+            if session is not None:
+                session.close(restarted=True)
+                del sessions[client_address]
+            print(f"\nReceiving data from {client_address[0]}:{client_address[1]}...")
+            print(f"Received image size: {'unknown (stream)' if flags & udp_packet.FLAG_STREAM else filesize}, "
+                  f"chunk size: {chunk_size}")
+
+            # The files of a batch go into a directory named like the file the client would have sent otherwise, a
+            # batch is never striped, and neither is a stream
+            batch = bool(flags & udp_packet.FLAG_BATCH)
+            stream = bool(flags & udp_packet.FLAG_STREAM)
+            sink = None
+            if stream:
+                transfer_id, offset, stripe_length = 0, 0, 0
+                sink = stream_for(client_address) if stream_for is not None else None
+                filename = filename_for(client_address) if sink is None else None
+            elif batch:
+                transfer_id, offset, stripe_length = 0, 0, filesize
+                filename = os.path.splitext(filename_for(client_address))[0]
+            elif transfer_id:
+                print(f"Transfer {transfer_id:08x}, bytes {offset}-{offset + stripe_length}")
+                filename = filename_for(client_address, transfer_id)
+            else:
+                filename = filename_for(client_address)
+            metrics = metrics_for(client_address) if metrics_for is not None else None
+            session = ReceiveSession(client_address, filesize, chunk_size, filename, metrics=metrics,
+                                     transfer_id=transfer_id, offset=offset, length=stripe_length,
+                                     delta=bool(flags & udp_packet.FLAG_DELTA), hash_cache=hash_cache,
+                                     fec=(fec_group, fec_parity) if fec_parity else None, batch=batch,
+                                     stream=stream, sink=sink)
+            sessions[client_address] = session
+        return session.hello_ack()
+
+    # Data from a client without a session is most likely a late packet from a transfer the server already forgot
+    if session is None:
+        return None
+
+    # A client resuming a transfer asks for the bitmap of the chunks the session has and a client sending a delta for
+    # the signature of the basis, the sequence number is the offset into them
+    if packet_type in (udp_packet.TYPE_STATE, udp_packet.TYPE_SIGNATURE):
+        return session.piece(packet_type, seq_num)
+    if packet_type == udp_packet.TYPE_PARITY:
+        return session.handle_parity(seq_num, udp_packet.payload(view, length))
+    if packet_type == udp_packet.TYPE_MANIFEST:
+        return session.handle_manifest(seq_num, udp_packet.payload(view, length))
+    if packet_type not in (udp_packet.TYPE_DATA, udp_packet.TYPE_LITERAL, udp_packet.TYPE_COPY):
+        return None
+    if session.sink is not None:
+        if packet_type != udp_packet.TYPE_DATA:
+            return None
+        return session.handle_stream(seq_num, udp_packet.payload(view, length), udp_packet.header_flags(view))
+    return session.handle_data(seq_num, udp_packet.payload(view, length), packet_type, udp_packet.header_flags(view))
 
 
 # The receive_image() method is the main driver of the server, as this handles the information from the socket
 # connection and rebuilding the image file from the client
-def receive_image(sock):
-    # Receive the size of the image from the client
-    data, client_address = sock.recvfrom(BUFFER_SIZE)
-    filesize = int(data.decode())
-    print("\nReceiving data...")
-    print(f"Received image size: {filesize}")
-
-    # Open a new file to write the image data to -- in this case 'test2.jpg' as per the requirements for the project
-    with open("test2.jpg", "wb") as f:
-        # Since receiving, seq_num starts at 1 as it is expecting 1 from the client
-        seq_num = 1
+# This receives exactly one file from the first client that sends a HELLO, serve() is the version for many clients
+# Pass in a udp_metrics.Metrics as metrics to follow the transfer while it runs
+# If the client sends a stream it is delivered to stream (a callback, writable or udp_stream.StreamReader) as it
+# arrives, or written to filename without one. A stream (or file) that doesn't get done is closed at the end
+def receive_image(sock, filename="test2.jpg", max_chunk_size=MAX_CHUNK_SIZE, metrics=None, stream=None):
+    # Every datagram is received into this one buffer
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    # Only the first client gets a session
+    sessions = {}
+    client_address = None
+    enlarge_receive_buffer(sock)
+
+    timeout = sock.gettimeout()
+    try:
+        # Keep going until the file is complete, then keep ACKing retransmitted packets for a little while in case
+        # the last ACKs were lost on the way back
         while True:
+            session = sessions.get(client_address)
+            wait = None
+            if session is not None:
+                # Send the delayed ACK once it is due, and wait for the next packet no longer than until the next one is
+                now = time.monotonic()
+                if session.ack_due(now):
+                    sock.sendto(session.ack(), client_address)
+                if session.ack_deadline is not None:
+                    wait = session.ack_deadline - now
+                if session.completed is not None:
+                    remaining = LINGER - (now - session.last_active)
+                    if remaining <= 0:
+                        break
+                    wait = remaining if wait is None else min(wait, remaining)
+
+            # Without a timer of its own the socket waits as long as it did before receive_image() was called
+            sock.settimeout(timeout if wait is None else wait)
+
             # Receive the packet from the client
-            packet, client_address = sock.recvfrom(BUFFER_SIZE)
-            
-            # This is for output to console and it peels off the 1024 bytes in the f-string
-            # since the actual packet is 1032 bytes in length, not 1024
-            print(f"Received packet {seq_num} with {len(packet)-8} bytes of data")
-
-            # Unpack the packet and get the sequence number, data, and file size
-            # struct.unpack() does the opposite (obviously) as struct.pack() and breaks the struct into chunks
-            # determined by the user parameters -- this also catches the last packet that is smaller than 1024 bytes
-            # packet_date[0] is the sequence number of type !I -- big-endian integer of 4 bytes
-            # packet_data[1] is the image data of type s1024 -- char[] of 1024 bytes
-            # packet_data[2] is the filesize, for looping until the size of 'test.jpg' is the same as 'test2.jpg'
-            # No error checking or data validity but that is out of scope -- could be done with a checksum sent with the
-            # packet header
-            packet_data = struct.unpack(f'!I{min(filesize-f.tell(),1024)}sI', packet)
-            packet_seq_num = packet_data[0]
-            packet_data = packet_data[1]
-            packet_filesize = packet_data[2]
-
-            # If the sequence number is not what we expect, ignore the packet and continue waiting
-            # This is for TIMEOUTs and out-of-order packets -- probably out of scope for this project
-            if packet_seq_num != seq_num:
-                print(f"Ignoring packet {packet_seq_num}, expected packet {seq_num}")
+            try:
+                nbytes, address = sock.recvfrom_into(buffer)
+            except socket.timeout:
+                if wait is None:
+                    break
+                continue
+            if client_address is not None and address != client_address:
                 continue
 
-            # Write the data from the packet to the file -- the opposite of what is done in the client, rb or read-binary vs.
-            # write-binary
-            f.write(packet_data)
+            # Send the reply to the client, the HELLO_ACK or the ACK if one is due
+            reply = handle_datagram(sessions, view, nbytes, address, lambda address, transfer_id=0: filename,
+                                    max_chunk_size, None if metrics is None else lambda address: metrics,
+                                    stream_for=None if stream is None else lambda address: stream)
+            if reply is not None:
+                client_address = address
+                sock.sendto(reply, client_address)
+    finally:
+        sock.settimeout(timeout)
+        for session in sessions.values():
+            session.close()
+
+
+# The receive_stream() method is receive_image() for a stream, as an async iterator: async for data in
+# receive_stream(sock) gets the bytes of the stream from the first client that sends one in order as they arrive, and
+# the loop raises ConnectionError if the stream stops before its end
+# The server runs in a thread of the event loop's default executor and delivers to a udp_stream.StreamReader, a
+# coroutine that falls behind holds the server up once the reader is full, so the client slows down to its pace
+async def receive_stream(sock, max_chunk_size=MAX_CHUNK_SIZE, metrics=None):
+    reader = udp_stream.StreamReader()
+    server = asyncio.get_running_loop().run_in_executor(
+        None, lambda: receive_image(sock, max_chunk_size=max_chunk_size, metrics=metrics, stream=reader))
+
+    # A server that stops without the stream ending (it failed, or no client came before the socket timed out) ends
+    # the reader as well, once the stream has ended this comes too late to matter
+    server.add_done_callback(lambda future: reader.abort(None if future.cancelled() else future.exception()))
+    try:
+        async for data in reader:
+            yield data
+    finally:
+        reader.close()
+
+
+# The serve() method receives files from any number of clients at the same time, forever (or until stop_event is set)
+# A single selector loop reads every datagram that hits the socket and hands it to the session of the client address
+# it came from, so no client has to wait for another one to finish. Idle sessions are dropped after idle_timeout
+# Every session counts into a udp_metrics.Metrics of its own, or the one metrics_for(client address) returns, and the
+# sessions are kept in the dict sessions if one is passed in, so the caller can look at them (and their metrics) while
+# the server runs. hash_cache is the udp_delta.HashCache the signatures for deltas are kept in
+# A stream is written to the file filename_for(client address) as it arrives, in order, or delivered to what
+# stream_for(client address) returns (see handle_datagram())
+def serve(sock, filename_for=session_filename, idle_timeout=SESSION_TIMEOUT, stop_event=None,
+          max_chunk_size=MAX_CHUNK_SIZE, metrics_for=None, sessions=None, hash_cache=None, stream_for=None):
+    if sessions is None:
+        sessions = {}
+    enlarge_receive_buffer(sock)
+
+    # Every datagram from every client is received into this one buffer
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
 
-            # Send an acknowledgement to the client with the sequence number of the packet
-            # This could be sent as a small packet with a separate loop or function in in the client receiving this
-            # and handling it for better space and time performance
-            ack_packet = struct.pack('!I', seq_num)
-            sock.sendto(ack_packet, client_address)
-            print(f"Sent ACK for packet {seq_num}\n")
+    # Wake up at least twice a second to expire sessions and check stop_event, sooner if a delayed ACK is due
+    timeout = 0.5
 
-            seq_num += 1
+    try:
+        while stop_event is None or not stop_event.is_set():
+            events = selector.select(timeout=timeout)
 
-            # If we have received all the data, break out of the loop
-            # No checksum or data validity check, but essentially a size parity check
-            # test.jpg == test2.jpg? -- if yes, break out of the loop and return to 'main'
-            if f.tell() >= filesize:
-                break
+            # Read every datagram waiting on the socket
+            while events:
+                try:
+                    nbytes, client_address = sock.recvfrom_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionResetError:
+                    # Windows reports an ICMP port unreachable from an earlier sendto() here
+                    continue
 
-    # Print a message indicating the file has been received
-    print("File received successfully.")
+                # Send the reply to the client, the HELLO_ACK or the ACK if one is due
+                reply = handle_datagram(sessions, view, nbytes, client_address, filename_for, max_chunk_size,
+                                        metrics_for, hash_cache, stream_for)
+                if reply is not None:
+                    send_reply(sock, reply, client_address)
+
+            # Send the delayed ACKs that are due and find out when the next one will be
+            now = time.monotonic()
+            timeout = 0.5
+            for client_address, session in sessions.items():
+                if session.ack_due(now):
+                    send_reply(sock, session.ack(), client_address)
+                elif session.ack_deadline is not None:
+                    timeout = min(timeout, session.ack_deadline - now)
+
+            # Forget about finished and abandoned sessions
+            for client_address in [address for address, session in sessions.items()
+                                   if session.expired(now, idle_timeout)]:
+                sessions.pop(client_address).close()
+    finally:
+        selector.close()
+        for session in sessions.values():
+            session.close()
+
+
+# The serve_worker() method is what every worker process of serve_workers() runs: serve() on its own socket until
+# stop_event is set or Ctrl+C is pressed, with a trace of its own written to trace if it is given
+def serve_worker(sock, trace=None, trace_every=1, **kwargs):
+    tracer = udp_metrics.Tracer(trace, trace_every) if trace else None
+    try:
+        serve(sock, metrics_for=None if tracer is None else lambda client_address: udp_metrics.Metrics(tracer),
+              **kwargs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tracer is not None:
+            tracer.close()
+        sock.close()
+
+
+# The serve_workers() method runs serve() on every socket in socks at the same time, each in a worker process of its
+# own so the workers don't share one interpreter lock and the server uses as many cores as it has sockets
+# The client of a striped transfer sends its stripes to all of the sockets, every stripe is received by the worker of
+# the socket it was sent to and written into the same file (see ReceiveSession). This returns once every worker has
+# stopped, stop_event has to be a multiprocessing.Event to reach them. The other keyword arguments go to serve()
+# With trace every worker writes its own trace file, the trace filename with the number of the worker added
+def serve_workers(socks, stop_event=None, trace=None, trace_every=1, **kwargs):
+    workers = []
+    for number, sock in enumerate(socks):
+        worker_trace = trace if trace in (None, "-") else f"{trace}.{number}"
+        worker = multiprocessing.Process(target=serve_worker, args=(sock, worker_trace, trace_every),
+                                         kwargs=dict(kwargs, stop_event=stop_event), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        # Ctrl+C reaches the workers as well and they stop on their own, the ones that don't are stopped here
+        for worker in workers:
+            worker.join(LINGER)
+            if worker.is_alive():
+                worker.terminate()
 
 
 # Define the main function to run the server
-def main():
+# The address can be given on the command line (python udp_server.py --port 5000) so the server can be run from a
+# script, without --port it is asked for like before. Port 0 picks any free port, the one picked is printed
+# With --workers N the server listens on N ports in a row starting at --port (or N free ports with port 0), each
+# served by a worker process of its own, for the stripes of striped transfers (python udp_client.py --stripes N)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receive images from UDP clients")
+    parser.add_argument("--host", help="IP address to listen on (default: the IP address of this machine)")
+    parser.add_argument("--port", type=int, help="port to listen on")
+    parser.add_argument("--trace", help="write every packet received and ACKed to this JSON-lines file, "
+                                        "- for the screen")
+    parser.add_argument("--trace-every", type=int, default=1, help="only trace every Nth packet")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes, each listening on its own port from --port up (default: 1)")
+    parser.add_argument("--hash-cache", help="keep the signatures of received files for deltas in this JSON file")
+    args = parser.parse_args(argv)
+
     # Set up server parameters and accept user input to set up the server IP and port
-    # Get the current machine's hostname
-    hostname = socket.gethostname()
+    ip_address = args.host
+    if ip_address is None:
+        # Get the current machine's hostname
+        hostname = socket.gethostname()
 
-    # GEt the IP address for the hostname
-    ip_address = socket.gethostbyname(hostname)
+        # GEt the IP address for the hostname
+        ip_address = socket.gethostbyname(hostname)
 
-    # Print the IP address
-    print(f"IP address for {hostname} is {ip_address}")
+        # Print the IP address
+        print(f"IP address for {hostname} is {ip_address}")
 
     # Prompt the user to enter a port number
-    server_port = input("Enter a port number: ")
+    server_port = args.port
+    if server_port is None:
+        server_port = input("Enter a port number: ")
 
-    # Conver the user input to an integer
-    server_port = int(server_port)
+        # Conver the user input to an integer
+        server_port = int(server_port)
 
     # Set up the SERVER_IP and SERVER_PORT variables
     SERVER_IP = ip_address
@@ -147,21 +1355,45 @@ def main():
     # Print the SERVER_IP and SERVER_PORT variables
     print(f"Server address: {SERVER_IP}:{SERVER_PORT}")
 
-    # Create a UDP socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Create a UDP socket for every worker
+    server_sockets = []
+    for number in range(max(args.workers, 1)):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Bind the socket to the server address and port (in this case, will be host IP and any
+        # port of choice), the ports of the workers follow each other
+        server_socket.bind((SERVER_IP, SERVER_PORT + number if SERVER_PORT else 0))
+        server_sockets.append(server_socket)
+    server_socket = server_sockets[0]
+    SERVER_PORT = server_socket.getsockname()[1]
 
-    # Bind the socket to the server address and port (in this case, will be host IP and any
-    # port of choice)
-    server_socket.bind((SERVER_IP, SERVER_PORT))
+    # Print a message indicating that the server is listening, flushed right away for scripts waiting on it
+    ports = ",".join(str(sock.getsockname()[1]) for sock in server_sockets)
+    print(f"Server listening on {SERVER_IP}:{ports}", flush=True)
 
-    # Print a message indicating that the server is listening
-    print(f"Server listening on {SERVER_IP}:{SERVER_PORT}")
+    # The signatures of the files received, for the clients sending deltas, are kept across runs with --hash-cache
+    hash_cache = udp_delta.HashCache(args.hash_cache) if args.hash_cache else None
 
-    # Call the receive_image function to receive the image data
-    receive_image(server_socket)
+    # Call the serve function to receive image data from every client that connects, until Ctrl+C is pressed
+    try:
+        if len(server_sockets) > 1:
+            serve_workers(server_sockets, trace=args.trace, trace_every=args.trace_every, hash_cache=hash_cache)
+        elif args.trace:
+            # One trace for every client, the events say which client they are about
+            tracer = udp_metrics.Tracer(args.trace, args.trace_every)
+            try:
+                serve(server_socket, metrics_for=lambda client_address: udp_metrics.Metrics(tracer),
+                      hash_cache=hash_cache)
+            finally:
+                tracer.close()
+        else:
+            serve(server_socket, hash_cache=hash_cache)
+    except KeyboardInterrupt:
+        pass
 
-    # Close the socket and print a message
-    server_socket.close()
+    # Close the sockets and print a message
+    for server_socket in server_sockets:
+        server_socket.close()
     print("Server socket closed.")
 
 
@@ -0,0 +1,267 @@
+"""
+Streams: data nobody knows the length of up front, from a pipe, a socket or a generator (live camera frames, a tar
+stream), sent while it is still being produced and handed over on the other side in order as it arrives. The client
+sends every piece the source produces as soon as it has it, up to a chunk at a time, and an empty chunk flagged
+`udp_packet.CHUNK_END` once the source is done. The server delivers every chunk to a callback, a writable or an async
+iterator as soon as every chunk in front of it has been delivered, the chunks that arrive ahead of that wait for it.
+
+Neither side ever holds more than about a window of chunks: the client only keeps the chunks that are in flight and
+the few the reader thread has ready (`Stream`), the server only the chunks that arrived ahead of a lost one.
+
+`asyncio` - The `asyncio` module is a library to write concurrent code using the async/await syntax. A `StreamReader`
+hands the data of a stream to a coroutine with `async for`, through an `asyncio.Queue`.
+
+`asyncio`: https://docs.python.org/3/library/asyncio.html
+
+`queue` - The `queue` module implements multi-producer, multi-consumer queues. The reader thread of a `Stream` puts the
+pieces it reads into a `queue.Queue` of a fixed size, so it stops reading when the client falls behind.
+
+`queue`: https://docs.python.org/3/library/queue.html
+
+`socket` - The `socket` module provides a low-level interface for network communication. A `socket.socketpair()` wakes
+the client up in `select.select()` when the reader thread has a piece for it.
+
+`socket`: https://docs.python.org/3/library/socket.html
+
+`threading` - The `threading` module constructs higher-level threading interfaces. The source of a stream is read in a
+thread of its own, a source that blocks (a pipe, a camera) doesn't hold up the client's ACKs and retransmissions. A
+`threading.Semaphore` keeps a `StreamReader` from taking more chunks than it has room for.
+
+`threading`: https://docs.python.org/3/library/threading.html
+
+"""
+
+import asyncio
+import queue
+import socket
+import threading
+
+
+# How many chunks a StreamReader keeps for a coroutine that hasn't read them yet, before the server waits for it
+READER_CHUNKS = 64
+
+
+# The pieces() method yields the data of source in pieces of at most chunk_size bytes as it comes: from a file-like
+# object (read1() or read(), binary), a socket (recv()) or any iterable of bytes-like objects, which are cut up where
+# they are bigger than a chunk. Empty pieces are left out, the end of the stream is the end of the pieces
+def pieces(source, chunk_size):
+    read = getattr(source, "read1", None) or getattr(source, "read", None) or getattr(source, "recv", None)
+    if read is not None:
+        while True:
+            piece = read(chunk_size)
+            if not piece:
+                return
+            yield piece
+    for data in source:
+        view = memoryview(data).cast("B")
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+
+
+# The Stream class is the source of a stream the client sends, read by a thread of its own so the client can take the
+# pieces when it has room for them (take()). A piece is a chunk, chunk seq_num is stream[(seq_num - 1) * chunk_size:]
+# like in the memory-mapped file of a single file transfer, but only as long as the piece is, and it is kept until it
+# is ACKed (release()). The reader thread keeps at most queue_size pieces ready, so neither the source nor the client
+# gets more than that ahead of the other
+# The end of the source is an empty chunk of its own (ended is set once it is taken), size is how many bytes were
+# taken. A source that fails sets error instead, the stream never ends then
+class Stream:
+    def __init__(self, source):
+        self.source = source
+        self.chunk_size = None
+        self.chunks = {}
+        self.count = 0
+        self.size = 0
+        self.ended = False
+        self.error = None
+        self.closed = False
+        self.queue = None
+        self.wakeup = None
+        self.waker = None
+
+    # The start() method starts reading the source, in pieces of up to chunk_size bytes
+    def start(self, chunk_size, queue_size):
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(queue_size)
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        threading.Thread(target=self.read, daemon=True).start()
+
+    # The read() method is the reader thread: every piece of the source goes into the queue, followed by None at the end
+    # or the exception reading the source raised. Anything can go wrong in a generator, so anything is passed on
+    def read(self):
+        try:
+            for piece in pieces(self.source, self.chunk_size):
+                if not self.put(piece):
+                    return
+        except Exception as error:
+            self.put(error)
+        else:
+            self.put(None)
+
+    # The put() method puts item in the queue, waiting for room, and wakes the client up. It returns False once the
+    # stream is closed, the reader thread stops then
+    def put(self, item):
+        if self.closed:
+            return False
+        self.queue.put(item)
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            # The socket buffer is full of wakeups the client hasn't read yet, or the stream was closed meanwhile
+            pass
+        return True
+
+    # The take() method takes the pieces the reader thread has ready as chunks, up to chunk number last, and returns how
+    # many chunks there are now. The wakeups are read first, a piece put in the queue after that wakes the client again
+    def take(self, last):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.count < last and not self.ended and self.error is None:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, Exception):
+                self.error = item
+                break
+            if item is None:
+                self.ended = True
+                item = b""
+            self.count += 1
+            self.chunks[self.count] = item
+            self.size += len(item)
+        return self.count
+
+    # The waiting() method tells whether the client has to wait for the source to have chunk number seq_num
+    def waiting(self, seq_num):
+        return seq_num > self.count and not self.ended and self.error is None
+
+    # Slicing a Stream returns the chunk the slice starts in, the slice always covers one chunk
+    def __getitem__(self, key):
+        return self.chunks[key.start // self.chunk_size + 1]
+
+    # The release() method drops chunk seq_num once it is ACKed, it is never sent again
+    def release(self, seq_num):
+        self.chunks.pop(seq_num, None)
+
+    # The fileno() method is what select.select() waits on for the next piece from the reader thread
+    def fileno(self):
+        return self.wakeup.fileno()
+
+    # The close() method stops the reader thread: it finds the stream closed the next time it has a piece, and the
+    # queue is emptied so it isn't left waiting for room
+    def close(self):
+        self.closed = True
+        self.chunks.clear()
+        if self.queue is not None:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.wakeup.close()
+            self.waker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The Writer class delivers a stream to a writable, anything with a write() method (a file, sys.stdout.buffer, a
+# socket's makefile("wb")). The data is written as it is, straight out of the server's receive buffer, and the
+# writable is flushed at the end of the stream but left open
+class Writer:
+    def __init__(self, writable):
+        self.writable = writable
+
+    def write(self, data):
+        self.writable.write(data)
+
+    def end(self):
+        flush = getattr(self.writable, "flush", None)
+        if flush is not None:
+            flush()
+
+    def abort(self, error=None):
+        pass
+
+
+# The Callback class delivers a stream to a callback, which is called with the bytes of every chunk in order and with
+# b'' at the end of the stream, like read() at the end of a file. A stream that never ends never gets the b''
+class Callback:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, data):
+        self.callback(bytes(data))
+
+    def end(self):
+        self.callback(b"")
+
+    def abort(self, error=None):
+        pass
+
+
+# The StreamReader class delivers a stream to a coroutine: async for data in reader gets the bytes of every chunk in
+# order, the loop ends at the end of the stream and raises ConnectionError (or the error the server stopped with) if
+# the stream stops before its end. It has to be made in the event loop it is read in, the server writes to it from
+# another thread (udp_server.receive_stream() runs it in the loop's executor)
+# At most max_chunks chunks wait for the coroutine, then write() waits for it, and so does the server. The coroutine
+# calls close() when it stops reading early, write() drops the chunks after that
+class StreamReader:
+    def __init__(self, max_chunks=READER_CHUNKS):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.room = threading.Semaphore(max_chunks)
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.room.acquire()
+        if not self.closed:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, bytes(data))
+
+    def end(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def abort(self, error=None):
+        if error is None:
+            error = ConnectionError("the stream stopped before its end")
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, error)
+
+    # The close() method lets a server waiting for room go on, the chunks it writes from now on are dropped
+    def close(self):
+        self.closed = True
+        self.room.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        self.room.release()
+        return item
+
+
+# The sink() method returns what the server delivers a stream to for target: a StreamReader (or Writer or Callback)
+# as it is, a Writer for anything with a write() method and a Callback for anything else that can be called
+def sink(target):
+    if isinstance(target, (StreamReader, Writer, Callback)):
+        return target
+    if hasattr(target, "write"):
+        return Writer(target)
+    if callable(target):
+        return Callback(target)
+    raise TypeError(f"a stream can't be delivered to {target!r}, it needs a write() method or to be callable")